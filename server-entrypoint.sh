@@ -5,6 +5,11 @@ set -ex
 # This script launches the backend as a production configuration.
 export ENVIRONMENT=current-deployment
 source ./load-env.sh
+# The workers read the file again on SIGHUP, i.e. after rotating credentials.
+export CONFIG_FILE="$(realpath "$ENV_FILE")"
+# Queued emails survive restarts in the spool, unless the env file sets another
+# directory.
+export MAIL_SPOOL_DIR="${MAIL_SPOOL_DIR:-$(realpath -m "$BUILD_DIR/spool")}"
 source ../venv/bin/activate # we have created a venv in the parent directory as part of boostrap.sh
 
 joshinkand --log-dir $LOGS_DIR --host $BACKEND_HOST --port $BACKEND_PORT
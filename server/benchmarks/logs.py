@@ -0,0 +1,80 @@
+"""Compares the previous logging setup (a StreamHandler writing synchronously,
+every logger at DEBUG and the handler filtering, plus `logger.debug(environ)`
+per request) with the queue based pipeline of `joshinkan.logger` at INFO.
+Output goes to /dev/null. Run from the server directory with
+`python -m benchmarks.logs`."""
+import logging
+import os
+import timeit
+from wsgiref.util import setup_testing_defaults
+
+from joshinkan.logger import get_logger, log_context, setup_logging, stop_logging
+
+
+def make_environ() -> dict:
+    environ = {
+        "REQUEST_METHOD": "POST",
+        "PATH_INFO": "/trial-registration",
+        "QUERY_STRING": "",
+        "CONTENT_TYPE": "application/x-www-form-urlencoded",
+        "CONTENT_LENGTH": "120",
+        "HTTP_USER_AGENT": "Mozilla/5.0 (X11; Linux x86_64) Firefox/120.0",
+        "HTTP_X_REAL_IP": "203.0.113.7",
+    }
+    setup_testing_defaults(environ)
+    return environ
+
+
+def previous_logger(stream) -> logging.Logger:
+    handler = logging.StreamHandler(stream)
+    handler.setLevel(logging.INFO)
+    handler.setFormatter(
+        logging.Formatter(fmt="%(levelname)s %(name)s %(asctime)s: %(message)s")
+    )
+    logger = logging.getLogger("previous")
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    return logger
+
+
+def bench(name: str, function, number: int = 20_000) -> float:
+    seconds = min(timeit.repeat(function, number=number, repeat=5))
+    print(f"{name:<40} {seconds / number * 1e6:8.2f} µs/request")
+    return seconds
+
+
+def main():
+    environ = make_environ()
+    with open(os.devnull, "w") as stream:
+        previous = previous_logger(stream)
+        setup_logging("INFO", "json", stream=stream)
+        logger = get_logger("joshinkan.benchmark")
+
+        def previous_request():
+            previous.debug(environ)
+            previous.info("Email sent.")
+
+        def request():
+            with log_context(request_id="0123456789abcdef"):
+                logger.debug(environ)
+                logger.info("Email sent.")
+
+        def previous_filtered():
+            previous.debug(environ)
+
+        def filtered():
+            logger.debug(environ)
+
+        baseline = bench("previous (debug environ + info)", previous_request)
+        seconds = bench("queue, json (debug environ + info)", request)
+        print(f"{'speedup':<40} {baseline / seconds:8.2f}x\n")
+
+        baseline = bench("previous (filtered debug)", previous_filtered)
+        seconds = bench("queue (filtered debug)", filtered)
+        print(f"{'speedup':<40} {baseline / seconds:8.2f}x")
+        stop_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Compares route resolution of the compiled route table with the previous
+dispatch in `make_app`, which looked up static routes with `has_route` and
+`get_route`, i.e. two dict lookups each, for a few hundred static routes.
+The previous router had no parameterised routes, so those are timed on their
+own, next to as many static routes. Run from the server directory with
+`python -m benchmarks.routing`."""
+import timeit
+
+from joshinkan.logger import setup_logging
+
+setup_logging("WARNING")
+
+from joshinkan.httpd import Request, Response, Router  # noqa: E402
+
+
+def handler(request: Request) -> Response:
+    return 200, None
+
+
+def make_router(count: int, parameters: bool) -> Router:
+    router = Router()
+    for index in range(count):
+        router.get(f"/static/{index}")(handler)
+        router.post(f"/static/{index}")(handler)
+        if parameters:
+            router.get(f"/dojo/{index}/members/{{member_id}}")(handler)
+    return router
+
+
+def make_previous(router: Router):
+    routes = router.routes
+
+    def has_route(method: str, path: str) -> bool:
+        return path in routes and method in routes[path]
+
+    def get_route(method: str, path: str):
+        return routes[path][method]
+
+    def resolve(method: str, path: str):
+        if has_route(method, path):
+            return get_route(method, path), {}
+        return None, {}
+
+    return resolve
+
+
+def bench(name: str, resolve, method: str, path: str, number: int = 200_000) -> float:
+    seconds = min(timeit.repeat(lambda: resolve(method, path), number=number, repeat=5))
+    print(f"{name:<36} {seconds / number * 1e6:8.2f} µs/call")
+    return seconds
+
+
+def main():
+    router = make_router(100, parameters=False)
+    compiled = router.compile()
+    previous = make_previous(router)
+
+    for label, method, path in [
+        ("static", "POST", "/static/99"),
+        ("not found", "GET", "/unknown/path"),
+    ]:
+        assert compiled.resolve(method, path)[0] is previous(method, path)[0]
+        slow = bench(f"has_route + get_route ({label})", previous, method, path)
+        fast = bench(f"compiled ({label})", compiled.resolve, method, path)
+        print(f"{'speedup':<36} {slow / fast:8.2f}x\n")
+
+    compiled = make_router(100, parameters=True).compile()
+    for label, method, path in [
+        ("parameter", "GET", "/dojo/99/members/42"),
+        ("not found among parameters", "GET", "/unknown/path"),
+    ]:
+        bench(f"compiled ({label})", compiled.resolve, method, path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Compares the previous JSON path (`json.dumps` followed by `bytes(...)`,
+and `json.loads` of the decoded body) with the codecs of `joshinkan.httpd`,
+for a typical response and a large export. Run from the server directory with
+`python -m benchmarks.serialisation`."""
+import json
+import timeit
+
+from joshinkan.logger import setup_logging
+
+setup_logging("WARNING")
+
+from joshinkan.httpd import STDLIB_JSON_CODEC, get_json_codec  # noqa: E402
+
+TYPICAL = {
+    "message": "The key 'email' is missing.",
+    "errors": [
+        {"message": "The key 'email' is missing.", "path": ["email"]},
+        {"message": "Expected type str but got int.", "path": ["phone"]},
+    ],
+}
+
+LARGE = {
+    "members": [
+        {
+            "id": index,
+            "first_name": "Jürgen",
+            "last_name": f"Member {index}",
+            "email": f"member{index}@example.com",
+            "grades": ["6. Kyu", "5. Kyu", "4. Kyu"],
+            "active": index % 3 != 0,
+            "fee": 12.5,
+        }
+        for index in range(5_000)
+    ]
+}
+
+
+def previous_dumps(value) -> bytes:
+    return bytes(json.dumps(value), encoding="utf8")
+
+
+def previous_loads(body: bytes):
+    return json.loads(body.decode("utf8"))
+
+
+def bench(name: str, function, value, number: int) -> float:
+    seconds = min(timeit.repeat(lambda: function(value), number=number, repeat=5))
+    print(f"{name:<32} {seconds / number * 1e6:10.2f} µs/call")
+    return seconds
+
+
+def main():
+    codecs = [STDLIB_JSON_CODEC]
+    try:
+        codecs.append(get_json_codec("orjson"))
+    except ImportError:
+        print("orjson is not installed, only comparing the standard library.\n")
+
+    for label, value, number in [("typical", TYPICAL, 50_000), ("large", LARGE, 20)]:
+        body = previous_dumps(value)
+        baseline = bench(f"previous dumps ({label})", previous_dumps, value, number)
+        for codec in codecs:
+            seconds = bench(f"{codec.name} dumps ({label})", codec.dumps, value, number)
+            print(f"{'speedup':<32} {baseline / seconds:10.2f}x")
+
+        baseline = bench(f"previous loads ({label})", previous_loads, body, number)
+        for codec in codecs:
+            seconds = bench(f"{codec.name} loads ({label})", codec.loads, body, number)
+            print(f"{'speedup':<32} {baseline / seconds:10.2f}x")
+        print()
+
+
+if __name__ == "__main__":
+    main()
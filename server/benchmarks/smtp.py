@@ -0,0 +1,84 @@
+"""Compares serialising the two emails of a registration with
+`SMTP.send_message` against `joshinkan.smtp.prepare_message`. The SMTP
+session is replaced by a stub which only dot-stuffs the data like
+`SMTP.data`, so only the CPU time to serialise the messages is measured. Run
+from the server directory with `python -m benchmarks.smtp`."""
+import smtplib
+import timeit
+
+from joshinkan.smtp import prepare_message
+from joshinkan.templating import Templates
+
+SENDER = "Joshinkan Werder Karate <info@joshinkan.de>"
+HEADERS = {"From": SENDER, "Cc": "trainer@joshinkan.de, vorstand@joshinkan.de"}
+RECIPIENTS = ["info@joshinkan.de", "trainer@joshinkan.de", "vorstand@joshinkan.de"]
+
+
+class StubSMTP(smtplib.SMTP):
+    def __init__(self):
+        super().__init__()
+        self.does_esmtp = True
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        smtplib._quote_periods(msg)
+        return {}
+
+
+TEMPLATES = Templates()
+
+
+def make_messages():
+    message = TEMPLATES.mail("registration_adult").message(
+        {**HEADERS, "To": SENDER},
+        first_name="Jürgen",
+        last_name="Müller",
+        age="42",
+        email="juergen@example.com",
+        phone="0331 123456",
+    )
+    ack_message = TEMPLATES.mail("acknowledgement_adult").message(
+        {**HEADERS, "Reply-To": SENDER},
+        first_name="Jürgen",
+        domain="https://joshinkan.de",
+    )
+    ack_message["To"] = "Jürgen Müller <juergen@example.com>"
+    return [message, ack_message]
+
+
+def previous(smtp: StubSMTP, messages):
+    for message in messages:
+        smtp.send_message(message, to_addrs=RECIPIENTS)
+
+
+def prepared(smtp: StubSMTP, messages):
+    for message in messages:
+        message = prepare_message(message)
+        smtp.sendmail(message.sender, RECIPIENTS, message.data)
+
+
+def bench(name: str, send, number: int = 5_000) -> float:
+    smtp = StubSMTP()
+    seconds = float("inf")
+    for _ in range(5):
+        # NOTE: Every registration renders new messages, so only the headers
+        # the templates share are cached, as in the app.
+        registrations = iter([make_messages() for _ in range(number)])
+        seconds = min(
+            seconds,
+            timeit.timeit(lambda: send(smtp, next(registrations)), number=number),
+        )
+    print(f"{name:<28} {seconds / number * 1e6:8.2f} µs/registration")
+    return seconds
+
+
+def main():
+    baseline = bench("send_message", previous)
+    seconds = bench("prepare_message + sendmail", prepared)
+    print(f"{'speedup':<28} {baseline / seconds:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
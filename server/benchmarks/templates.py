@@ -0,0 +1,141 @@
+"""Compares building the two emails of a children registration with the
+previous f-strings and `EmailMessage.set_content` against the compiled
+templates of `joshinkan.templating`. Run from the server directory with
+`python -m benchmarks.templates`."""
+import textwrap
+import timeit
+from email.message import EmailMessage
+
+from joshinkan.templating import Markup, Templates
+
+SENDER = "Joshinkan Werder Karate <info@joshinkan.de>"
+CC = ["trainer@joshinkan.de", "vorstand@joshinkan.de"]
+DOMAIN = "https://joshinkan.de"
+
+FORM_DATA = {
+    "first_name": "Dad",
+    "last_name": "Fam",
+    "email": "fam@mail.com",
+    "phone": "049127495",
+    "child_first_name": ["Boi", "Girl"],
+    "child_last_name": ["Fam", "Fam"],
+    "child_age": ["17", "16"],
+}
+
+
+def join_names(names: list[str]) -> str:
+    if len(names) == 1:
+        return names[0]
+    return ", ".join(names[:-1]) + " und " + names[-1]
+
+
+def previous(form_data: dict) -> tuple[EmailMessage, EmailMessage]:
+    first_name = form_data["first_name"]
+    last_name = form_data["last_name"]
+
+    def make_block(index: int) -> str:
+        return f"""
+        <b>Kind #{index+1}</b><br/>
+        Name: {form_data["child_first_name"][index]} {form_data["child_last_name"][index]}<br/>
+        Alter: {form_data["child_age"][index]}<br/>
+        """
+
+    num_children = len(form_data["child_first_name"])
+    blocks = "\n<br/>".join(make_block(i) for i in range(num_children))
+
+    message = EmailMessage()
+    message.set_content(
+        f"""
+        Neuanmeldung zum Probetraining für <b>Kinder</b>.<br/>
+        <br/>
+        {blocks}
+        <br/>
+        <b>Elternteil</b><br/>
+        Name: {first_name} {last_name}<br/>
+        Email: {form_data["email"]}<br/>
+        Telefon: {form_data["phone"]}<br/>
+        """,
+        subtype="html",
+    )
+    message["Subject"] = f"Anmeldung zum Probetraining: Kinder ({num_children})"
+    message["From"] = SENDER
+    message["To"] = SENDER
+    message["Cc"] = CC
+
+    ack_message = EmailMessage()
+    ack_message.set_content(
+        textwrap.dedent(
+            f"""\
+            Liebe Familie {last_name},<br/>
+            <br/>
+            Vielen Dank für die Anmeldung von {join_names(form_data["child_first_name"])} zum Probetraining.<br/>
+            <br/>
+            Einer unserer Trainer wird sich in Kürze bei euch melden und die Anmeldung mit einem Termin zum ersten Training bestätigen. Falls ihr in der Zwischenzeit weitere Fragen habt, findet ihr Infos <a href="{DOMAIN}/kontakt">hier</a>.<br/>
+            <br/>
+            Liebe Grüße,<br/>
+            Das Joshinkan Team<br/>
+            """
+        ),
+        subtype="html",
+    )
+    ack_message["From"] = SENDER
+    ack_message["To"] = f"{first_name} {last_name} <{form_data['email']}>"
+    ack_message["Cc"] = CC
+    ack_message["Reply-To"] = SENDER
+    ack_message["Subject"] = "Joshinkan Werder Karate - Anmeldung zum Probetraining"
+    return message, ack_message
+
+
+TEMPLATES = Templates()
+
+
+def templated(form_data: dict) -> tuple[EmailMessage, EmailMessage]:
+    headers = {"From": SENDER, "Cc": ", ".join(CC)}
+    child = TEMPLATES.partial("child")
+    names = form_data["child_first_name"]
+    children = Markup(
+        "<br/>\n".join(
+            child.render(
+                number=index + 1,
+                first_name=name,
+                last_name=form_data["child_last_name"][index],
+                age=form_data["child_age"][index],
+            )
+            for index, name in enumerate(names)
+        )
+    )
+    message = TEMPLATES.mail("registration_children").message(
+        {**headers, "To": SENDER},
+        num_children=len(names),
+        children=children,
+        first_name=form_data["first_name"],
+        last_name=form_data["last_name"],
+        email=form_data["email"],
+        phone=form_data["phone"],
+    )
+    ack_message = TEMPLATES.mail("acknowledgement_children").message(
+        {**headers, "Reply-To": SENDER},
+        last_name=form_data["last_name"],
+        children_names=join_names(names),
+        domain=DOMAIN,
+    )
+    ack_message[
+        "To"
+    ] = f"{form_data['first_name']} {form_data['last_name']} <{form_data['email']}>"
+    return message, ack_message
+
+
+def bench(name: str, build, number: int = 2_000) -> float:
+    seconds = min(timeit.repeat(lambda: build(FORM_DATA), number=number, repeat=5))
+    print(f"{name:<28} {seconds / number * 1e6:8.2f} µs/registration")
+    return seconds
+
+
+def main():
+    baseline = bench("f-strings + set_content", previous)
+    seconds = bench("compiled templates", templated)
+    print(f"{'speedup':<28} {baseline / seconds:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
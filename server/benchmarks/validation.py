@@ -0,0 +1,54 @@
+"""Compares `Schema.validate` with the compiled validator on registration
+forms. Run from the server directory with `python -m benchmarks.validation`."""
+import timeit
+
+from joshinkan.validation import ListOf, Schema, Values
+
+SCHEMA = Schema(
+    {
+        "first_name": str,
+        "last_name": str,
+        "email": str,
+        "phone": str,
+        "privacy": Values("on"),
+        "age": str,
+        "child_first_name": ListOf(str),
+        "child_last_name": ListOf(str),
+        "child_age": ListOf(str),
+        "parents_consent": Values("on"),
+    }
+)
+
+VALID = {
+    "first_name": "Dad",
+    "last_name": "Fam",
+    "email": "fam@mail.com",
+    "phone": "049127495",
+    "privacy": "on",
+    "age": "",
+    "child_first_name": ["Boi", "Girl"],
+    "child_last_name": ["Fam", "Fam"],
+    "child_age": ["17", "16"],
+    "parents_consent": "on",
+}
+
+INVALID = {**VALID, "privacy": "off"}
+
+
+def bench(name: str, validate, value, number: int = 100_000) -> float:
+    seconds = min(timeit.repeat(lambda: validate(value), number=number, repeat=5))
+    print(f"{name:<22} {seconds / number * 1e6:8.2f} µs/call")
+    return seconds
+
+
+def main():
+    compiled = SCHEMA.compile()
+    for label, value in [("valid", VALID), ("invalid", INVALID)]:
+        assert compiled.validate(value)[0] == SCHEMA.validate(value)[0]
+        interpreted = bench(f"validate ({label})", SCHEMA.validate, value)
+        fast = bench(f"compiled ({label})", compiled.validate, value)
+        print(f"{'speedup':<22} {interpreted / fast:8.2f}x\n")
+
+
+if __name__ == "__main__":
+    main()
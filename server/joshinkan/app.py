@@ -1,29 +1,119 @@
 from wsgiref.simple_server import make_server
 
 
-def build_app():
+def build_router():
     from inspect import getmembers, ismodule
     from .logger import setup_logging, get_logger
-    from .config import Config
+    from .config import get_config, install_reload_handler
 
-    config = Config()
-    setup_logging(config.LOGLEVEL)
+    config = get_config()
+    setup_logging(config.LOGLEVEL, config.LOG_FORMAT)
     logger = get_logger(__name__)
     logger.info(f"Config: {config}")
 
-    from .httpd import make_app
     from .routes import router, AppContext
 
     context = AppContext.from_config(config)
+    context.restore()
     router.set_context(context)
     router.set_config(config)
-    app = make_app(router)
-    return app
+
+    def on_reload(config, error):
+        if error is not None:
+            logger.error(f"Keeping the current config. {error}")
+            return
+        # NOTE: Routes read the config per request. Settings which the app
+        # is built from, i.e. the log level or MAIL_QUEUE, need a restart.
+        router.set_config(config)
+        context.reconfigure(config)
+        logger.info(f"Reloaded config: {config}")
+
+    from .instrumentation import (
+        add_metrics_route,
+        instrumentation,
+        mail_queue_collector,
+    )
+    from .mailqueue import MailQueue
+    from .metrics import REGISTRY, SnapshotStore
+
+    # NOTE: Registered first, so the latency includes the other middleware.
+    store = SnapshotStore(config.METRICS_DIR) if config.METRICS_DIR else None
+    router.use(instrumentation(REGISTRY, store))
+    add_metrics_route(router, REGISTRY, store)
+    if isinstance(context.mailer, MailQueue):
+        REGISTRY.add_collector(mail_queue_collector(context.mailer))
+
+    from .httpd import Middleware
+
+    reload_if_requested = install_reload_handler(on_reload)
+    if reload_if_requested is None:
+        logger.warning("Cannot reload the config on SIGHUP outside of the main thread")
+    else:
+        router.use(Middleware(before=lambda environ: reload_if_requested()))
+
+    from .profiler import Profiler, install_signal_handler, profiling
+
+    if config.PROFILE_DIR:
+        profiler = Profiler(config.PROFILE_DIR, sample_rate=config.PROFILE_SAMPLE_RATE)
+        if config.PROFILE_SAMPLE_RATE > 0:
+            router.use(profiling(profiler))
+        if not install_signal_handler(profiler, config.PROFILE_SECONDS):
+            logger.warning("Cannot profile on SIGUSR2 outside of the main thread")
+
+    from . import tracing
+
+    if config.TRACE_EXPORTER == "stdout":
+        tracing.configure(tracing.SpanExporter())
+    elif config.TRACE_EXPORTER == "file":
+        tracing.configure(tracing.FileSpanExporter(config.TRACE_DIR))
+
+    from .compression import compression
+
+    if config.COMPRESSION_LEVEL > 0:
+        router.use(
+            compression(
+                min_size=config.COMPRESSION_MIN_SIZE, level=config.COMPRESSION_LEVEL
+            )
+        )
+    return router
+
+
+def build_app():
+    router = build_router()
+    from .httpd import make_app
+
+    return make_app(router)
+
+
+def build_asgi_app():
+    router = build_router()
+    from .httpd import make_asgi_app
+
+    return make_asgi_app(router)
+
+
+def serve_asgi(host: str, port: int) -> None:
+    app = build_asgi_app()
+
+    from .asgi import serve
+
+    serve(app, host=host, port=port)
+
+
+ACCESS_LOG_FORMAT = (
+    '\'%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"'
+    " %({x-request-id}o)s'"
+)
+"""gunicorn's default access log format plus the X-Request-ID response
+header, quoted for the shell."""
 
 
 def serve_gunicorn() -> None:
     import argparse
+    import os
+    from pathlib import Path
     from inspect import cleandoc
+    from .config import get_config
     from .scale import shell
 
     parser = argparse.ArgumentParser(description="Joshinkan server")
@@ -51,13 +141,49 @@ def serve_gunicorn() -> None:
         "--log-dir",
         help="Store gunicorn access and error logs in this directory. Default: Log to stdout",
     )
+    parser.add_argument(
+        "--asgi",
+        action="store_true",
+        help=cleandoc(
+            """Serve the ASGI app with the built-in asyncio server in a single
+            process instead of gunicorn. Default: False"""
+        ),
+    )
+
+    parser.add_argument(
+        "--profile-rate",
+        type=float,
+        help=cleandoc(
+            """Profile this fraction of requests, i.e. 0.01, and write
+            collapsed stacks per worker to PROFILE_DIR or else --log-dir.
+            Default: Only profile after SIGUSR2 when PROFILE_DIR is set"""
+        ),
+    )
 
     args = parser.parse_args()
 
+    if args.profile_rate is not None:
+        if not args.log_dir and not os.environ.get("PROFILE_DIR"):
+            parser.error("--profile-rate requires --log-dir or PROFILE_DIR")
+        # NOTE: The workers inherit the environment from gunicorn.
+        os.environ["PROFILE_SAMPLE_RATE"] = str(args.profile_rate)
+        os.environ.setdefault("PROFILE_DIR", args.log_dir)
+
+    if args.asgi:
+        serve_asgi(args.host, args.port)
+        return
+
     if args.debug:
         args.reload = True
         args.workers = 1
 
+    config = get_config()
+    if config.METRICS_DIR:
+        # NOTE: Counters of workers which exited are kept in their snapshots,
+        # so only a restart of the whole server resets them.
+        for path in Path(config.METRICS_DIR).glob("metrics-*.json"):
+            path.unlink(missing_ok=True)
+
     shell.trace()
     shell.exit_on_error()
     shell(
@@ -74,6 +200,8 @@ def serve_gunicorn() -> None:
             "--error-logfile": f"{args.log_dir}/gunicorn-error.log"
             if args.log_dir
             else "-",
+            # NOTE: Ties access log lines to the app's logs and traces.
+            "--access-logformat": ACCESS_LOG_FORMAT,
             "'joshinkan.app:build_app()'": "",
         },
     )
@@ -0,0 +1,277 @@
+"""A small HTTP/1.1 server for ASGI apps on top of asyncio streams. It only
+depends on the standard library and supports what the backend needs:
+keep-alive, request bodies with a Content-Length and chunked responses."""
+import asyncio
+from http import HTTPStatus
+from typing import Optional
+from urllib.parse import unquote
+
+from .logger import get_logger
+
+logger = get_logger(__name__)
+
+MAX_HEADER_COUNT = 100
+MAX_LINE_SIZE = 8 * 1024
+KEEP_ALIVE_TIMEOUT = 5.0
+"""Seconds an idle connection is kept open for the next request."""
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class BadRequest(Exception):
+    pass
+
+
+def simple_response(status: HTTPStatus, close: bool = True) -> bytes:
+    body = f"{status.value} {status.phrase}".encode("latin-1")
+    return (
+        f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        + ("Connection: close\r\n" if close else "")
+        + "\r\n"
+    ).encode("latin-1") + body
+
+
+async def read_head(
+    reader: asyncio.StreamReader,
+) -> Optional[tuple[str, str, str, list]]:
+    """Read the request line and headers. Returns None if the client closed
+    the connection before sending a request."""
+    try:
+        line = await reader.readuntil(b"\r\n")
+    except asyncio.IncompleteReadError as error:
+        if error.partial.strip() == b"":
+            return None
+        raise BadRequest("Incomplete request line")
+    except asyncio.LimitOverrunError:
+        raise BadRequest("Request line too long")
+
+    try:
+        method, target, version = line.decode("latin-1").strip().split(" ")
+    except ValueError:
+        raise BadRequest("Malformed request line")
+    if not version.startswith("HTTP/1."):
+        raise BadRequest(f"Unsupported protocol {version}")
+
+    headers = []
+    while True:
+        try:
+            line = await reader.readuntil(b"\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            raise BadRequest("Malformed headers")
+        if line == b"\r\n":
+            break
+        if len(headers) >= MAX_HEADER_COUNT:
+            raise BadRequest("Too many headers")
+        name, separator, value = line.partition(b":")
+        if not separator or not name or name != name.strip():
+            raise BadRequest("Malformed header")
+        headers.append((name.lower(), value.strip()))
+
+    return method, target, version, headers
+
+
+class Connection:
+    """Serves the requests of one client connection, one after the other."""
+
+    def __init__(
+        self,
+        app,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ):
+        self.app = app
+        self.reader = reader
+        self.writer = writer
+        self.server = writer.get_extra_info("sockname")[:2]
+        self.client = writer.get_extra_info("peername")[:2]
+
+    async def serve(self):
+        try:
+            while await self.serve_request():
+                pass
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        except BadRequest as error:
+            logger.debug(f"Bad request from {self.client}: {error}")
+            self.writer.write(simple_response(HTTPStatus.BAD_REQUEST))
+        finally:
+            try:
+                await self.writer.drain()
+                self.writer.close()
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def serve_request(self) -> bool:
+        """Serve one request. Returns whether the connection can be reused."""
+        head = await asyncio.wait_for(read_head(self.reader), KEEP_ALIVE_TIMEOUT)
+        if head is None:
+            return False
+        method, target, version, headers = head
+
+        header_values = dict(headers)
+        if header_values.get(b"transfer-encoding", b"identity") != b"identity":
+            self.writer.write(simple_response(HTTPStatus.LENGTH_REQUIRED))
+            return False
+        try:
+            remaining = int(header_values.get(b"content-length", b"0"))
+        except ValueError:
+            raise BadRequest("Malformed Content-Length")
+
+        connection = header_values.get(b"connection", b"").lower()
+        keep_alive = (
+            connection != b"close"
+            if version == "HTTP/1.1"
+            else connection == b"keep-alive"
+        )
+
+        path, _, query = target.partition("?")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0", "spec_version": "2.3"},
+            "http_version": version[len("HTTP/") :],
+            "method": method.upper(),
+            "scheme": "http",
+            "path": unquote(path),
+            "raw_path": path.encode("latin-1"),
+            "query_string": query.encode("latin-1"),
+            "root_path": "",
+            "headers": headers,
+            "server": self.server,
+            "client": self.client,
+        }
+
+        async def receive() -> dict:
+            nonlocal remaining
+            if remaining <= 0:
+                return {"type": "http.request", "body": b"", "more_body": False}
+            try:
+                chunk = await self.reader.read(min(remaining, READ_CHUNK_SIZE))
+            except ConnectionError:
+                chunk = b""
+            if not chunk:
+                return {"type": "http.disconnect"}
+            remaining -= len(chunk)
+            return {"type": "http.request", "body": chunk, "more_body": remaining > 0}
+
+        response_started = False
+        chunked = False
+        bodiless = method.upper() == "HEAD"
+
+        async def send(message: dict):
+            nonlocal response_started, chunked, keep_alive, bodiless
+            if message["type"] == "http.response.start":
+                status = HTTPStatus(message["status"])
+                # NOTE: These responses never have a body, see RFC 9112
+                # section 6.3.
+                bodiless = bodiless or status in (
+                    HTTPStatus.NO_CONTENT,
+                    HTTPStatus.NOT_MODIFIED,
+                )
+                response_headers = list(message.get("headers", []))
+                names = {name.lower() for name, _ in response_headers}
+                for name, value in response_headers:
+                    if name.lower() == b"connection" and value.lower() == b"close":
+                        keep_alive = False
+                if b"content-length" not in names and not bodiless:
+                    if version == "HTTP/1.1":
+                        chunked = True
+                        response_headers.append((b"transfer-encoding", b"chunked"))
+                    else:
+                        # NOTE: HTTP/1.0 clients read the body until the
+                        # connection closes.
+                        keep_alive = False
+                if not keep_alive and b"connection" not in names:
+                    response_headers.append((b"connection", b"close"))
+
+                head = [f"HTTP/1.1 {status.value} {status.phrase}".encode("latin-1")]
+                head.extend(name + b": " + value for name, value in response_headers)
+                self.writer.write(b"\r\n".join(head) + b"\r\n\r\n")
+                response_started = True
+            elif message["type"] == "http.response.body":
+                body = message.get("body", b"")
+                more_body = message.get("more_body", False)
+                if bodiless:
+                    pass
+                elif chunked:
+                    if body:
+                        self.writer.write(b"%x\r\n%s\r\n" % (len(body), body))
+                    if not more_body:
+                        self.writer.write(b"0\r\n\r\n")
+                else:
+                    self.writer.write(body)
+                await self.writer.drain()
+
+        try:
+            await self.app(scope, receive, send)
+        except Exception:
+            logger.exception(f"Unhandled error in {method} {path}")
+            if response_started:
+                return False
+            self.writer.write(simple_response(HTTPStatus.INTERNAL_SERVER_ERROR))
+            return False
+
+        await self.writer.drain()
+        # NOTE: A body the app did not read would be parsed as the next request.
+        return keep_alive and remaining <= 0
+
+
+class Lifespan:
+    """Runs the app's lifespan protocol next to the server. Apps which do not
+    support lifespan events may raise, which is ignored."""
+
+    def __init__(self, app):
+        self.app = app
+        self.messages: asyncio.Queue = asyncio.Queue()
+        self.events: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+
+    async def run(self):
+        try:
+            await self.app(
+                {"type": "lifespan", "asgi": {"version": "3.0"}},
+                self.messages.get,
+                self.events.put,
+            )
+        except Exception as error:
+            logger.debug(f"The app does not support lifespan events: {error!r}")
+        finally:
+            await self.events.put(None)
+
+    async def startup(self):
+        self.task = asyncio.create_task(self.run())
+        await self.messages.put({"type": "lifespan.startup"})
+        await self.events.get()
+
+    async def shutdown(self):
+        if self.task is None or self.task.done():
+            return
+        await self.messages.put({"type": "lifespan.shutdown"})
+        await self.task
+
+
+async def start_server(app, host: str, port: int) -> asyncio.AbstractServer:
+    async def on_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        await Connection(app, reader, writer).serve()
+
+    return await asyncio.start_server(on_connect, host, port, limit=MAX_LINE_SIZE)
+
+
+async def serve_forever(app, host: str, port: int):
+    lifespan = Lifespan(app)
+    await lifespan.startup()
+    server = await start_server(app, host, port)
+    logger.info(f"Listening on http://{host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await lifespan.shutdown()
+
+
+def serve(app, host: str = "0.0.0.0", port: int = 5000):
+    try:
+        asyncio.run(serve_forever(app, host, port))
+    except KeyboardInterrupt:
+        pass
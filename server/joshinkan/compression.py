@@ -0,0 +1,203 @@
+import zlib
+from typing import Iterable, Iterator, Optional, Union
+
+from .httpd import HTTPResponse, Middleware, StreamingResponse, WSGIEnv
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_MIN_SIZE = 1024
+"""Bodies smaller than this many bytes are sent uncompressed. They fit into a
+few packets anyway and compressing them costs more than it saves."""
+
+DEFAULT_LEVEL = 6
+
+COMPRESSED_CONTENT_TYPES = (
+    "image/",
+    "video/",
+    "audio/",
+    "font/woff",
+    "application/zip",
+    "application/gzip",
+    "application/x-gzip",
+    "application/x-bzip2",
+    "application/x-7z-compressed",
+    "application/pdf",
+)
+"""Content types which are compressed already. `image/svg+xml` is text and is
+compressed nevertheless."""
+
+BODILESS_STATUSES = (204, 304)
+
+
+def supported_encodings() -> list[str]:
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick the supported content coding with the highest q-value from an
+    Accept-Encoding header. Brotli wins ties as it compresses better."""
+    preferences = {}
+    for entry in accept_encoding.split(","):
+        coding, _, parameters = entry.strip().partition(";")
+        coding = coding.strip().lower()
+        quality = 1.0
+        parameter, _, value = parameters.strip().partition("=")
+        if parameter.strip() == "q":
+            try:
+                quality = float(value)
+            except ValueError:
+                continue
+        if coding:
+            preferences[coding] = quality
+
+    best, best_quality = None, 0.0
+    for coding in supported_encodings():
+        quality = preferences.get(coding, preferences.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+class Compressor:
+    """A streaming compressor for one response body."""
+
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        if encoding == "br":
+            # NOTE: Brotli qualities range from 0 to 11, gzip levels from 1
+            # to 9. Higher brotli qualities are too slow to run per request.
+            self._brotli = brotli.Compressor(quality=min(level, 11))
+        else:
+            self._zlib = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk: bytes) -> bytes:
+        """Compress a chunk and flush it, so it reaches the client right away,
+        i.e. for server-sent events."""
+        if self.encoding == "br":
+            return self._brotli.process(chunk) + self._brotli.flush()
+        return self._zlib.compress(chunk) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._brotli.finish()
+        return self._zlib.flush(zlib.Z_FINISH)
+
+
+def compress(body: bytes, encoding: str, level: int) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=min(level, 11))
+    return zlib.compress(body, level, wbits=16 + zlib.MAX_WBITS)
+
+
+class CompressedStream(StreamingResponse):
+    """Compresses the chunks of a streaming response as they are produced."""
+
+    def __init__(self, stream: Iterable[bytes], encoding: str, level: int):
+        super().__init__(stream)
+        self.stream = stream
+        self.encoding = encoding
+        self.level = level
+
+    def __iter__(self) -> Iterator[bytes]:
+        compressor = Compressor(self.encoding, self.level)
+        for chunk in self.stream:
+            if chunk:
+                yield compressor.compress(chunk)
+        yield compressor.finish()
+
+    async def __aiter__(self):
+        compressor = Compressor(self.encoding, self.level)
+        async for chunk in self.stream:
+            if chunk:
+                yield compressor.compress(chunk)
+        yield compressor.finish()
+
+    def close(self):
+        if hasattr(self.stream, "close"):
+            self.stream.close()
+
+
+def is_compressible(headers: dict[str, str]) -> bool:
+    if "content-encoding" in headers:
+        return False
+    content_type = headers.get("content-type", "").lower()
+    if content_type.startswith("image/svg+xml"):
+        return True
+    return not content_type.startswith(COMPRESSED_CONTENT_TYPES)
+
+
+def add_vary(headers: dict[str, str]):
+    vary = headers.get("vary")
+    if vary is None:
+        headers["vary"] = "Accept-Encoding"
+    elif "accept-encoding" not in vary.lower():
+        headers["vary"] = f"{vary}, Accept-Encoding"
+
+
+def compress_response(
+    environ: WSGIEnv,
+    status: int,
+    headers: list[tuple[str, str]],
+    chunks: Union[list[bytes], Iterable[bytes]],
+    min_size: int = DEFAULT_MIN_SIZE,
+    level: int = DEFAULT_LEVEL,
+) -> tuple[list[tuple[str, str]], Union[list[bytes], Iterable[bytes]]]:
+    """Compress a response body according to the request's Accept-Encoding.
+    Buffered bodies (lists of chunks) are compressed at once and keep a
+    Content-Length. Anything else is compressed chunk by chunk. Returns the
+    new headers and chunks."""
+    header_values = {key.lower(): value for key, value in headers}
+    if (
+        status in BODILESS_STATUSES
+        or environ.get("REQUEST_METHOD") == "HEAD"
+        or not is_compressible(header_values)
+    ):
+        return headers, chunks
+
+    add_vary(header_values)
+    encoding = negotiate_encoding(environ.get("HTTP_ACCEPT_ENCODING", ""))
+    content_length = header_values.get("content-length")
+    if (
+        encoding is None
+        or content_length is not None
+        and int(content_length) < min_size
+    ):
+        return list(header_values.items()), chunks
+
+    if isinstance(chunks, list):
+        body = b"".join(chunks)
+        if len(body) < min_size:
+            return list(header_values.items()), chunks
+        chunks = [compress(body, encoding, level)]
+        header_values["content-length"] = str(len(chunks[0]))
+    else:
+        chunks = CompressedStream(chunks, encoding, level)
+        header_values.pop("content-length", None)
+
+    header_values["content-encoding"] = encoding
+    # NOTE: The compressed body is a different representation, so a strong
+    # ETag must not be shared with the uncompressed one. If-None-Match uses
+    # the weak comparison, so the weak ETag still validates either.
+    etag = header_values.get("etag")
+    if etag is not None and not etag.startswith("W/"):
+        header_values["etag"] = "W/" + etag
+    return list(header_values.items()), chunks
+
+
+def compression(
+    min_size: int = DEFAULT_MIN_SIZE, level: int = DEFAULT_LEVEL
+) -> Middleware:
+    """A middleware which compresses responses with gzip, or brotli when the
+    `brotli` package is installed."""
+
+    def compress_after(environ: WSGIEnv, response: HTTPResponse) -> HTTPResponse:
+        status, headers, chunks = response
+        headers, chunks = compress_response(
+            environ, status, headers, chunks, min_size=min_size, level=level
+        )
+        return status, headers, chunks
+
+    return Middleware(after=compress_after)
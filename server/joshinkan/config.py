@@ -1,51 +1,351 @@
-from dataclasses import dataclass, field
+"""The app's settings, parsed and validated once from the environment and
+the env file in CONFIG_FILE.
+
+`get_config` returns an immutable snapshot which is cached per process.
+`reload_config` parses a new snapshot, i.e. after the SMTP credentials were
+rotated, and swaps it in at once, so a request never sees half of a reload."""
+from dataclasses import dataclass, field, fields, replace
 from .smtp import EmailUser
+import importlib.util
 import os
-from typing import Optional
+import signal
+import threading
+from typing import Any, Callable, Mapping, Optional
 
 
-@dataclass
-class Config:
-    LOGLEVEL: str = field(
-        default_factory=lambda: os.environ.get("LOGLEVEL", "DEBUG").strip()
+class ConfigError(ValueError):
+    def __init__(self, errors: list[str]):
+        super().__init__("Invalid configuration:\n  " + "\n  ".join(errors))
+        self.errors = errors
+
+
+def one_of(*choices: str) -> Callable[[Any], Optional[str]]:
+    def check(value) -> Optional[str]:
+        if value not in choices:
+            return f"expected one of {', '.join(choices)}"
+
+    return check
+
+
+def at_least(minimum: float) -> Callable[[Any], Optional[str]]:
+    def check(value) -> Optional[str]:
+        if value < minimum:
+            return f"expected at least {minimum}"
+
+    return check
+
+
+def between(minimum: float, maximum: float) -> Callable[[Any], Optional[str]]:
+    def check(value) -> Optional[str]:
+        if not minimum <= value <= maximum:
+            return f"expected {minimum} to {maximum}"
+
+    return check
+
+
+def installed_for(choice: str, module: str) -> Callable[[Any], Optional[str]]:
+    def check(value) -> Optional[str]:
+        if value == choice and importlib.util.find_spec(module) is None:
+            return f"the {module} package is not installed"
+
+    return check
+
+
+def setting(default, *checks, required: bool = False, secret: bool = False):
+    return field(
+        default=default,
+        repr=not secret,
+        metadata={"checks": checks, "required": required, "secret": secret},
     )
-    """Global loglevel filter used for the logger module"""
 
-    PRINT_STACKTRACE: bool = field(
-        default_factory=lambda: len(os.environ.get("PRINT_STACKTRACE", "").strip()) > 0
+
+def parse_bool(value: str) -> bool:
+    return value.strip().lower() not in ("", "0", "false", "no", "off")
+
+
+def parse_optional_str(value: str) -> Optional[str]:
+    return value.strip() or None
+
+
+def parse_email(value: str) -> Optional[EmailUser]:
+    value = value.strip()
+    return EmailUser.from_description(value) if value else None
+
+
+def parse_emails(value: str) -> tuple[EmailUser, ...]:
+    return tuple(
+        EmailUser.from_description(email.strip())
+        for email in value.split(",")
+        if email.strip()
     )
+
+
+# NOTE: Field type -> (parser of environment values, what the parser expects)
+PARSERS: dict[Any, tuple[Callable[[str], Any], str]] = {
+    str: (str.strip, "a string"),
+    int: (int, "an integer"),
+    float: (float, "a number"),
+    bool: (parse_bool, "a boolean"),
+    Optional[str]: (parse_optional_str, "a string"),
+    Optional[EmailUser]: (parse_email, "an email address like 'Name <a@b.de>'"),
+    tuple[EmailUser, ...]: (parse_emails, "comma separated email addresses"),
+}
+
+LOGLEVELS = ("CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG")
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Values may be given parsed or as strings, as in the environment. Every
+    value is validated when the config is created."""
+
+    LOGLEVEL: str = setting("INFO", one_of(*LOGLEVELS))
+    """Global loglevel filter used for the logger module"""
+
+    LOG_FORMAT: str = setting("text", one_of("text", "json"))
+    """Log records as text or as JSON lines."""
+
+    PRINT_STACKTRACE: bool = setting(False)
     """Return a full stacktrace when a route raises an error for debugging purposes."""
 
-    SMTP_HOST: str = field(
-        default_factory=lambda: os.environ.get("SMTP_HOST", "smtp.gmail.com").strip()
-    )
-    SMTP_PORT: int = field(
-        default_factory=lambda: int(os.environ.get("SMTP_PORT", 587))
+    MAX_BODY_SIZE: int = setting(1024 * 1024, at_least(0))
+    """Default maximum request body size in bytes. Routes can set their own
+    limit. Larger requests are rejected with 413."""
+
+    BODY_READ_TIMEOUT: float = setting(10.0)
+    """Seconds a route may spend reading the request body before the request
+    is aborted with 408."""
+
+    COMPRESSION_LEVEL: int = setting(6, between(0, 11))
+    """gzip level (1-9) or brotli quality for compressed responses. 0 disables
+    compression."""
+
+    COMPRESSION_MIN_SIZE: int = setting(1024, at_least(0))
+    """Responses smaller than this many bytes are sent uncompressed."""
+
+    JSON_CODEC: str = setting(
+        "auto", one_of("auto", "orjson", "json"), installed_for("orjson", "orjson")
     )
-    SMTP_USER: EmailUser = field(
-        default_factory=lambda: EmailUser.from_description(
-            os.environ.get("SMTP_USER").strip()
+    """JSON library for request and response bodies: orjson, json or auto to
+    use orjson when it is installed."""
+
+    SMTP_HOST: str = setting("smtp.gmail.com")
+    SMTP_PORT: int = setting(587, between(1, 65535))
+    SMTP_USER: Optional[EmailUser] = setting(None, required=True)
+    SMTP_PASSWORD: Optional[str] = setting(None, required=True, secret=True)
+    SMTP_REPLY_TO: Optional[EmailUser] = setting(None)
+    SMTP_CC: tuple[EmailUser, ...] = setting(())
+    SMTP_BCC: tuple[EmailUser, ...] = setting(())
+    SMTP_POOL_SIZE: int = setting(2, at_least(0))
+    """Maximum number of idle SMTP sessions kept open per worker."""
+
+    SMTP_POOL_IDLE_TIMEOUT: float = setting(60.0, at_least(0))
+    """Seconds after which an idle pooled SMTP session is closed."""
+
+    MAIL_QUEUE: bool = setting(True)
+    """Deliver emails in a background worker instead of in the request. Set
+    to 0 to send emails synchronously."""
+
+    MAIL_QUEUE_MAX_ATTEMPTS: int = setting(20, at_least(1))
+    """Number of delivery attempts before a queued email is given up on. With
+    the default backoff, which is capped at 5 minutes, 20 attempts span about
+    an hour, i.e. an outage of the SMTP relay."""
+
+    MAIL_QUEUE_BACKOFF: float = setting(1.0, at_least(0))
+    """Seconds to wait before the first retry. Doubles with every attempt."""
+
+    MAIL_SPOOL_DIR: Optional[str] = setting(None)
+    """Persist queued emails in this directory until they are delivered, so
+    they survive worker restarts. Requires MAIL_QUEUE."""
+
+    RATE_LIMIT_BURST: int = setting(5, at_least(0))
+    """Registrations a client (by its address) or an email address may send at
+    once before it is throttled with 429. 0 disables rate limiting."""
+
+    RATE_LIMIT_PER_HOUR: float = setting(10.0, at_least(0.001))
+    """Registrations per hour a client or an email address may send on
+    average."""
+
+    RATE_LIMIT_DIR: Optional[str] = setting(None)
+    """Share the rate limits between the gunicorn workers through a table in
+    this directory. Without it, every worker limits on its own."""
+
+    IDEMPOTENCY_TTL: float = setting(300.0, at_least(0))
+    """Seconds during which a repeated registration, i.e. after a double
+    click, gets the first response again instead of sending the emails again.
+    0 disables the check."""
+
+    IDEMPOTENCY_DIR: Optional[str] = setting(None)
+    """Share the responses of recent registrations between the gunicorn
+    workers through files in this directory. Without it, every worker only
+    detects its own duplicates."""
+
+    METRICS_DIR: Optional[str] = setting(None)
+    """Share metrics between the gunicorn workers through files in this
+    directory, so `/metrics` reports all of them. Without it, every worker
+    only reports its own metrics."""
+
+    PROFILE_DIR: Optional[str] = setting(None)
+    """Enables the sampling profiler. Every worker writes its stack samples to
+    `profile-{pid}.folded` in this directory."""
+
+    PROFILE_SAMPLE_RATE: float = setting(0.0, between(0, 1))
+    """Fraction of requests to profile, i.e. 0.01 for 1%. Requires PROFILE_DIR."""
+
+    PROFILE_SECONDS: float = setting(30.0, at_least(0))
+    """Seconds to profile all requests of a worker after it receives SIGUSR2.
+    Requires PROFILE_DIR."""
+
+    TRACE_EXPORTER: str = setting("none", one_of("none", "stdout", "file"))
+    """Export request traces in the OTLP JSON format: none, stdout or file."""
+
+    TRACE_DIR: str = setting("traces")
+    """With TRACE_EXPORTER=file, every worker writes its traces to
+    `traces-{pid}.jsonl` in this directory."""
+
+    CONFIG_FILE: Optional[str] = setting(None)
+    """An env file (`KEY=value` lines) which `reload_config` reads on SIGHUP.
+    Its values take precedence over the environment."""
+
+    def __post_init__(self):
+        errors = []
+        for setting_field in fields(self):
+            name = setting_field.name
+            value = getattr(self, name)
+            if isinstance(value, str):
+                parse, expected = PARSERS[setting_field.type]
+                try:
+                    value = parse(value)
+                except (ValueError, EmailUser.ParsingError):
+                    shown = "***" if setting_field.metadata["secret"] else repr(value)
+                    errors.append(f"{name}: expected {expected}, got {shown}")
+                    continue
+            elif isinstance(value, list):
+                value = tuple(value)
+            # NOTE: The way to initialise the fields of a frozen dataclass.
+            object.__setattr__(self, name, value)
+
+            if value is None:
+                if setting_field.metadata["required"]:
+                    errors.append(f"{name}: is required")
+                continue
+            for check in setting_field.metadata["checks"]:
+                message = check(value)
+                if message is not None:
+                    errors.append(f"{name}: {message}, got {value!r}")
+        if errors:
+            raise ConfigError(errors)
+
+    @classmethod
+    def from_environ(cls, environ: Mapping[str, str] = os.environ) -> "Config":
+        """Parse the settings which are set in `environ`, the others keep
+        their defaults."""
+        return cls(
+            **{
+                setting_field.name: environ[setting_field.name]
+                for setting_field in fields(cls)
+                if setting_field.name in environ
+            }
         )
-    )
-    SMTP_PASSWORD: str = field(
-        default_factory=lambda: os.environ.get("SMTP_PASSWORD").strip()
-    )
-    SMTP_REPLY_TO: Optional[EmailUser] = field(
-        default_factory=lambda: None
-        if os.environ.get("SMTP_REPLY_TO") is None
-        else EmailUser.from_description(os.environ.get("SMTP_REPLY_TO").strip())
-    )
-    SMTP_CC: list[EmailUser] = field(
-        default_factory=lambda: [
-            EmailUser.from_description(email.strip())
-            for email in os.environ.get("SMTP_CC", "").split(",")
-            if email != ""
-        ]
-    )
-    SMTP_BCC: list[EmailUser] = field(
-        default_factory=lambda: [
-            EmailUser.from_description(email.strip())
-            for email in os.environ.get("SMTP_BCC", "").split(",")
-            if email != ""
-        ]
-    )
+
+    def replace(self, **changes) -> "Config":
+        """A copy with some settings changed, i.e. for tests."""
+        return replace(self, **changes)
+
+
+def read_env_file(path: str) -> dict[str, str]:
+    """Read `KEY=value` lines like `load-env.sh` does, skipping comments."""
+    values = {}
+    with open(path, encoding="utf8") as file:
+        for line in file:
+            key, separator, value = line.partition("=")
+            key, value = key.strip(), value.strip()
+            if not separator or not key or not value or key.startswith("#"):
+                continue
+            if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+                value = value[1:-1]
+            values[key] = value
+    return values
+
+
+def read_environ() -> dict[str, str]:
+    """The environment with the values of the CONFIG_FILE on top. Raises
+    `ConfigError` if the file cannot be read."""
+    environ = dict(os.environ)
+    config_file = environ.get("CONFIG_FILE", "").strip()
+    if config_file:
+        try:
+            environ.update(read_env_file(config_file))
+        except OSError as error:
+            raise ConfigError(
+                [f"CONFIG_FILE: cannot read {config_file!r}: {error.strerror}"]
+            ) from error
+    return environ
+
+
+_config: Optional[Config] = None
+_lock = threading.Lock()
+
+
+def get_config() -> Config:
+    """The config of this process, parsed from the environment and the
+    CONFIG_FILE on first use."""
+    global _config
+
+    config = _config
+    if config is None:
+        with _lock:
+            if _config is None:
+                _config = Config.from_environ(read_environ())
+            config = _config
+    return config
+
+
+def reload_config() -> Config:
+    """Parse the environment and the CONFIG_FILE again and make the result
+    the config of this process. Raises `ConfigError` and keeps the current
+    config if the new one is invalid or the file cannot be read."""
+    global _config
+
+    config = Config.from_environ(read_environ())
+    with _lock:
+        _config = config
+    return config
+
+
+def install_reload_handler(
+    on_reload: Callable[[Optional[Config], Optional[ConfigError]], None],
+    signum: int = signal.SIGHUP,
+) -> Optional[Callable[[], None]]:
+    """Reload the config after the process receives `signum`, i.e.
+    `kill -HUP <worker pid>`, and pass the new config or the error to
+    `on_reload`.
+
+    The signal handler only notes the signal, as it may interrupt code which
+    holds a lock the reload needs. The returned function does the reload if
+    one is due, call it where no locks are held, i.e. before each request.
+    Returns None if the handler cannot be installed because this is not the
+    main thread."""
+    requested = False
+
+    def on_signal(signum, frame):
+        nonlocal requested
+        requested = True
+
+    def reload_if_requested():
+        nonlocal requested
+        if not requested:
+            return
+        requested = False
+        try:
+            config = reload_config()
+        except ConfigError as error:
+            on_reload(None, error)
+        else:
+            on_reload(config, None)
+
+    try:
+        signal.signal(signum, on_signal)
+    except ValueError:
+        return None
+    return reload_if_requested
@@ -3,35 +3,82 @@ from contextlib import contextmanager
 from enum import Enum, auto, IntEnum
 import dataclasses
 from dataclasses import dataclass
-from typing import Callable, Optional, Dict, Union, Iterable, Iterator, Any, Protocol
-from functools import partialmethod, partial
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Optional,
+    Dict,
+    Union,
+    Iterable,
+    Iterator,
+    Any,
+    Protocol,
+    BinaryIO,
+)
+from functools import partialmethod, partial, wraps
+import asyncio
+import contextvars
+import datetime
+import email.utils
+import hashlib
+import inspect
 import traceback
 import json
-import sys
+import math
+import signal
+import threading
+import time
 from wsgiref.util import setup_testing_defaults, guess_scheme
 from io import BytesIO
 
 from .config import Config
-from .logger import get_logger
+from .logger import get_logger, log_context
+from .tracing import SPAN_KIND_SERVER, is_trace_id, new_trace_id, span
 from .validation import Schema, InvalidSchema
 import joshinkan.multipart as multipart
 
+try:
+    import gevent
+    from gevent.monkey import is_module_patched
+except ImportError:
+    gevent = None
+
 logger = get_logger(__name__)
 
 
 class Status(IntEnum):
     OK = 200
+    NOT_MODIFIED = 304
     BAD_REQUEST = 400
     NOT_FOUND = 404
+    METHOD_NOT_ALLOWED = 405
+    REQUEST_TIMEOUT = 408
+    CONFLICT = 409
+    PAYLOAD_TOO_LARGE = 413
+    TOO_MANY_REQUESTS = 429
     INTERNAL_SERVER_ERROR = 500
 
     def __str__(self) -> str:
         if self == Status.OK:
             return "200 OK"
+        elif self == Status.NOT_MODIFIED:
+            return "304 Not Modified"
         elif self == Status.BAD_REQUEST:
             return "400 Bad Request"
         elif self == Status.NOT_FOUND:
             return "404 Not Found"
+        elif self == Status.METHOD_NOT_ALLOWED:
+            return "405 Method Not Allowed"
+        elif self == Status.REQUEST_TIMEOUT:
+            return "408 Request Timeout"
+        elif self == Status.CONFLICT:
+            return "409 Conflict"
+        elif self == Status.PAYLOAD_TOO_LARGE:
+            return "413 Payload Too Large"
+        elif self == Status.TOO_MANY_REQUESTS:
+            return "429 Too Many Requests"
         elif self == Status.INTERNAL_SERVER_ERROR:
             return "500 Internal Server Error"
 
@@ -60,7 +107,9 @@ WSGIStartResponse = Callable[
 ]
 # See: https://peps.python.org/pep-3333/#buffering-and-streaming
 WSGIResponse = Union[Iterable[bytes], Iterator[bytes]]
-Response = tuple[int, Optional[dict]]
+ResponseBody = Optional[Union[dict, str, "StreamingResponse"]]
+Response = Union[tuple[int, ResponseBody], tuple[int, ResponseBody, dict[str, str]]]
+"""A status and a body, optionally followed by response headers."""
 RequestHandler = Callable[[WSGIEnv], Response]
 
 
@@ -68,11 +117,226 @@ def normalize_headers(headers: dict) -> dict:
     return {key.lower(): value for key, value in headers.items()}
 
 
+class RequestBodyTooLarge(Exception):
+    pass
+
+
+class RequestTimeout(Exception):
+    pass
+
+
+@contextmanager
+def time_limit(seconds: float, message: str) -> Iterator[None]:
+    """Raise `RequestTimeout` if the block, i.e. a blocking read from a slow
+    client, takes longer than `seconds`.
+
+    The gevent workers get a `gevent.Timeout`. The sync workers and the
+    development server handle requests in the main thread, which gets a
+    SIGALRM timer. Other threads are not limited, i.e. the ASGI app's, which
+    limits reads with `asyncio.wait_for` instead."""
+    if gevent is not None and is_module_patched("socket"):
+        with gevent.Timeout(seconds, RequestTimeout(message)):
+            yield
+        return
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def on_alarm(signum, frame):
+        raise RequestTimeout(message)
+
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, signal.SIG_DFL if previous is None else previous)
+
+
+class TooManyRequests(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Too many requests. Retry in {math.ceil(retry_after)}s.")
+        self.retry_after = retry_after
+
+
+@dataclass(frozen=True)
+class JSONCodec:
+    """Serialises response bodies to UTF-8 bytes and parses request bodies
+    from bytes. orjson does both without an intermediate `str`. The standard
+    library only works on `str`, so its codec decodes and encodes once per
+    body, as the handlers did before."""
+
+    name: str
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[Union[bytes, str]], Any]
+
+
+# NOTE: Compact separators and unescaped unicode, so the output is the same
+# with every codec.
+_stdlib_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+_stdlib_decoder = json.JSONDecoder()
+
+
+def _stdlib_loads(body: Union[bytes, str]) -> Any:
+    # NOTE: Decoding explicitly is faster than letting `json.loads` detect the
+    # encoding of bytes.
+    if not isinstance(body, str):
+        body = body.decode("utf8")
+    return _stdlib_decoder.decode(body)
+
+
+STDLIB_JSON_CODEC = JSONCodec(
+    name="json",
+    dumps=lambda value: _stdlib_encoder.encode(value).encode("utf8"),
+    loads=_stdlib_loads,
+)
+
+
+def orjson_codec() -> JSONCodec:
+    import orjson
+
+    return JSONCodec(
+        name="orjson",
+        dumps=partial(orjson.dumps, option=orjson.OPT_NON_STR_KEYS),
+        loads=orjson.loads,
+    )
+
+
+def get_json_codec(name: str = "auto") -> JSONCodec:
+    """Look up a codec by name. `auto` uses orjson when it is installed and
+    falls back to the standard library."""
+    if name == "json":
+        return STDLIB_JSON_CODEC
+    if name == "orjson":
+        return orjson_codec()
+    if name == "auto":
+        try:
+            return orjson_codec()
+        except ImportError:
+            return STDLIB_JSON_CODEC
+    raise ValueError(
+        f"Unknown JSON codec {name}. Please choose from auto, orjson or json"
+    )
+
+
+DEFAULT_JSON_CODEC = get_json_codec()
+
+
+ROUTE_KEY = "joshinkan.route"
+"""The environ key of the path pattern of the matched route."""
+
+REQUEST_ID_KEY = "joshinkan.request_id"
+"""The environ key of the id of the request, see `request_id`."""
+
+TIMINGS_KEY = "joshinkan.timings"
+"""The environ key of the seconds a request spent per phase, i.e. reading the
+body or in the handler."""
+
+
+def add_timing(timings: dict[str, float], phase: str, seconds: float):
+    timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+READ_TIMEOUT_MESSAGE = "Reading the request body took too long."
+
+
+class InputStream:
+    """Wraps `wsgi.input` so that no more than CONTENT_LENGTH bytes are read.
+    See: https://peps.python.org/pep-3333/#input-and-error-streams
+
+    Reading more than `max_size` bytes in total raises `RequestBodyTooLarge`
+    and reading after the `deadline` (a `time.monotonic` timestamp) raises
+    `RequestTimeout`, also while a read waits for a client which trickles its
+    bytes, see `time_limit`. Both abort a request part-way through the body,
+    i.e. when the client did not send a CONTENT_LENGTH or sends slowly."""
+
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(
+        self,
+        stream: BinaryIO,
+        content_length: Optional[int],
+        max_size: Optional[int] = None,
+        deadline: Optional[float] = None,
+        timings: Optional[dict[str, float]] = None,
+    ):
+        self.stream = stream
+        self.remaining = content_length
+        self.max_size = max_size
+        self.deadline = deadline
+        self.timings = timings
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            chunks = []
+            while chunk := self.read(self.CHUNK_SIZE):
+                chunks.append(chunk)
+            return b"".join(chunks)
+
+        remaining_time = None
+        if self.deadline is not None:
+            remaining_time = self.deadline - time.monotonic()
+            if remaining_time <= 0:
+                raise RequestTimeout(READ_TIMEOUT_MESSAGE)
+
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        if self.max_size is not None:
+            # NOTE: Read one byte past the limit to detect oversized bodies.
+            size = min(size, self.max_size - self.bytes_read + 1)
+        if size == 0:
+            return b""
+
+        started = time.perf_counter()
+        if remaining_time is None:
+            chunk = self.stream.read(size)
+        else:
+            with time_limit(remaining_time, READ_TIMEOUT_MESSAGE):
+                chunk = self.stream.read(size)
+        if self.timings is not None:
+            add_timing(self.timings, "body_read", time.perf_counter() - started)
+        self.bytes_read += len(chunk)
+        if self.remaining is not None:
+            self.remaining -= len(chunk)
+        if self.max_size is not None and self.bytes_read > self.max_size:
+            raise RequestBodyTooLarge(
+                f"The request body exceeds the maximum size of {self.max_size} bytes."
+            )
+        return chunk
+
+
 class Request:
-    def __init__(self, environ: WSGIEnv):
+    def __init__(
+        self,
+        environ: WSGIEnv,
+        max_body_size: Optional[int] = None,
+        read_timeout: Optional[float] = None,
+        json_codec: JSONCodec = DEFAULT_JSON_CODEC,
+    ):
         self.environ = environ
+        self.max_body_size = max_body_size
+        self.json_codec = json_codec
+        self.read_deadline = (
+            None if read_timeout is None else time.monotonic() + read_timeout
+        )
         self._parameters: Optional[dict[str, Union[str, list[str]]]] = None
+        self._raw_body: Optional[bytes] = None
         self._body: Optional[str] = None
+        self._form_data: Optional[dict] = None
+        self._stream_consumed = False
+        self.path_parameters: dict[str, str] = {}
+        """Values of the `{name}` segments of the matched route path."""
+        self.timings: dict[str, float] = environ.setdefault(TIMINGS_KEY, {})
+        self.request_id: Optional[str] = environ.get(REQUEST_ID_KEY)
+        """Identifies the request in logs, traces and the X-Request-ID
+        response header."""
+
+    @property
+    def method(self) -> str:
+        return self.environ["REQUEST_METHOD"]
 
     @property
     def parameters(self) -> dict[str, Union[list[str]]]:
@@ -83,24 +347,67 @@ class Request:
                     self._parameters[key] = value[0]
         return self._parameters
 
+    @property
+    def content_length(self) -> Optional[int]:
+        try:
+            return int(self.environ.get("CONTENT_LENGTH") or "")
+        except ValueError:
+            return None
+
+    def stream(self) -> InputStream:
+        """The request body as a binary stream. It can only be read once and
+        `body` is unavailable afterwards."""
+        if self._stream_consumed:
+            raise RuntimeError("The request body has already been read.")
+        self._stream_consumed = True
+        return InputStream(
+            self.environ["wsgi.input"],
+            self.content_length,
+            max_size=self.max_body_size,
+            deadline=self.read_deadline,
+            timings=self.timings,
+        )
+
+    @property
+    def raw_body(self) -> bytes:
+        if self._raw_body is None:
+            self._raw_body = self.stream().read()
+        return self._raw_body
+
     @property
     def body(self) -> str:
         if self._body is None:
-            self._body = self.environ["wsgi.input"].read().decode("utf8")
+            self._body = self.raw_body.decode("utf8")
         return self._body
 
     def json(self) -> dict:
-        return json.loads(self.body)
+        with span("parse", content_type="application/json"):
+            return self.json_codec.loads(self.raw_body)
 
     def form_data(self) -> Optional[dict]:
+        if self._stream_consumed and self._raw_body is None:
+            # NOTE: The stream was parsed by an earlier call.
+            return self._form_data
+
         content_type = self.environ.get("CONTENT_TYPE", None)
         if content_type is None:
             return None
-        try:
-            return multipart.parse(body=self.body, content_type=content_type)
-        except ValueError as error:
-            logger.error(error)
-            return None
+        started = time.perf_counter()
+        with span("parse", content_type=content_type):
+            try:
+                if self._raw_body is not None:
+                    self._form_data = multipart.parse(
+                        body=self._raw_body, content_type=content_type
+                    )
+                else:
+                    self._form_data = multipart.parse_stream(
+                        self.stream(), content_type=content_type
+                    )
+            except (ValueError, UnicodeDecodeError) as error:
+                logger.error(error)
+                self._form_data = None
+        add_timing(self.timings, "form_parse", time.perf_counter() - started)
+        return self._form_data
 
 
 @dataclass
@@ -108,15 +415,131 @@ class Route:
     path: str
     method: str
     handler: RequestHandler
+    max_body_size: Optional[int] = None
+    """Overrides the MAX_BODY_SIZE config for this route."""
+    is_async: bool = False
+    """Whether the handler, below its decorators, is an `async def`."""
 
 
 class RouterException(Exception):
     pass
 
 
+def is_parameter(segment: str) -> bool:
+    return len(segment) > 2 and segment[0] == "{" and segment[-1] == "}"
+
+
+class RouteNode:
+    """A node of the path trie in `CompiledRouter`. One node per path segment."""
+
+    __slots__ = ("children", "parameter", "parameter_child", "methods")
+
+    def __init__(self):
+        self.children: dict[str, RouteNode] = {}
+        self.parameter: Optional[str] = None
+        self.parameter_child: Optional[RouteNode] = None
+        self.methods: dict[str, Route] = {}
+
+
+class CompiledRouter:
+    """A read-only lookup structure for the routes of a `Router`, built once
+    in `make_app`.
+
+    Static paths resolve with a dict lookup on the path and one on the
+    method, as in the previous `has_route` dispatch. Paths
+    with `{name}` segments are stored in a trie of segments, where static
+    segments take precedence over parameters."""
+
+    def __init__(self, routes: dict[str, dict[str, Route]]):
+        self.static: dict[str, dict[str, Route]] = {}
+        self.static_methods: dict[str, list[str]] = {}
+        self.root = RouteNode()
+        self.has_parameters = False
+
+        for path, methods in routes.items():
+            segments = path.split("/")[1:]
+            if not any(is_parameter(segment) for segment in segments):
+                self.static[path] = dict(methods)
+                self.static_methods[path] = sorted(methods)
+                continue
+
+            self.has_parameters = True
+            node = self.root
+            for segment in segments:
+                if is_parameter(segment):
+                    name = segment[1:-1]
+                    if node.parameter_child is None:
+                        node.parameter = name
+                        node.parameter_child = RouteNode()
+                    elif node.parameter != name:
+                        raise RouterException(
+                            f"The route {path} names the parameter '{name}' but"
+                            f" another route uses '{node.parameter}' at the same position."
+                        )
+                    node = node.parameter_child
+                else:
+                    node = node.children.setdefault(segment, RouteNode())
+            node.methods.update(methods)
+
+    def resolve(
+        self, method: str, path: str
+    ) -> tuple[Optional[Route], dict[str, str], Optional[list[str]]]:
+        """Returns the route and its path parameters. If the path exists but
+        not for this method, the route is None and the allowed methods are
+        returned instead."""
+        # NOTE: Nested dicts instead of a (method, path) key, which would
+        # build and hash a tuple on every request.
+        methods = self.static.get(path)
+        if methods is not None:
+            route = methods.get(method)
+            if route is not None:
+                return route, {}, None
+            return None, {}, self.static_methods[path]
+        if not self.has_parameters or path[:1] != "/":
+            return None, {}, None
+
+        parameters: dict[str, str] = {}
+        node = self._match(self.root, path.split("/")[1:], 0, parameters)
+        if node is None:
+            return None, {}, None
+
+        route = node.methods.get(method)
+        if route is None:
+            return None, {}, sorted(node.methods)
+        return route, parameters, None
+
+    def _match(
+        self,
+        node: RouteNode,
+        segments: list[str],
+        index: int,
+        parameters: dict[str, str],
+    ) -> Optional[RouteNode]:
+        if index == len(segments):
+            return node if node.methods else None
+
+        segment = segments[index]
+        child = node.children.get(segment)
+        if child is not None:
+            found = self._match(child, segments, index + 1, parameters)
+            if found is not None:
+                return found
+
+        if node.parameter_child is not None and segment != "":
+            found = self._match(node.parameter_child, segments, index + 1, parameters)
+            if found is not None:
+                parameters[node.parameter] = segment
+                return found
+
+        return None
+
+
 class AppConfig(Protocol):
     PRINT_STACKTRACE: bool
     LOGLEVEL: str
+    MAX_BODY_SIZE: int
+    BODY_READ_TIMEOUT: float
+    JSON_CODEC: str
 
 
 class Router:
@@ -125,18 +548,27 @@ class Router:
         self.routes: dict[str, dict[str, Route]] = {}
         self.context: Optional[Any] = None
         self.config: Optional[AppConfig] = None
+        self.middleware: list["Middleware"] = []
 
     def has_route(self, method: str, path: str) -> bool:
         return path in self.routes and method in self.routes[path]
 
-    def make_route(self, method: str, path: str) -> Callable[[RequestHandler], None]:
+    def make_route(
+        self, method: str, path: str, max_body_size: Optional[int] = None
+    ) -> Callable[[RequestHandler], None]:
         """This method is supposed to be used as a decorator on a route
         function. Registers the decorated handler in the router."""
         assert len(path) > 0, "Route path cannot be an empty string"
         assert path[0] == "/", f"Route '{path}' must start with a forward-slash!"
 
         def wrapper(handler: RequestHandler):
-            route = Route(path, method, handler)
+            route = Route(
+                path,
+                method,
+                handler,
+                max_body_size=max_body_size,
+                is_async=inspect.iscoroutinefunction(inspect.unwrap(handler)),
+            )
 
             if self.has_route(method, path):
                 raise RouterException(f"The route {route} already exists!")
@@ -155,8 +587,12 @@ class Router:
     def get_route(self, method: str, path: str) -> Route:
         return self.routes[path][method]
 
+    def compile(self) -> CompiledRouter:
+        return CompiledRouter(self.routes)
+
     def with_context(self):
         def wrapper(handler: RequestHandler) -> Response:
+            @wraps(handler)
             def handler_with_context(*args, **kwargs) -> Response:
                 if self.context is None:
                     raise ValueError(
@@ -181,6 +617,7 @@ class Router:
 
     def with_config(self):
         def wrapper(handler: RequestHandler) -> Response:
+            @wraps(handler)
             def handler_with_config(*args, **kwargs) -> Response:
                 if self.config is None:
                     raise ValueError(
@@ -195,6 +632,21 @@ class Router:
     def set_config(self, config: AppConfig):
         self.config = config
 
+    def use(self, middleware: "Middleware"):
+        """Add a middleware to the apps built from this router. The first
+        middleware added is the outermost one."""
+        self.middleware.append(middleware)
+
+    def before_request(self, hook: "BeforeHook") -> "BeforeHook":
+        """A decorator to register a `Middleware.before` hook."""
+        self.use(Middleware(before=hook))
+        return hook
+
+    def after_request(self, hook: "AfterHook") -> "AfterHook":
+        """A decorator to register a `Middleware.after` hook."""
+        self.use(Middleware(after=hook))
+        return hook
+
     get = partialmethod(make_route, "GET")
     post = partialmethod(make_route, "POST")
     head = partialmethod(make_route, "HEAD")
@@ -213,69 +665,731 @@ class WSGIApp(Protocol):
         ...
 
 
+def open_request(
+    route: Route,
+    environ: WSGIEnv,
+    path_parameters: dict[str, str],
+    config: AppConfig,
+    json_codec: JSONCodec = DEFAULT_JSON_CODEC,
+) -> Request:
+    """Create the request for a resolved route. Rejects bodies which declare a
+    CONTENT_LENGTH above the route's limit before anything is read."""
+    max_body_size = (
+        route.max_body_size if route.max_body_size is not None else config.MAX_BODY_SIZE
+    )
+    request = Request(
+        environ,
+        max_body_size=max_body_size,
+        read_timeout=config.BODY_READ_TIMEOUT,
+        json_codec=json_codec,
+    )
+    request.path_parameters = path_parameters
+    if request.content_length is not None and request.content_length > max_body_size:
+        raise RequestBodyTooLarge(
+            f"The request body exceeds the maximum size of {max_body_size} bytes."
+        )
+    return request
+
+
+Chunk = Union[str, bytes]
+
+
+def encode_chunk(chunk: Chunk) -> bytes:
+    return chunk.encode("utf8") if isinstance(chunk, str) else chunk
+
+
+class StreamingResponse:
+    """A response body which is sent to the client while it is produced, i.e.
+    from a generator. Return it as the body of a handler response.
+
+    `chunks` is an iterable or async iterable of `str` or `bytes`. Chunks are
+    passed on one by one, so a large export never has to fit into memory.
+    Without a `content_length` the server uses chunked transfer encoding.
+    `headers` are added to the response. By default nginx is told not to
+    buffer the response, as it would otherwise hold back the chunks."""
+
+    def __init__(
+        self,
+        chunks: Union[Iterable[Chunk], AsyncIterable[Chunk]],
+        content_type: str = "application/octet-stream",
+        content_length: Optional[int] = None,
+        headers: Optional[dict[str, str]] = None,
+    ):
+        self.chunks = chunks
+        self.content_type = content_type
+        self.content_length = content_length
+        self.headers = {"X-Accel-Buffering": "no", **(headers or {})}
+
+    def __iter__(self) -> Iterator[bytes]:
+        if not hasattr(self.chunks, "__aiter__"):
+            for chunk in self.chunks:
+                yield encode_chunk(chunk)
+            return
+
+        # NOTE: WSGI iterates synchronously, so async chunks are driven by a
+        # private event loop.
+        loop = asyncio.new_event_loop()
+        iterator = aiter(self.chunks)
+        try:
+            while True:
+                try:
+                    chunk = loop.run_until_complete(anext(iterator))
+                except StopAsyncIteration:
+                    return
+                yield encode_chunk(chunk)
+        finally:
+            if hasattr(iterator, "aclose"):
+                loop.run_until_complete(iterator.aclose())
+            loop.close()
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        if hasattr(self.chunks, "__aiter__"):
+            async for chunk in self.chunks:
+                yield encode_chunk(chunk)
+            return
+
+        # NOTE: Plain iterators may block, i.e. on a database, so each chunk
+        # is produced in the thread pool.
+        loop = asyncio.get_running_loop()
+        iterator = iter(self.chunks)
+        end = object()
+        while (
+            chunk := await loop.run_in_executor(None, next, iterator, end)
+        ) is not end:
+            yield encode_chunk(chunk)
+
+    def close(self):
+        """Called by the WSGI server when the client goes away early."""
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
+
+
+def map_chunks(
+    chunks: Union[Iterable, AsyncIterable], encode: Callable[[Any], Chunk]
+) -> Union[Iterable[Chunk], AsyncIterable[Chunk]]:
+    if hasattr(chunks, "__aiter__"):
+
+        async def encode_async():
+            async for chunk in chunks:
+                yield encode(chunk)
+
+        return encode_async()
+    return (encode(chunk) for chunk in chunks)
+
+
+def ndjson(
+    records: Union[Iterable[Any], AsyncIterable[Any]],
+    json_codec: JSONCodec = DEFAULT_JSON_CODEC,
+) -> StreamingResponse:
+    """Stream records as newline delimited JSON, one record per line."""
+    return StreamingResponse(
+        map_chunks(records, lambda record: json_codec.dumps(record) + b"\n"),
+        content_type="application/x-ndjson",
+    )
+
+
+def server_sent_event(data: Any, json_codec: JSONCodec = DEFAULT_JSON_CODEC) -> str:
+    if not isinstance(data, str):
+        data = json_codec.dumps(data).decode("utf8")
+    return "".join(f"data: {line}\n" for line in data.split("\n")) + "\n"
+
+
+def server_sent_events(
+    events: Union[Iterable[Any], AsyncIterable[Any]],
+    json_codec: JSONCodec = DEFAULT_JSON_CODEC,
+) -> StreamingResponse:
+    """Stream events as text/event-stream. Strings are sent as they are, other
+    values as JSON."""
+    return StreamingResponse(
+        map_chunks(events, partial(server_sent_event, json_codec=json_codec)),
+        content_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+HTTPResponse = tuple[
+    Status, list[tuple[str, str]], Union[list[bytes], StreamingResponse]
+]
+"""The status, headers and body chunks which are sent to the client."""
+
+
+def make_etag(body: bytes) -> str:
+    """A strong entity tag derived from the response body."""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def http_date(value: Union[float, datetime.datetime]) -> str:
+    """Format a timestamp or a datetime for Last-Modified and Expires."""
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.fromtimestamp(value, tz=datetime.timezone.utc)
+    return email.utils.format_datetime(
+        value.astimezone(datetime.timezone.utc), usegmt=True
+    )
+
+
+def cache_control(
+    max_age: Optional[int] = None,
+    s_maxage: Optional[int] = None,
+    public: bool = False,
+    private: bool = False,
+    no_cache: bool = False,
+    no_store: bool = False,
+    must_revalidate: bool = False,
+    immutable: bool = False,
+    stale_while_revalidate: Optional[int] = None,
+) -> dict[str, str]:
+    """Build a Cache-Control header for a handler response, i.e.
+    `return 200, body, cache_control(max_age=60, public=True)`. `s_maxage`
+    applies to shared caches like nginx only."""
+    directives = []
+    if public:
+        directives.append("public")
+    if private:
+        directives.append("private")
+    if no_cache:
+        directives.append("no-cache")
+    if no_store:
+        directives.append("no-store")
+    if max_age is not None:
+        directives.append(f"max-age={max_age}")
+    if s_maxage is not None:
+        directives.append(f"s-maxage={s_maxage}")
+    if must_revalidate:
+        directives.append("must-revalidate")
+    if immutable:
+        directives.append("immutable")
+    if stale_while_revalidate is not None:
+        directives.append(f"stale-while-revalidate={stale_while_revalidate}")
+    return {"Cache-Control": ", ".join(directives)}
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """The weak comparison of If-None-Match, see RFC 9110 section 13.1.2."""
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag.removeprefix("W/")
+    return any(
+        candidate.strip().removeprefix("W/") == etag
+        for candidate in if_none_match.split(",")
+    )
+
+
+def is_not_modified(environ: WSGIEnv, headers: dict[str, str]) -> bool:
+    """Whether the client's cached copy is still valid according to the ETag
+    or Last-Modified response headers. If-Modified-Since is only considered
+    without If-None-Match."""
+    if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        return "etag" in headers and etag_matches(if_none_match, headers["etag"])
+
+    if_modified_since = environ.get("HTTP_IF_MODIFIED_SINCE")
+    if if_modified_since is None or "last-modified" not in headers:
+        return False
+    try:
+        since = email.utils.parsedate_to_datetime(if_modified_since)
+        last_modified = email.utils.parsedate_to_datetime(headers["last-modified"])
+    except (TypeError, ValueError):
+        return False
+    return last_modified <= since
+
+
+NOT_MODIFIED_HEADERS = (
+    "cache-control",
+    "content-location",
+    "date",
+    "etag",
+    "expires",
+    "last-modified",
+    "vary",
+)
+"""Headers which are repeated in a 304 response, see RFC 9110 section 15.4.5."""
+
+
+def not_modified(headers: dict[str, str]) -> HTTPResponse:
+    return (
+        Status.NOT_MODIFIED,
+        [(key, value) for key, value in headers.items() if key in NOT_MODIFIED_HEADERS],
+        [],
+    )
+
+
+def encode_response(
+    request: Request,
+    status: Union[int, Status],
+    body: ResponseBody,
+    headers: Optional[dict[str, str]] = None,
+) -> HTTPResponse:
+    """Serialise a handler response. Successful GET and HEAD responses get an
+    ETag unless they are streamed or set their own. Requests whose
+    If-None-Match or If-Modified-Since still match are answered with 304. When
+    the handler sets ETag or Last-Modified itself, the body is not even
+    serialised."""
+    headers = normalize_headers(headers or {})
+
+    if type(status) == int:
+        status = Status(status)
+
+    conditional = status == Status.OK and request.method in ("GET", "HEAD")
+    if conditional and is_not_modified(request.environ, headers):
+        return not_modified(headers)
+
+    if isinstance(body, StreamingResponse):
+        headers.setdefault("content-type", body.content_type)
+        headers.update(normalize_headers(body.headers))
+        if body.content_length is not None:
+            headers["content-length"] = str(body.content_length)
+        return status, list(headers.items()), body
+
+    if type(body) == dict:
+        if "content-type" not in headers:
+            headers["content-type"] = "application/json"
+        if headers["content-type"] == "application/json":
+            body = request.json_codec.dumps(body)
+
+    if body == None:
+        body = b""
+    elif type(body) == str:
+        body = body.encode("utf8")
+
+    if conditional and "etag" not in headers:
+        headers["etag"] = make_etag(body)
+        if is_not_modified(request.environ, headers):
+            return not_modified(headers)
+
+    headers["content-length"] = str(len(body))
+    return status, list(headers.items()), [body]
+
+
+def error_response(error: Exception, config: AppConfig) -> HTTPResponse:
+    if isinstance(error, RequestBodyTooLarge):
+        return (
+            Status.PAYLOAD_TOO_LARGE,
+            [("Content-Type", "application/json"), ("Connection", "close")],
+            [DEFAULT_JSON_CODEC.dumps({"message": str(error)})],
+        )
+    if isinstance(error, RequestTimeout):
+        return (
+            Status.REQUEST_TIMEOUT,
+            [("Content-Type", "application/json"), ("Connection", "close")],
+            [DEFAULT_JSON_CODEC.dumps({"message": str(error)})],
+        )
+
+    if isinstance(error, TooManyRequests):
+        return (
+            Status.TOO_MANY_REQUESTS,
+            [
+                ("Content-Type", "application/json"),
+                ("Retry-After", str(math.ceil(error.retry_after))),
+            ],
+            [DEFAULT_JSON_CODEC.dumps({"message": str(error)})],
+        )
+
+    tb = "".join(traceback.format_exception(error))
+    logger.error(tb)
+    return (
+        Status.INTERNAL_SERVER_ERROR,
+        [("Content-Type", "text/html; charset=utf-8")],
+        [
+            b"<h1>Internal Server Error</h1>",
+            b"<pre>",
+            bytes(tb, encoding="utf8") if config.PRINT_STACKTRACE else b"",
+            b"</pre>",
+        ],
+    )
+
+
+def route_not_found(
+    method: str, path: str, allowed_methods: Optional[list[str]]
+) -> HTTPResponse:
+    if allowed_methods is not None:
+        return (
+            Status.METHOD_NOT_ALLOWED,
+            [
+                ("Content-Type", "text/html; charset=utf-8"),
+                ("Allow", ", ".join(allowed_methods)),
+            ],
+            [
+                b"<h1>Method Not Allowed</h1>",
+                bytes(
+                    f"The route at {path} only allows {', '.join(allowed_methods)}.",
+                    encoding="utf8",
+                ),
+            ],
+        )
+    return (
+        Status.NOT_FOUND,
+        [("Content-Type", "text/html; charset=utf-8")],
+        [
+            b"<h1>Not Found</h1>",
+            bytes(f"The {method} route at {path} does not exist.", encoding="utf8"),
+        ],
+    )
+
+
+Handler = Callable[[WSGIEnv], HTTPResponse]
+AsyncHandler = Callable[[WSGIEnv], Awaitable[HTTPResponse]]
+BeforeHook = Callable[[WSGIEnv], Optional[HTTPResponse]]
+AfterHook = Callable[[WSGIEnv, HTTPResponse], HTTPResponse]
+
+
+@dataclass(frozen=True)
+class Middleware:
+    """Code which runs around every request of an app, before routing.
+
+    `before` runs first and may answer the request itself by returning a
+    response. `after` receives the response and returns the one to send. Both
+    are plain functions and run in the WSGI and the ASGI app.
+
+    `wrap` receives the next handler of the chain and returns a handler which
+    calls it, for code which needs to run on both sides of the request, i.e.
+    timing. The ASGI app uses `wrap_async` instead, which receives and returns
+    async handlers."""
+
+    before: Optional[BeforeHook] = None
+    after: Optional[AfterHook] = None
+    wrap: Optional[Callable[[Handler], Handler]] = None
+    wrap_async: Optional[Callable[[AsyncHandler], AsyncHandler]] = None
+
+
+def with_hooks(
+    handle: Handler, before: Optional[BeforeHook], after: Optional[AfterHook]
+) -> Handler:
+    # NOTE: Each combination of hooks gets its own closure, so absent hooks
+    # cost nothing per request.
+    if before is not None and after is not None:
+
+        def handle_with_hooks(environ: WSGIEnv) -> HTTPResponse:
+            response = before(environ)
+            if response is None:
+                response = handle(environ)
+            return after(environ, response)
+
+    elif before is not None:
+
+        def handle_with_hooks(environ: WSGIEnv) -> HTTPResponse:
+            response = before(environ)
+            return handle(environ) if response is None else response
+
+    elif after is not None:
+
+        def handle_with_hooks(environ: WSGIEnv) -> HTTPResponse:
+            return after(environ, handle(environ))
+
+    else:
+        return handle
+    return handle_with_hooks
+
+
+def with_async_hooks(
+    handle: AsyncHandler, before: Optional[BeforeHook], after: Optional[AfterHook]
+) -> AsyncHandler:
+    if before is not None and after is not None:
+
+        async def handle_with_hooks(environ: WSGIEnv) -> HTTPResponse:
+            response = before(environ)
+            if response is None:
+                response = await handle(environ)
+            return after(environ, response)
+
+    elif before is not None:
+
+        async def handle_with_hooks(environ: WSGIEnv) -> HTTPResponse:
+            response = before(environ)
+            return await handle(environ) if response is None else response
+
+    elif after is not None:
+
+        async def handle_with_hooks(environ: WSGIEnv) -> HTTPResponse:
+            return after(environ, await handle(environ))
+
+    else:
+        return handle
+    return handle_with_hooks
+
+
+def build_pipeline(handle: Handler, middleware: list[Middleware]) -> Handler:
+    """Nest the middleware around the dispatcher once, so a request only
+    passes through a chain of calls."""
+    for layer in reversed(middleware):
+        if layer.wrap is not None:
+            handle = layer.wrap(handle)
+        handle = with_hooks(handle, layer.before, layer.after)
+    return handle
+
+
+def build_async_pipeline(
+    handle: AsyncHandler, middleware: list[Middleware]
+) -> AsyncHandler:
+    for layer in reversed(middleware):
+        if layer.wrap_async is not None:
+            handle = layer.wrap_async(handle)
+        elif layer.wrap is not None:
+            raise ValueError(
+                f"The middleware {layer} has no `wrap_async` for the ASGI app."
+            )
+        handle = with_async_hooks(handle, layer.before, layer.after)
+    return handle
+
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+MAX_REQUEST_ID_LENGTH = 128
+
+
+def get_request_id(environ: WSGIEnv) -> str:
+    """The id nginx passed in the X-Request-ID header, or a new one. The ids
+    of nginx (`$request_id`) and new ids are 32 hex digits and double as the
+    trace id.
+
+    NOTE: The header is trusted as it is. nginx overwrites it, but without
+    nginx in front, i.e. with `--asgi` or in development, clients choose
+    their request ids and can give several requests the same one. Only
+    letters, digits and `-._` are accepted, so an id cannot forge log
+    lines."""
+    request_id = environ.get("HTTP_X_REQUEST_ID", "")
+    if (
+        0 < len(request_id) <= MAX_REQUEST_ID_LENGTH
+        and request_id.replace("-", "").replace(".", "").replace("_", "").isalnum()
+        and request_id.isascii()
+    ):
+        return request_id
+    return new_trace_id()
+
+
+def request_span(environ: WSGIEnv):
+    request_id = environ[REQUEST_ID_KEY]
+    return span(
+        "request",
+        kind=SPAN_KIND_SERVER,
+        trace_id=request_id if is_trace_id(request_id) else None,
+        request_id=request_id,
+        **{
+            "http.request.method": environ["REQUEST_METHOD"],
+            "url.path": environ["PATH_INFO"],
+        },
+    )
+
+
+def end_request_span(root, environ: WSGIEnv, status: int):
+    root.set_attribute("http.route", environ.get(ROUTE_KEY, ""))
+    root.set_attribute("http.response.status_code", int(status))
+    if status >= 500:
+        root.set_error(str(status))
+
+
 def make_app(router: Router) -> WSGIApp:
     if router.config is None:
         raise ValueError(
             "Config is not set. Use `router.set_config` when building the app."
         )
 
-    def app(environ: WSGIEnv, start_response: WSGIStartResponse) -> WSGIResponse:
-        logger.debug(environ)
+    compiled_router = router.compile()
+    json_codec = get_json_codec(router.config.JSON_CODEC)
 
+    def handle(environ: WSGIEnv) -> HTTPResponse:
         path = environ["PATH_INFO"]
         method = environ["REQUEST_METHOD"]
 
-        if router.has_route(method, path):
-            route = router.get_route(method, path)
+        route, path_parameters, allowed_methods = compiled_router.resolve(method, path)
+        if route is None:
+            return route_not_found(method, path, allowed_methods)
+        environ[ROUTE_KEY] = route.path
 
+        try:
+            request = open_request(
+                route, environ, path_parameters, router.config, json_codec
+            )
+            started = time.perf_counter()
+            with span("handler", route=route.path):
+                result = route.handler(request)
+                if inspect.isawaitable(result):
+                    # NOTE: Async handlers run to completion on a fresh event
+                    # loop, so both entry points can serve the same router.
+                    result = asyncio.run(result)
+            add_timing(request.timings, "handler", time.perf_counter() - started)
+            return encode_response(request, *result)
+        except Exception as error:
+            return error_response(error, router.config)
+
+    pipeline = build_pipeline(handle, router.middleware)
+
+    def app(environ: WSGIEnv, start_response: WSGIStartResponse) -> WSGIResponse:
+        request_id = environ[REQUEST_ID_KEY] = get_request_id(environ)
+        with log_context(request_id=request_id), request_span(environ) as root:
             try:
-                request = Request(environ)
-                status, body = route.handler(request)
+                status, headers, chunks = pipeline(environ)
+            except Exception as error:
+                status, headers, chunks = error_response(error, router.config)
+            end_request_span(root, environ, status)
+        start_response(str(status), headers + [(REQUEST_ID_HEADER, request_id)])
+        return chunks
 
-                # TODO(sven): Support setting custom headers in the route
-                # handlers. Also, allow performing a non-json response, i.e. for
-                # long polling or HTML.
-                headers = {}
-                headers = normalize_headers(headers)
+    app.router = router
+    app.config = router.config
+    app.context = router.context
+    return app
 
-                if type(body) == dict:
-                    if "content-type" not in headers:
-                        headers["content-type"] = "application/json"
-                    if headers["content-type"] == "application/json":
-                        body = json.dumps(body)
 
-                if body == None:
-                    body = ""
+# See: https://asgi.readthedocs.io/en/latest/specs/main.html
+ASGIScope = Dict
+ASGIReceive = Callable[[], Awaitable[dict]]
+ASGISend = Callable[[dict], Awaitable[None]]
 
-                if type(status) == int:
-                    status = Status(status)
 
-                start_response(str(status), list(headers.items()))
-                return [bytes(body, encoding="utf8")]
-            except Exception as error:
-                tb = traceback.format_exc()
-                logger.error(tb)
+class ASGIApp(Protocol):
+    router: Router
+    config: Config
+    context: Any
 
-                start_response(
-                    str(Status.INTERNAL_SERVER_ERROR),
-                    [("Content-Type", "text/html; charset=utf-8")],
-                )
-                return [
-                    b"<h1>Internal Server Error</h1>",
-                    b"<pre>",
-                    bytes(tb, encoding="utf8")
-                    if router.config.PRINT_STACKTRACE
-                    else b"",
-                    b"</pre>",
-                ]
+    async def __call__(
+        self, scope: ASGIScope, receive: ASGIReceive, send: ASGISend
+    ) -> None:
+        ...
+
+
+def asgi_environ(scope: ASGIScope) -> WSGIEnv:
+    """Translate an ASGI http scope into the WSGI environ which `Request`
+    reads from. The body is attached separately as `wsgi.input`."""
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+    }
+    for key, value in scope["headers"]:
+        key = key.decode("latin-1").replace("-", "_").upper()
+        value = value.decode("latin-1")
+        if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[key] = value
+        elif "HTTP_" + key in environ:
+            environ["HTTP_" + key] += "," + value
         else:
-            start_response(
-                str(Status.NOT_FOUND), [("Content-Type", "text/html; charset=utf-8")]
+            environ["HTTP_" + key] = value
+    return environ
+
+
+async def read_asgi_body(receive: ASGIReceive, max_size: int) -> bytes:
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise RequestTimeout("The client disconnected while sending the body.")
+        body += message.get("body", b"")
+        if len(body) > max_size:
+            raise RequestBodyTooLarge(
+                f"The request body exceeds the maximum size of {max_size} bytes."
             )
-            return [
-                b"<h1>Not Found</h1>",
-                bytes(f"The {method} route at {path} does not exist.", encoding="utf8"),
-            ]
+        if not message.get("more_body", False):
+            return bytes(body)
+
+
+def make_asgi_app(router: Router) -> ASGIApp:
+    """The ASGI counterpart of `make_app`, serving the same router.
+
+    The body is read from the client before the handler runs, bounded by the
+    route's body size limit and BODY_READ_TIMEOUT. `async def` handlers run on
+    the event loop. Plain handlers run in the default thread pool, so blocking
+    calls, i.e. to the SMTP server, don't stall other requests."""
+    if router.config is None:
+        raise ValueError(
+            "Config is not set. Use `router.set_config` when building the app."
+        )
+
+    compiled_router = router.compile()
+    json_codec = get_json_codec(router.config.JSON_CODEC)
+
+    async def handle(environ: WSGIEnv) -> HTTPResponse:
+        path = environ["PATH_INFO"]
+        method = environ["REQUEST_METHOD"]
+
+        route, path_parameters, allowed_methods = compiled_router.resolve(method, path)
+        if route is None:
+            return route_not_found(method, path, allowed_methods)
+        environ[ROUTE_KEY] = route.path
+
+        try:
+            request = open_request(
+                route, environ, path_parameters, router.config, json_codec
+            )
+            started = time.perf_counter()
+            try:
+                body = await asyncio.wait_for(
+                    read_asgi_body(environ["asgi.receive"], request.max_body_size),
+                    router.config.BODY_READ_TIMEOUT,
+                )
+            except asyncio.TimeoutError:
+                raise RequestTimeout(READ_TIMEOUT_MESSAGE)
+            environ["wsgi.input"] = BytesIO(body)
+            environ["CONTENT_LENGTH"] = str(len(body))
+            add_timing(request.timings, "body_read", time.perf_counter() - started)
+
+            started = time.perf_counter()
+            with span("handler", route=route.path):
+                if route.is_async:
+                    result = route.handler(request)
+                else:
+                    loop = asyncio.get_running_loop()
+                    # NOTE: Executor threads do not inherit the context, i.e.
+                    # the request id of log records and the current span.
+                    result = await loop.run_in_executor(
+                        None, contextvars.copy_context().run, route.handler, request
+                    )
+                if inspect.isawaitable(result):
+                    result = await result
+            add_timing(request.timings, "handler", time.perf_counter() - started)
+            return encode_response(request, *result)
+        except Exception as error:
+            return error_response(error, router.config)
+
+    pipeline = build_async_pipeline(handle, router.middleware)
+
+    async def app(scope: ASGIScope, receive: ASGIReceive, send: ASGISend) -> None:
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        if scope["type"] != "http":
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']}")
+
+        environ = asgi_environ(scope)
+        environ["asgi.receive"] = receive
+        request_id = environ[REQUEST_ID_KEY] = get_request_id(environ)
+        with log_context(request_id=request_id), request_span(environ) as root:
+            try:
+                status, headers, chunks = await pipeline(environ)
+            except Exception as error:
+                status, headers, chunks = error_response(error, router.config)
+            end_request_span(root, environ, status)
+        headers = headers + [(REQUEST_ID_HEADER, request_id)]
+        await send(
+            {
+                "type": "http.response.start",
+                "status": int(status),
+                "headers": [
+                    (key.lower().encode("latin-1"), value.encode("latin-1"))
+                    for key, value in headers
+                ],
+            }
+        )
+        if isinstance(chunks, StreamingResponse):
+            async for chunk in chunks:
+                if chunk:
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+            await send({"type": "http.response.body", "body": b""})
+        else:
+            await send({"type": "http.response.body", "body": b"".join(chunks)})
 
     app.router = router
     app.config = router.config
@@ -289,20 +1403,46 @@ class ValidationType(Enum):
     FORM_DATA = auto()
 
 
+def validation_errors(errors: list[InvalidSchema]) -> dict:
+    """The 400 response body for a failed `validate_all`. `message` holds the
+    first error, `errors` holds all of them."""
+    return {
+        "message": str(errors[0].message),
+        "errors": [{"message": str(e.message), "path": e.path} for e in errors],
+    }
+
+
+@contextmanager
+def validation_phase(request: Request) -> Iterator[Any]:
+    """Record the validation of a request as a span and in its timings, for
+    routes which validate without `expect_schema`."""
+    started = time.perf_counter()
+    try:
+        with span("validate") as validation_span:
+            yield validation_span
+    finally:
+        add_timing(request.timings, "validation", time.perf_counter() - started)
+
+
 def expect_schema(
-    schema: Schema, validate: ValidationType = ValidationType.PARAMETERS
+    schema: Schema,
+    validate: ValidationType = ValidationType.PARAMETERS,
+    all_errors: bool = False,
 ) -> Callable:
     """A decorator for routes. Applies the validation to the request parameters
-    or the json body"""
+    or the json body. With `all_errors`, the response lists every validation
+    error instead of only the first."""
+    schema = schema.compile()
 
     def wrapper(handler):
+        @wraps(handler)
         def validation_handler(request: Request) -> Response:
             if validate is ValidationType.PARAMETERS:
                 validation_object = request.parameters
             elif validate is ValidationType.JSON_BODY:
                 try:
                     validation_object = request.json()
-                except json.JSONDecodeError:
+                except (json.JSONDecodeError, UnicodeDecodeError):
                     return 400, {
                         "message": "The request body could not be parsed or is empty."
                     }
@@ -315,13 +1455,21 @@ def expect_schema(
             else:
                 raise ValueError(f"Unknown validation type {validate}")
 
-            valid, error = schema.validate(validation_object)
+            with validation_phase(request) as validation_span:
+                if all_errors:
+                    valid, errors = schema.validate_all(validation_object)
+                else:
+                    valid, error = schema.validate(validation_object)
+                validation_span.set_attribute("valid", valid)
+
             if not valid:
                 logger.debug("Request validation failed")
+                if all_errors:
+                    logger.debug(errors)
+                    return 400, validation_errors(errors)
                 logger.debug(error)
                 return 400, {"message": str(error.message)}
-            else:
-                return handler(request)
+            return handler(request)
 
         return validation_handler
 
@@ -347,14 +1495,17 @@ class Client:
 
     @contextmanager
     def config(self, key: str, value: Any):
-        """A context manager to temporarily set a config value."""
+        """A context manager to temporarily set a config value. The config is
+        immutable, so the router gets a changed copy."""
         assert hasattr(self.app, "router")
-        assert self.app.router.config is not None
-        assert hasattr(self.app.router.config, key)
-        backup = getattr(self.app.router.config, key)
-        setattr(self.app.router.config, key, value)
-        yield
-        setattr(self.app.router.config, key, backup)
+        config = self.app.router.config
+        assert config is not None
+        assert hasattr(config, key)
+        self.app.router.set_config(dataclasses.replace(config, **{key: value}))
+        try:
+            yield
+        finally:
+            self.app.router.set_config(config)
 
     def __init__(self, app: WSGIApp):
         self.app = app
@@ -378,9 +1529,10 @@ class Client:
 
         if type(body) == dict:
             body = json.dumps(body)
+        body = bytes(body, encoding="utf8")
         if len(body) > 0:
-            environ["wsgi.input"] = BytesIO(bytes(body, encoding="utf8"))
-        environ["CONTENT_LENGTH"] = headers.get("content-length", len(body))
+            environ["wsgi.input"] = BytesIO(body)
+        environ["CONTENT_LENGTH"] = headers.get("content-length", str(len(body)))
 
         for key, value in headers.items():
             key = key.replace("-", "_").upper()
@@ -0,0 +1,184 @@
+"""Answers repeated requests with the response of the first one.
+
+A request is identified by its `Idempotency-Key` header or, without one, by
+a hash of its normalised payload. The first request claims the key and runs,
+duplicates which arrive while it runs wait for its response. Responses are
+kept for `ttl` seconds, in memory or, to share them between the gunicorn
+workers, as files in a directory."""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+from .httpd import Request, Response, Status
+
+IDEMPOTENCY_KEY_HEADER = "HTTP_IDEMPOTENCY_KEY"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+def payload_key(payload: dict) -> str:
+    """A hash of the payload which ignores the order of the fields, the case
+    of the email and surrounding whitespace."""
+    normalised = {}
+    for name, value in payload.items():
+        values = value if isinstance(value, list) else [value]
+        values = [str(item).strip() for item in values]
+        if name == "email":
+            values = [item.lower() for item in values]
+        normalised[name] = values
+    encoded = json.dumps(normalised, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf8")).hexdigest()
+
+
+def request_key(request: Request, payload: dict) -> str:
+    key = request.environ.get(IDEMPOTENCY_KEY_HEADER, "").strip()
+    path = request.environ["PATH_INFO"]
+    if key:
+        return f"{path}:key:{key}"
+    return f"{path}:payload:{payload_key(payload)}"
+
+
+class Pending(Exception):
+    """Another request with the same key is still running."""
+
+
+class MemoryStore:
+    """Keeps at most `max_entries` responses of this process."""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        # NOTE: key -> (time stored, response or None while pending)
+        self._entries: OrderedDict[str, tuple[float, Optional[dict]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, key: str, ttl: float) -> Optional[dict]:
+        """Claim `key` and return None, or return the stored response. Raises
+        `Pending` while another request holds the claim."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < ttl:
+                if entry[1] is None:
+                    raise Pending(key)
+                return entry[1]
+            self._entries[key] = (now, None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return None
+
+    def store(self, key: str, response: dict):
+        with self._lock:
+            self._entries[key] = (time.time(), response)
+
+    def release(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class FileStore:
+    """Shares the responses between processes as files in `directory`. An
+    empty file is a claim, which `os.O_EXCL` makes atomic."""
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._last_prune = 0.0
+
+    def path(self, key: str) -> Path:
+        return self.directory / hashlib.sha256(key.encode("utf8")).hexdigest()
+
+    def claim(self, key: str, ttl: float) -> Optional[dict]:
+        path = self.path(key)
+        self._prune(ttl)
+        while True:
+            try:
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+                return None
+            except FileExistsError:
+                pass
+            try:
+                stored = path.stat().st_mtime
+                content = path.read_bytes()
+            except FileNotFoundError:
+                continue  # released in the meantime
+            if time.time() - stored >= ttl:
+                path.unlink(missing_ok=True)
+                continue
+            if not content:
+                raise Pending(key)
+            return json.loads(content)
+
+    def store(self, key: str, response: dict):
+        path = self.path(key)
+        temporary = path.with_suffix(".tmp")
+        temporary.write_text(json.dumps(response), encoding="utf8")
+        os.replace(temporary, path)
+
+    def release(self, key: str):
+        self.path(key).unlink(missing_ok=True)
+
+    def _prune(self, ttl: float):
+        # NOTE: At most once per `ttl`, so the directory holds the responses
+        # of about two `ttl` windows.
+        now = time.time()
+        if now - self._last_prune < ttl:
+            return
+        self._last_prune = now
+        for path in self.directory.iterdir():
+            try:
+                if now - path.stat().st_mtime >= ttl:
+                    path.unlink(missing_ok=True)
+            except FileNotFoundError:
+                pass
+
+
+class IdempotencyCache:
+    """Runs a request once per key within `ttl` seconds. A duplicate waits up
+    to `wait` seconds for the first request to finish, then gets 409."""
+
+    def __init__(
+        self,
+        ttl: float,
+        store: Union[MemoryStore, FileStore, None] = None,
+        wait: float = 10.0,
+        poll_interval: float = 0.05,
+    ):
+        self.ttl = ttl
+        self.store = store or MemoryStore()
+        self.wait = wait
+        self.poll_interval = poll_interval
+
+    def run(self, key: str, handle: Callable[[], Response]) -> Response:
+        """Return the stored response of `key` or call `handle` and store its
+        response. Responses with a 5xx status or an error are not stored, so
+        the request can be retried."""
+        deadline = time.monotonic() + self.wait
+        while True:
+            try:
+                stored = self.store.claim(key, self.ttl)
+                break
+            except Pending:
+                if time.monotonic() >= deadline:
+                    return Status.CONFLICT, {
+                        "message": "The same request is still being processed."
+                    }
+                time.sleep(self.poll_interval)
+
+        if stored is not None:
+            return stored["status"], stored["body"], {REPLAYED_HEADER: "true"}
+
+        try:
+            status, body, *_ = response = handle()
+        except BaseException:
+            self.store.release(key)
+            raise
+        if int(status) >= 500 or not isinstance(body, dict):
+            self.store.release(key)
+        else:
+            self.store.store(key, {"status": int(status), "body": body})
+        return response
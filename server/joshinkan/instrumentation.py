@@ -0,0 +1,147 @@
+"""Request metrics of the app, reported through `joshinkan.metrics`."""
+import time
+from typing import Optional
+
+from .httpd import (
+    ROUTE_KEY,
+    TIMINGS_KEY,
+    AsyncHandler,
+    Handler,
+    HTTPResponse,
+    Middleware,
+    Request,
+    RequestBodyTooLarge,
+    RequestTimeout,
+    Response,
+    Router,
+    Status,
+    TooManyRequests,
+    WSGIEnv,
+    cache_control,
+)
+from .mailqueue import MailQueue
+from .metrics import CONTENT_TYPE, REGISTRY, Registry, SnapshotStore, exposition
+
+UNMATCHED_ROUTE = "unmatched"
+"""The route label of requests which did not match a route. Using the path
+instead would create a time series per URL a scanner tries."""
+
+
+def error_status(error: Exception) -> int:
+    """The status `error_response` answers an error with."""
+    if isinstance(error, RequestBodyTooLarge):
+        return Status.PAYLOAD_TOO_LARGE
+    if isinstance(error, RequestTimeout):
+        return Status.REQUEST_TIMEOUT
+    if isinstance(error, TooManyRequests):
+        return Status.TOO_MANY_REQUESTS
+    return Status.INTERNAL_SERVER_ERROR
+
+
+def instrumentation(
+    registry: Registry = REGISTRY, store: Optional[SnapshotStore] = None
+) -> Middleware:
+    """A middleware which records the latency, the time of each request phase
+    and the status of every request per route. Register it first, so the
+    latency includes the other middleware.
+
+    With a `store`, the metrics are written to it after requests, at most once
+    per `store.interval`, so `/metrics` can add up the metrics of all workers.
+
+    NOTE: The latency of a streaming response ends when the handler returns,
+    not when the last chunk is sent."""
+    duration = registry.histogram(
+        "joshinkan_request_duration_seconds",
+        "Time from receiving a request until the response is ready.",
+        ("route", "method"),
+    )
+    phases = registry.histogram(
+        "joshinkan_request_phase_seconds",
+        "Time spent reading the body, parsing forms, validating and in the handler.",
+        ("route", "phase"),
+    )
+    responses = registry.counter(
+        "joshinkan_responses_total",
+        "Responses by status code.",
+        ("route", "method", "status"),
+    )
+    in_flight = registry.gauge(
+        "joshinkan_requests_in_flight", "Requests which are being handled."
+    )
+
+    def record(environ: WSGIEnv, status: int, started: float):
+        route = environ.get(ROUTE_KEY, UNMATCHED_ROUTE)
+        method = environ["REQUEST_METHOD"]
+        duration.observe(time.perf_counter() - started, route, method)
+        for phase, seconds in environ[TIMINGS_KEY].items():
+            phases.observe(seconds, route, phase)
+        responses.inc(route, method, str(int(status)))
+        if store is not None:
+            store.write(registry)
+
+    def wrap(handle: Handler) -> Handler:
+        def handle_instrumented(environ: WSGIEnv) -> HTTPResponse:
+            environ[TIMINGS_KEY] = {}
+            started = time.perf_counter()
+            in_flight.inc()
+            status = Status.INTERNAL_SERVER_ERROR
+            try:
+                response = handle(environ)
+                status = response[0]
+                return response
+            except Exception as error:
+                status = error_status(error)
+                raise
+            finally:
+                in_flight.dec()
+                record(environ, status, started)
+
+        return handle_instrumented
+
+    def wrap_async(handle: AsyncHandler) -> AsyncHandler:
+        async def handle_instrumented(environ: WSGIEnv) -> HTTPResponse:
+            environ[TIMINGS_KEY] = {}
+            started = time.perf_counter()
+            in_flight.inc()
+            status = Status.INTERNAL_SERVER_ERROR
+            try:
+                response = await handle(environ)
+                status = response[0]
+                return response
+            except Exception as error:
+                status = error_status(error)
+                raise
+            finally:
+                in_flight.dec()
+                record(environ, status, started)
+
+        return handle_instrumented
+
+    return Middleware(wrap=wrap, wrap_async=wrap_async)
+
+
+def add_metrics_route(
+    router: Router,
+    registry: Registry = REGISTRY,
+    store: Optional[SnapshotStore] = None,
+    path: str = "/metrics",
+):
+    """Serve the metrics in the Prometheus text format at `path`."""
+
+    @router.get(path)
+    def metrics(request: Request) -> Response:
+        return (
+            Status.OK,
+            exposition(registry, store),
+            {"Content-Type": CONTENT_TYPE, **cache_control(no_store=True)},
+        )
+
+
+def mail_queue_collector(queue: MailQueue):
+    """Report the depth of a mail queue on every scrape. The queue counts its
+    deliveries in `joshinkan_mail_queue_messages_total` itself."""
+
+    def collect() -> dict[str, float]:
+        return {"joshinkan_mail_queue_depth": queue.stats().depth}
+
+    return collect
@@ -1,35 +1,181 @@
+import atexit
+import copy
+import json
 import logging
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import Iterator, Optional, TextIO
 
-_console_handler = None
+ROOT_LOGGER_NAME = "joshinkan"
+"""Loggers of the backend are children of this logger, which holds the only
+handler. Loggers of other names get it added once."""
 
+LOG_FORMATS = ("text", "json")
 
-def setup_logging(loglevel_name: str):
-    global _console_handler
+_queue_handler: Optional[QueueHandler] = None
+_listener: Optional[QueueListener] = None
 
-    loglevel = getattr(logging, loglevel_name)
+_log_context: ContextVar[Optional[dict]] = ContextVar("log_context", default=None)
+
+
+@contextmanager
+def log_context(**fields) -> Iterator[dict]:
+    """Add `fields` to every record logged within the block, in this thread or
+    asyncio task. Records also get the milliseconds since the block started
+    as `elapsed_ms`."""
+    context = {**(_log_context.get() or {}), **fields}
+    context.setdefault("started", time.perf_counter())
+    token = _log_context.set(context)
+    try:
+        yield context
+    finally:
+        _log_context.reset(token)
+
+
+def current_log_context() -> dict:
+    return _log_context.get() or {}
+
+
+class ContextFilter(logging.Filter):
+    """Copies the fields of the `log_context` onto records as `context`. It
+    runs in the thread which logs, as the context is gone once the listener
+    formats the record."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = _log_context.get()
+        if context is not None:
+            fields = {key: value for key, value in context.items() if key != "started"}
+            fields["elapsed_ms"] = round(
+                (time.perf_counter() - context["started"]) * 1e3, 3
+            )
+            record.context = fields
+        return True
+
+
+class RecordQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # NOTE: The message and the traceback are rendered here, as the
+        # arguments may change after the call. Unlike the default, the record
+        # is only copied when it has a traceback, which the handlers of parent
+        # loggers still need.
+        if record.exc_info:
+            record = copy.copy(record)
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__(fmt="%(levelname)s %(name)s %(asctime)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        context = getattr(record, "context", None)
+        if context is None or context.get("request_id") is None:
+            return message
+        return f"{message} [{context['request_id']} +{context['elapsed_ms']}ms]"
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as JSON lines, including the fields of the
+    `log_context`. `time` is in seconds since the epoch."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        context = getattr(record, "context", None)
+        if context is not None:
+            entry.update(context)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(
+    loglevel_name: str, log_format: str = "text", stream: Optional[TextIO] = None
+):
+    """Log records of `loglevel_name` and higher to stderr, or `stream`, as
+    text or JSON lines.
+
+    Records are handed through a queue to a background thread which writes
+    them, so logging never waits for I/O. Records below the level are dropped
+    before their message is formatted."""
+    global _queue_handler, _listener
+
+    loglevel = getattr(logging, loglevel_name, None)
     if loglevel is None or not isinstance(loglevel, int):
         raise ValueError(
             f"Unknown loglevel name {loglevel_name}. Please choose from DEBUG,"
             " INFO, WARNING or ERROR"
         )
+    if log_format not in LOG_FORMATS:
+        raise ValueError(
+            f"Unknown log format {log_format}. Please choose from"
+            f" {', '.join(LOG_FORMATS)}"
+        )
 
-    _console_handler = logging.StreamHandler()
-    _console_handler.setLevel(loglevel)
+    stream_handler = logging.StreamHandler(stream or sys.stderr)
+    stream_handler.setFormatter(
+        JSONFormatter() if log_format == "json" else TextFormatter()
+    )
+    queue_handler = RecordQueueHandler(SimpleQueue())
+    queue_handler.addFilter(ContextFilter())
+    listener = QueueListener(queue_handler.queue, stream_handler)
 
-    formatter = logging.Formatter(fmt="%(levelname)s %(name)s %(asctime)s: %(message)s")
-    _console_handler.setFormatter(formatter)
+    stop_logging()
+    previous_handler = _queue_handler
+    _queue_handler, _listener = queue_handler, listener
+    listener.start()
+
+    # NOTE: Replace the handler wherever `get_logger` added the previous one.
+    for logger in [logging.getLogger(ROOT_LOGGER_NAME)] + [
+        logger
+        for logger in logging.Logger.manager.loggerDict.values()
+        if isinstance(logger, logging.Logger) and previous_handler in logger.handlers
+    ]:
+        if previous_handler is not None:
+            logger.removeHandler(previous_handler)
+        logger.addHandler(queue_handler)
+    logging.getLogger(ROOT_LOGGER_NAME).setLevel(loglevel)
+
+
+def stop_logging():
+    """Write the records which are still queued and stop the thread."""
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
 
 
 def get_logger(logger_name: str) -> logging.Logger:
-    if _console_handler is None:
+    if _queue_handler is None:
         raise RuntimeError("Logging not initialized. Call `setup_logging` first!")
 
     logger = logging.getLogger(logger_name)
-
-    # NOTE(sven): Python logging can set the loglevel on the logger instance and
-    # on the handler. Here we allow the logger to always log every level (DEBUG
-    # and higher) but the handler has been restricted to the target log level in
-    # `setup_logging`.
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(_console_handler)
+    # NOTE: Loggers of the backend inherit the level and the handler of
+    # the `joshinkan` logger, so every record is handled exactly once.
+    if not (
+        logger_name == ROOT_LOGGER_NAME
+        or logger_name.startswith(f"{ROOT_LOGGER_NAME}.")
+        or _queue_handler in logger.handlers
+    ):
+        logger.setLevel(logging.getLogger(ROOT_LOGGER_NAME).level)
+        logger.addHandler(_queue_handler)
     return logger
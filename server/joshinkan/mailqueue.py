@@ -0,0 +1,314 @@
+import atexit
+import heapq
+import itertools
+import threading
+import time
+from dataclasses import dataclass, field
+from email.message import EmailMessage
+from typing import Optional
+
+from .logger import current_log_context, get_logger, log_context
+from .metrics import REGISTRY
+from .smtp import EmailUser, Mailer, RecipientsPartlyRefused
+from .spool import Spool
+from .tracing import SpanContext, current_span_context, span
+
+logger = get_logger(__name__)
+
+MESSAGES = REGISTRY.counter(
+    "joshinkan_mail_queue_messages_total",
+    "Queued emails which were delivered, retried or failed.",
+    ("result",),
+)
+DELIVERY_SECONDS = REGISTRY.histogram(
+    "joshinkan_mail_queue_delivery_seconds",
+    "Time from queueing an email until it was delivered, including retries.",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0),
+)
+
+SHUTDOWN_TIMEOUT = 25.0
+"""Seconds a worker spends on delivering its queue when it exits, below
+gunicorn's graceful timeout of 30 seconds."""
+
+
+@dataclass
+class MailJob:
+    message: EmailMessage
+    to_addrs: list[EmailUser]
+    enqueued_at: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+    spool_id: Optional[int] = None
+    request_id: Optional[str] = field(
+        default_factory=lambda: current_log_context().get("request_id")
+    )
+    """The request which sent the message, for the logs of its delivery."""
+    trace: Optional[SpanContext] = field(default_factory=current_span_context)
+    """The span which sent the message, linked from the delivery span."""
+
+
+@dataclass
+class MailQueueStats:
+    depth: int
+    delivered: int
+    retried: int
+    failed: int
+    last_latency: Optional[float]
+    """Seconds between enqueueing and delivering the last delivered message."""
+    max_latency: Optional[float]
+
+
+class MailQueue:
+    """Delivers emails in a background worker so request handlers don't wait
+    on the SMTP server.
+
+    `send` has the same signature as `Mailer.send` but only enqueues the
+    message. A worker thread (a greenlet when running under gevent) delivers
+    the messages in order. All messages which are due are delivered together
+    over one SMTP session with `Mailer.send_many`, at most `batch_size` at a
+    time. Failed deliveries are retried with exponential backoff until
+    `max_attempts` is reached.
+
+    With a `spool`, every message is persisted before `send` returns and is
+    marked as done once delivered. Messages which could not be delivered stay
+    in the spool and are replayed by `restore` on the next start.
+
+    When the process exits, i.e. when gunicorn restarts the worker, `stop`
+    makes one last attempt to deliver the queued messages."""
+
+    def __init__(
+        self,
+        mailer: Mailer,
+        max_attempts: int = 20,
+        backoff: float = 1.0,
+        max_backoff: float = 300.0,
+        spool: Optional[Spool] = None,
+        batch_size: int = 10,
+    ):
+        self.mailer = mailer
+        self.spool = spool
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # NOTE: Heap of (due time, sequence number, job). The sequence number
+        # keeps the order of jobs which are due at the same time and avoids
+        # comparing jobs.
+        self._jobs: list[tuple[float, int, MailJob]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._worker: Optional[threading.Thread] = None
+        self._stopped = False
+        self._busy = 0
+        self._exit_hook = False
+
+        self._delivered_count = 0
+        self._retried_count = 0
+        self._failed_count = 0
+        self._last_latency: Optional[float] = None
+        self._max_latency: Optional[float] = None
+
+    def start(self):
+        with self._condition:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._stopped = False
+            self._worker = threading.Thread(
+                target=self._run, name="mail-queue", daemon=True
+            )
+            self._worker.start()
+            if not self._exit_hook:
+                atexit.register(self.stop, SHUTDOWN_TIMEOUT)
+                self._exit_hook = True
+
+    def stop(self, timeout: Optional[float] = None):
+        """Deliver the queued messages, including those waiting for a retry,
+        and stop the worker. Waits at most `timeout` seconds. Messages which
+        fail now are not retried, they stay in the spool."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._worker is not None:
+            self._worker.join(timeout)
+            self._worker = None
+
+    def send(self, message: EmailMessage, to_addrs: list[EmailUser]):
+        job = MailJob(message=message, to_addrs=to_addrs)
+        if self.spool is not None:
+            job.spool_id = self.spool.add(message, to_addrs)
+        self.enqueue(job)
+
+    def send_many(
+        self, messages: list[tuple[EmailMessage, list[EmailUser]]]
+    ) -> list[Optional[Exception]]:
+        """Enqueue several messages. They will be delivered over the same
+        SMTP session. Errors are only logged, as delivery happens later."""
+        jobs = []
+        for message, to_addrs in messages:
+            job = MailJob(message=message, to_addrs=to_addrs)
+            if self.spool is not None:
+                job.spool_id = self.spool.add(message, to_addrs)
+            jobs.append(job)
+        self.enqueue_many(jobs)
+        return [None] * len(messages)
+
+    def restore(self) -> int:
+        """Enqueue the messages left over in the spool by previous workers.
+        Returns the number of restored messages."""
+        if self.spool is None:
+            return 0
+
+        mails = self.spool.recover()
+        for mail in mails:
+            self.enqueue(
+                MailJob(message=mail.message, to_addrs=mail.to_addrs, spool_id=mail.id)
+            )
+        return len(mails)
+
+    def enqueue(self, job: MailJob, delay: float = 0.0):
+        self.enqueue_many([job], delay)
+
+    def enqueue_many(self, jobs: list[MailJob], delay: float = 0.0):
+        """Enqueue the jobs at once, so the worker picks them up together and
+        delivers them in one batch."""
+        # NOTE: Start the worker lazily, so it is created in the gunicorn
+        # worker process which actually serves requests.
+        self.start()
+        with self._condition:
+            due = time.monotonic() + delay
+            for job in jobs:
+                heapq.heappush(self._jobs, (due, next(self._sequence), job))
+            self._condition.notify_all()
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Block until every queued message was delivered or given up on.
+        Returns False if the timeout expired first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._jobs or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stats(self) -> MailQueueStats:
+        with self._condition:
+            return MailQueueStats(
+                depth=len(self._jobs) + self._busy,
+                delivered=self._delivered_count,
+                retried=self._retried_count,
+                failed=self._failed_count,
+                last_latency=self._last_latency,
+                max_latency=self._max_latency,
+            )
+
+    def _next_jobs(self) -> list[MailJob]:
+        with self._condition:
+            while self._jobs or not self._stopped:
+                if not self._jobs:
+                    self._condition.wait()
+                    continue
+
+                due = self._jobs[0][0]
+                now = time.monotonic()
+                if self._stopped:
+                    now = float("inf")  # deliver everything before exiting
+                elif due > now:
+                    self._condition.wait(due - now)
+                    continue
+
+                jobs = []
+                while (
+                    self._jobs
+                    and self._jobs[0][0] <= now
+                    and len(jobs) < self.batch_size
+                ):
+                    jobs.append(heapq.heappop(self._jobs)[2])
+                self._busy = len(jobs)
+                return jobs
+        return []
+
+    def _run(self):
+        while True:
+            jobs = self._next_jobs()
+            if not jobs:
+                return
+
+            try:
+                self._deliver(jobs)
+            finally:
+                with self._condition:
+                    self._busy = 0
+                    self._condition.notify_all()
+
+    def _deliver(self, jobs: list[MailJob]):
+        for job in jobs:
+            job.attempts += 1
+
+        # NOTE: The worker thread does not share the context of the requests,
+        # so their ids and spans are restored from the jobs.
+        request_ids = {job.request_id: None for job in jobs if job.request_id}
+        with log_context(request_id=",".join(request_ids) or None), span(
+            "mail_queue.deliver",
+            links=[job.trace for job in jobs if job.trace is not None],
+            messages=len(jobs),
+        ):
+            try:
+                results = self.mailer.send_many(
+                    [(job.message, job.to_addrs) for job in jobs]
+                )
+            except Exception as error:
+                results = [error] * len(jobs)
+
+            for job, error in zip(jobs, results):
+                if isinstance(error, RecipientsPartlyRefused):
+                    # NOTE: Retrying would send the message to the accepted
+                    # recipients again.
+                    logger.warning(
+                        f"'{job.message['Subject']}' was not delivered to"
+                        f" {error.refused}"
+                    )
+                    error = None
+                if error is None:
+                    self._delivered(job)
+                else:
+                    self._failed(job, error)
+
+    def _delivered(self, job: MailJob):
+        if job.spool_id is not None:
+            self.spool.done(job.spool_id)
+
+        latency = time.monotonic() - job.enqueued_at
+        MESSAGES.inc("delivered")
+        DELIVERY_SECONDS.observe(latency)
+        with self._condition:
+            self._delivered_count += 1
+            self._last_latency = latency
+            self._max_latency = max(self._max_latency or 0.0, latency)
+
+    def _failed(self, job: MailJob, error: Exception):
+        if job.attempts >= self.max_attempts or self._stopped:
+            logger.error(
+                f"Giving up on '{job.message['Subject']}' after"
+                f" {job.attempts} attempts: {error!r}"
+                + (
+                    " It stays in the spool."
+                    if job.spool_id is not None
+                    else " It is lost."
+                )
+            )
+            MESSAGES.inc("failed")
+            with self._condition:
+                self._failed_count += 1
+            return
+
+        delay = min(self.backoff * 2 ** (job.attempts - 1), self.max_backoff)
+        logger.warning(
+            f"Sending '{job.message['Subject']}' failed, retrying in"
+            f" {delay:.1f}s: {error!r}"
+        )
+        MESSAGES.inc("retried")
+        with self._condition:
+            self._retried_count += 1
+        self.enqueue(job, delay=delay)
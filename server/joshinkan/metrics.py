@@ -0,0 +1,335 @@
+"""Counters, gauges and histograms in the Prometheus text exposition format.
+
+Every gunicorn worker keeps its own metrics in memory. With a `directory`,
+each worker regularly writes a snapshot to `metrics-{pid}.json` in it, and
+`/metrics` adds up the snapshots of all workers. Counters and histograms of
+workers which have exited are kept, so totals never go down. Gauges only
+count for workers which are still running.
+See: https://prometheus.io/docs/instrumenting/exposition_formats/"""
+import abc
+import bisect
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Optional, Union
+
+from .logger import get_logger
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+"""Upper bounds in seconds of the latency histogram buckets."""
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = tuple[str, ...]
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    return ",".join(
+        f'{name}="{escape_label_value(str(value))}"'
+        for name, value in zip(names, values)
+    )
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric(abc.ABC):
+    type = ""
+
+    def __init__(self, name: str, help: str, label_names: LabelValues = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def snapshot(self) -> dict:
+        """A JSON serialisable copy of the values, keyed by the formatted
+        labels."""
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, label_names: LabelValues = ()):
+        super().__init__(name, help, label_names)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def value(self, *label_values: str) -> float:
+        return self._values.get(label_values, 0.0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                format_labels(self.label_names, labels): value
+                for labels, value in self._values.items()
+            }
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *label_values: str, amount: float = 1.0):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value: float, *label_values: str):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: LabelValues = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, label_names)
+        self.buckets = buckets
+        # NOTE: Per label values: the count of each bucket (not cumulative, the
+        # last one is +Inf), the sum and the count of observations.
+        self._values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = (
+                    [0] * (len(self.buckets) + 1),
+                    [0.0],
+                )
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    def count(self, *label_values: str) -> int:
+        entry = self._values.get(label_values)
+        return 0 if entry is None else sum(entry[0])
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                format_labels(self.label_names, labels): {
+                    "buckets": list(counts),
+                    "sum": total[0],
+                }
+                for labels, (counts, total) in self._values.items()
+            }
+
+
+class Registry:
+    """The metrics of one process. `collectors` are called on every scrape and
+    return gauge values which are cheaper to read on demand, i.e. the mail
+    queue depth."""
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.collectors: list[Callable[[], dict[str, float]]] = []
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls: type, name: str, *args, **kwargs) -> Metric:
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"The metric {name} is a {metric.type}")
+            return metric
+
+    def counter(self, name: str, help: str, label_names: LabelValues = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, label_names)
+
+    def gauge(self, name: str, help: str, label_names: LabelValues = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help, label_names)
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        label_names: LabelValues = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._get_or_create(Histogram, name, help, label_names, buckets)
+
+    def add_collector(self, collector: Callable[[], dict[str, float]]):
+        """Register a function which returns {gauge name: value}. The gauges
+        are reported without labels."""
+        self.collectors.append(collector)
+
+    def snapshot(self) -> dict:
+        metrics = {}
+        for name, metric in list(self.metrics.items()):
+            metrics[name] = {
+                "type": metric.type,
+                "help": metric.help,
+                "buckets": getattr(metric, "buckets", None),
+                "values": metric.snapshot(),
+            }
+        for collector in self.collectors:
+            try:
+                collected = collector()
+            except Exception as error:
+                # NOTE: The logger is looked up here, as the config imports
+                # this module before logging is set up.
+                get_logger(__name__).error(
+                    f"Metrics collector {collector} failed: {error!r}"
+                )
+                continue
+            for name, value in collected.items():
+                metrics[name] = {
+                    "type": "gauge",
+                    "help": "",
+                    "buckets": None,
+                    "values": {"": value},
+                }
+        return {"pid": os.getpid(), "metrics": metrics}
+
+
+REGISTRY = Registry()
+"""The registry of this process which the backend reports to."""
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SnapshotStore:
+    """Shares the snapshots of all worker processes through files in
+    `directory`. Writes are throttled to one per `interval` seconds."""
+
+    def __init__(self, directory: Union[str, Path], interval: float = 1.0):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.interval = interval
+        self._last_write = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def path(self) -> Path:
+        # NOTE: Not cached, the pid changes when gunicorn forks the workers.
+        return self.directory / f"metrics-{os.getpid()}.json"
+
+    def write(self, registry: Registry, force: bool = False):
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_write < self.interval:
+                return
+            self._last_write = now
+
+        path = self.path
+        temporary = path.with_suffix(".tmp")
+        temporary.write_text(json.dumps(registry.snapshot()), encoding="utf8")
+        os.replace(temporary, path)
+
+    def read_all(self) -> list[dict]:
+        snapshots = []
+        for path in sorted(self.directory.glob("metrics-*.json")):
+            try:
+                snapshot = json.loads(path.read_text(encoding="utf8"))
+            except (OSError, ValueError):
+                continue  # removed or replaced in the meantime
+            if snapshot["pid"] != os.getpid() and not is_running(snapshot["pid"]):
+                snapshot["metrics"] = {
+                    name: metric
+                    for name, metric in snapshot["metrics"].items()
+                    if metric["type"] != "gauge"
+                }
+            snapshots.append(snapshot)
+        return snapshots
+
+    def clear(self):
+        """Remove the snapshots of a previous run."""
+        for path in self.directory.glob("metrics-*.json"):
+            path.unlink(missing_ok=True)
+
+
+def merge(snapshots: list[dict]) -> dict:
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot["metrics"].items():
+            target = merged.setdefault(
+                name,
+                {
+                    "type": metric["type"],
+                    "help": metric["help"],
+                    "buckets": metric["buckets"],
+                    "values": {},
+                },
+            )
+            for labels, value in metric["values"].items():
+                if metric["type"] != "histogram":
+                    target["values"][labels] = target["values"].get(labels, 0.0) + value
+                elif labels not in target["values"]:
+                    target["values"][labels] = {
+                        "buckets": list(value["buckets"]),
+                        "sum": value["sum"],
+                    }
+                else:
+                    existing = target["values"][labels]
+                    existing["buckets"] = [
+                        a + b for a, b in zip(existing["buckets"], value["buckets"])
+                    ]
+                    existing["sum"] += value["sum"]
+    return merged
+
+
+def with_label(labels: str, name: str, value: str) -> str:
+    label = format_labels([name], [value])
+    return f"{labels},{label}" if labels else label
+
+
+def braces(labels: str) -> str:
+    return f"{{{labels}}}" if labels else ""
+
+
+def render(metrics: dict) -> str:
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        if metric["help"]:
+            lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for labels, value in sorted(metric["values"].items()):
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{braces(labels)} {format_value(value)}")
+                continue
+
+            cumulative = 0
+            bounds = list(metric["buckets"]) + [float("inf")]
+            for bound, count in zip(bounds, value["buckets"]):
+                cumulative += count
+                bucket_labels = with_label(labels, "le", format_value(bound))
+                lines.append(f"{name}_bucket{braces(bucket_labels)} {cumulative}")
+            lines.append(f"{name}_sum{braces(labels)} {format_value(value['sum'])}")
+            lines.append(f"{name}_count{braces(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def exposition(registry: Registry, store: Optional[SnapshotStore] = None) -> str:
+    """The metrics of this process, or of all workers with a `store`, in the
+    text exposition format."""
+    if store is None:
+        return render(merge([registry.snapshot()]))
+    store.write(registry, force=True)
+    return render(merge(store.read_all()))
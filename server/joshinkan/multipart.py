@@ -1,13 +1,20 @@
 import re
-from typing import Union, Optional
+from io import BytesIO
+from typing import BinaryIO, Iterator, Union, Optional
 
+DEFAULT_CHUNK_SIZE = 16 * 1024
+"""Number of bytes read from the input stream at once."""
 
-def parse(body: str, content_type: str) -> Optional[dict[str, Union[str, list[str]]]]:
-    boundary_pattern = re.compile(
-        r"^multipart\/form-data;\s*boundary=(?P<boundary>.+)$"
-    )
-    name_pattern = re.compile(r'^form-data;\s?name\s?=\s?"(?P<name>.+)"$')
+DEFAULT_MAX_FIELD_SIZE = 1024 * 1024
+"""Maximum size in bytes of a single field value."""
 
+MAX_HEADER_LINE_SIZE = 8 * 1024
+
+boundary_pattern = re.compile(r"^multipart\/form-data;\s*boundary=(?P<boundary>.+)$")
+name_pattern = re.compile(r'^form-data;\s?name\s?=\s?"(?P<name>.+)"$')
+
+
+def parse_boundary(content_type: str) -> bytes:
     parsed_content_type = boundary_pattern.match(content_type)
 
     if parsed_content_type is None:
@@ -17,40 +24,121 @@ def parse(body: str, content_type: str) -> Optional[dict[str, Union[str, list[st
     if boundary is None:
         raise ValueError("Could not parse 'boundary' from content_type")
 
-    components = [
-        component
-        for component in (
-            component.strip() for component in body.split("--" + boundary)
-        )
-        if component != ""
-    ]
-    if len(components) < 2:
-        raise ValueError(f"Boundary not found in body: {boundary}")
-    if components[-1] != "--":
-        raise ValueError("Invalid end boundary")
+    return boundary.encode("utf8")
 
-    form_data = {}
 
-    # NOTE(sven): Skip the the last component which are double hyphens.
-    for i in range(len(components) - 1):
-        component = components[i]
-        parts = component.splitlines()
-        headers = {}
+class _Reader:
+    """A buffer over a binary stream which is filled in chunks on demand."""
+
+    def __init__(self, stream: BinaryIO, chunk_size: int):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.eof = False
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer += chunk
+        return True
+
+    def startswith(self, prefix: bytes) -> bool:
+        while len(self.buffer) < len(prefix) and self.fill():
+            pass
+        return self.buffer.startswith(prefix)
+
+    def read_line(self) -> Optional[bytes]:
+        """Read a line without its line break. Returns None if the stream
+        ends before the next line break."""
+        start = 0
+        while (end := self.buffer.find(b"\n", start)) < 0:
+            if len(self.buffer) > MAX_HEADER_LINE_SIZE:
+                raise ValueError("Line exceeds the maximum header size")
+            start = len(self.buffer)
+            if not self.fill():
+                return None
+
+        line = bytes(self.buffer[:end])
+        del self.buffer[: end + 1]
+        return line.rstrip(b"\r")
+
+    def read_until(self, marker: bytes, limit: Optional[int] = None) -> Optional[bytes]:
+        """Read up to the next occurence of `marker` and consume the marker.
+        Returns None if the stream ends before. Only `len(marker)` bytes which
+        might be the beginning of the marker are kept in the buffer while
+        scanning, the rest is moved into the result."""
+        result = bytearray()
+        while (position := self.buffer.find(marker)) < 0:
+            keep = len(marker) - 1
+            if len(self.buffer) > keep:
+                result += self.buffer[:-keep]
+                del self.buffer[:-keep]
+                if limit is not None and len(result) > limit:
+                    raise ValueError(f"Field exceeds the maximum size of {limit} bytes")
+            if not self.fill():
+                return None
+
+        result += self.buffer[:position]
+        del self.buffer[: position + len(marker)]
+        if limit is not None and len(result) > limit:
+            raise ValueError(f"Field exceeds the maximum size of {limit} bytes")
+        return bytes(result)
+
 
-        for part_index, header_line in enumerate(parts):
-            if header_line == "":
+def iter_fields(
+    stream: BinaryIO,
+    content_type: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_field_size: int = DEFAULT_MAX_FIELD_SIZE,
+) -> Iterator[tuple[str, str]]:
+    """Parse multipart/form-data from a binary stream in a single pass. Yields
+    (name, value) pairs as soon as a field is complete, so only the current
+    field and one chunk are held in memory."""
+    boundary = parse_boundary(content_type)
+    delimiter = b"--" + boundary
+    reader = _Reader(stream, chunk_size)
+    # NOTE: Prepend a line break, so the first delimiter can be found with the
+    # same marker as the delimiters between parts.
+    reader.buffer += b"\n"
+    marker = b"\n" + delimiter
+
+    if reader.read_until(marker, limit=max_field_size) is None:
+        raise ValueError(f"Boundary not found in body: {boundary.decode('utf8')}")
+
+    index = 0
+    while True:
+        if reader.startswith(b"--"):
+            return  # the closing delimiter
+
+        line = reader.read_line()
+        if line is None:
+            raise ValueError("Invalid end boundary")
+        if line.strip() != b"":
+            raise ValueError(f"Unexpected content after the boundary of part {index}")
+
+        headers = {}
+        while True:
+            header_line = reader.read_line()
+            if header_line is None:
+                raise ValueError("Invalid end boundary")
+            if header_line == b"":
                 break
             try:
-                key, value = header_line.split(":", maxsplit=1)
+                key, value = header_line.decode("utf8").split(":", maxsplit=1)
             except ValueError:
                 raise ValueError(
-                    f"Part {i} does not specify content disposition header"
+                    f"Part {index} does not specify content disposition header"
                 )
             headers[key.casefold()] = value.strip()
-        part_index += 1
 
         if "content-disposition" not in headers:
-            raise ValueError(f"Part {i} does not specify content disposition header")
+            raise ValueError(
+                f"Part {index} does not specify content disposition header"
+            )
 
         # i.e. form-data; name=\"first_name\"
         parsed_name = name_pattern.match(headers["content-disposition"])
@@ -64,17 +152,42 @@ def parse(body: str, content_type: str) -> Optional[dict[str, Union[str, list[st
         ), f"Could not parse name from content-disposition header: {headers['content-disposition']}"
         name = name.strip()
 
+        part_body = reader.read_until(marker, limit=max_field_size)
+        if part_body is None:
+            raise ValueError("Invalid end boundary")
+
         # TODO(sven): This potentially erases bespoke linebreaks from the
         # content. I don't see a usecase yet but this is something to be aware
         # of.
-        part_body = "\n".join(parts[part_index:])
+        value = "\n".join(part_body.decode("utf8").splitlines()).rstrip()
 
+        yield name, value
+        index += 1
+
+
+def parse_stream(
+    stream: BinaryIO,
+    content_type: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_field_size: int = DEFAULT_MAX_FIELD_SIZE,
+) -> dict[str, Union[str, list[str]]]:
+    form_data = {}
+
+    for name, value in iter_fields(stream, content_type, chunk_size, max_field_size):
         if name.endswith("[]"):
             stripped_name = name.rstrip("[]")
             if stripped_name not in form_data:
                 form_data[stripped_name] = []
-            form_data[stripped_name].append(part_body)
+            form_data[stripped_name].append(value)
         else:
-            form_data[name] = part_body
+            form_data[name] = value
 
     return form_data
+
+
+def parse(
+    body: Union[str, bytes], content_type: str
+) -> Optional[dict[str, Union[str, list[str]]]]:
+    if isinstance(body, str):
+        body = body.encode("utf8")
+    return parse_stream(BytesIO(body), content_type)
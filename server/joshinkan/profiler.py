@@ -0,0 +1,254 @@
+"""A sampling profiler which can stay enabled in production.
+
+A background thread periodically reads the stack of threads which are being
+profiled with `sys._current_frames`, so the profiled code itself does not
+run any slower. Stacks are profiled either for a random fraction of requests
+or, after a signal, for all threads during a time window. Each worker
+accumulates the samples in `profile-{pid}.folded`, in the collapsed stack
+format of flamegraph.pl, speedscope and inferno:
+
+    main (app.py:12);handle (httpd.py:1058);trial_registration (routes.py:99) 42
+"""
+import _thread
+import atexit
+import os
+import random
+import signal
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+from types import CodeType, FrameType
+from typing import Optional, Union
+
+from .httpd import AsyncHandler, Handler, HTTPResponse, Middleware, WSGIEnv
+
+try:
+    from gevent.monkey import get_original
+except ImportError:
+    get_original = None
+
+# NOTE: The gevent workers patch threads into greenlets. The sampler must be a
+# real thread though, otherwise it only runs when a request yields and never
+# sees the code which keeps the worker busy.
+if get_original is not None:
+    start_new_thread, allocate_lock, get_ident = get_original(
+        "_thread", ["start_new_thread", "allocate_lock", "get_ident"]
+    )
+    sleep = get_original("time", "sleep")
+else:
+    start_new_thread = _thread.start_new_thread
+    allocate_lock = _thread.allocate_lock
+    get_ident = _thread.get_ident
+    sleep = time.sleep
+
+DEFAULT_INTERVAL = 0.005
+"""Seconds between two samples of a profiled thread."""
+
+IDLE_INTERVAL = 0.1
+"""Seconds between checks for new work while nothing is profiled."""
+
+FLUSH_INTERVAL = 10.0
+"""Seconds between writes of the profile file while samples are taken."""
+
+
+def frame_label(code: CodeType) -> str:
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+class Profiler:
+    """Samples the stacks of profiled threads into a collapsed stack file in
+    `directory`. Profile a thread with `enter` and `exit` around the code of
+    interest, or every thread for a while with `profile_for`.
+
+    NOTE: With gevent, all requests of a worker share one thread. A sample of
+    a profiled request shows whichever greenlet runs at that moment, which is
+    mostly, but not always, the profiled request."""
+
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        sample_rate: float = 0.0,
+        interval: float = DEFAULT_INTERVAL,
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+
+        self._threads: Counter[int] = Counter()
+        self._window_end = 0.0
+        self._labels: dict[CodeType, str] = {}
+        self._dirty = False
+        self._lock = allocate_lock()
+        self._sampler_pid: Optional[int] = None
+        self._sampler_ident: Optional[int] = None
+        self._stopped = False
+
+    @property
+    def path(self) -> Path:
+        # NOTE: Not cached, the pid changes when gunicorn forks the workers.
+        return self.directory / f"profile-{os.getpid()}.folded"
+
+    @property
+    def active(self) -> bool:
+        return bool(self._threads) or time.monotonic() < self._window_end
+
+    def should_sample(self) -> bool:
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def enter(self, ident: Optional[int] = None):
+        """Start profiling the current thread, or the thread `ident`. Calls
+        nest, the thread is profiled until the matching number of `exit`s."""
+        if ident is None:
+            ident = get_ident()
+        self._ensure_sampler()
+        with self._lock:
+            self._threads[ident] += 1
+
+    def exit(self, ident: Optional[int] = None):
+        if ident is None:
+            ident = get_ident()
+        with self._lock:
+            self._threads[ident] -= 1
+            if self._threads[ident] <= 0:
+                del self._threads[ident]
+
+    def profile_for(self, seconds: float):
+        """Profile all threads for the next `seconds`.
+
+        NOTE: Called from signal handlers, so it must not take the lock."""
+        self._window_end = time.monotonic() + seconds
+        self._ensure_sampler()
+
+    def collapse(self, frame: FrameType) -> str:
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = frame_label(code)
+            labels.append(label)
+            frame = frame.f_back
+        return ";".join(reversed(labels))
+
+    def sample(self):
+        frames = sys._current_frames()
+        if time.monotonic() < self._window_end:
+            idents = [ident for ident in frames if ident != self._sampler_ident]
+        else:
+            with self._lock:
+                idents = list(self._threads)
+
+        stacks = [self.collapse(frames[ident]) for ident in idents if ident in frames]
+        if not stacks:
+            return
+        with self._lock:
+            self.stacks.update(stacks)
+            self.samples += len(stacks)
+            self._dirty = True
+
+    def flush(self):
+        """Write all samples of this process to `path`."""
+        # NOTE: Copy the samples under the lock, flush also runs at exit while
+        # the sampler thread may still add samples.
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            stacks = list(self.stacks.items())
+        path = self.path
+        temporary = path.with_suffix(".tmp")
+        temporary.write_text(
+            "".join(f"{stack} {count}\n" for stack, count in stacks),
+            encoding="utf8",
+        )
+        os.replace(temporary, path)
+
+    def stop(self):
+        """Stop the sampler thread and write the remaining samples."""
+        self._stopped = True
+        self.flush()
+
+    def _ensure_sampler(self):
+        # NOTE: Threads do not survive a fork, so every worker starts its own.
+        if self._sampler_pid == os.getpid():
+            return
+        self._sampler_pid = os.getpid()
+        self._stopped = False
+        self.stacks.clear()
+        self.samples = 0
+        start_new_thread(self._run, ())
+        atexit.register(self.stop)
+
+    def _run(self):
+        self._sampler_ident = get_ident()
+        last_flush = time.monotonic()
+        while not self._stopped:
+            if not self.active:
+                if self._dirty:
+                    self.flush()
+                sleep(IDLE_INTERVAL)
+                continue
+
+            self.sample()
+            if time.monotonic() - last_flush > FLUSH_INTERVAL:
+                self.flush()
+                last_flush = time.monotonic()
+            sleep(self.interval)
+
+
+def profiling(profiler: Profiler) -> Middleware:
+    """A middleware which profiles a random `profiler.sample_rate` fraction of
+    requests."""
+
+    def wrap(handle: Handler) -> Handler:
+        def handle_profiled(environ: WSGIEnv) -> HTTPResponse:
+            if not profiler.should_sample():
+                return handle(environ)
+            ident = get_ident()
+            profiler.enter(ident)
+            try:
+                return handle(environ)
+            finally:
+                profiler.exit(ident)
+
+        return handle_profiled
+
+    def wrap_async(handle: AsyncHandler) -> AsyncHandler:
+        async def handle_profiled(environ: WSGIEnv) -> HTTPResponse:
+            if not profiler.should_sample():
+                return await handle(environ)
+            # NOTE: Samples the event loop thread, which includes other
+            # requests running concurrently.
+            ident = get_ident()
+            profiler.enter(ident)
+            try:
+                return await handle(environ)
+            finally:
+                profiler.exit(ident)
+
+        return handle_profiled
+
+    return Middleware(wrap=wrap, wrap_async=wrap_async)
+
+
+def install_signal_handler(
+    profiler: Profiler, seconds: float, signum: int = signal.SIGUSR2
+) -> bool:
+    """Profile all threads for `seconds` whenever the process receives
+    `signum`, i.e. `kill -USR2 <worker pid>`. Returns False if the handler
+    cannot be installed because this is not the main thread."""
+
+    def on_signal(signum, frame):
+        profiler.profile_for(seconds)
+
+    try:
+        signal.signal(signum, on_signal)
+    except ValueError:
+        return False
+    return True
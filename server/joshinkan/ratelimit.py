@@ -0,0 +1,136 @@
+"""Token bucket rate limits which all gunicorn workers share.
+
+The buckets live in a fixed-size table in a memory mapped file. The table is
+set-associative: a key hashes to a set of `WAYS` slots, so a check reads at
+most `WAYS` slots. When a set is full, its least recently used slot is
+evicted. An evicted key starts over with a full bucket, which errs on the
+side of letting clients through."""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+from .httpd import TooManyRequests, WSGIEnv
+
+# NOTE: Key hash (0 marks an empty slot), tokens left and the time of the last
+# check. Wall clock time, as the table is shared between processes.
+SLOT = struct.Struct("<Qdd")
+WAYS = 8
+TABLE_NAME = "ratelimit.table"
+
+
+def hash_key(key: str) -> int:
+    digest = hashlib.blake2b(key.encode("utf8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+class BucketTable:
+    """A fixed-size table of token buckets. Pass a `directory` to share the
+    table between processes, otherwise it is private to this process."""
+
+    def __init__(self, directory: Union[str, Path, None] = None, slots: int = 4096):
+        self.sets = max(1, slots // WAYS)
+        size = self.sets * WAYS * SLOT.size
+        self._lock = threading.Lock()
+        self._fd: Optional[int] = None
+        if directory is None:
+            self._map = mmap.mmap(-1, size)
+            return
+
+        path = Path(directory)
+        path.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(path / TABLE_NAME, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked():
+            # NOTE: A table of another size is from a different configuration.
+            if os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        # NOTE: flock excludes other processes, the lock other threads of
+        # this one. Both are held for a handful of slot reads only.
+        with self._lock:
+            if self._fd is None:
+                yield
+                return
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def take(
+        self, key: str, capacity: float, rate: float, now: Optional[float] = None
+    ) -> float:
+        """Take a token from the bucket of `key`, which holds up to `capacity`
+        tokens and refills `rate` tokens per second. Returns 0 if there was a
+        token, otherwise the seconds until there is one."""
+        key_hash = hash_key(key)
+        now = time.time() if now is None else now
+        first = (key_hash % self.sets) * WAYS
+
+        with self._locked():
+            victim, victim_updated = first, float("inf")
+            for slot in range(first, first + WAYS):
+                slot_hash, tokens, updated = SLOT.unpack_from(
+                    self._map, slot * SLOT.size
+                )
+                if slot_hash == key_hash:
+                    tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+                    break
+                if slot_hash == 0:
+                    updated = float("-inf")  # empty slots are used first
+                if updated < victim_updated:
+                    victim, victim_updated = slot, updated
+            else:
+                slot, tokens = victim, capacity
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / rate
+            SLOT.pack_into(self._map, slot * SLOT.size, key_hash, tokens, now)
+        return wait
+
+    def close(self):
+        self._map.close()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class RateLimiter:
+    """Allows `burst` requests per key at once and `per_hour` requests per
+    hour on average."""
+
+    def __init__(self, table: BucketTable, burst: int, per_hour: float):
+        self.table = table
+        self.capacity = burst
+        self.rate = per_hour / 3600
+
+    def check(self, key: str) -> float:
+        """Returns 0 if a request of `key` is allowed, otherwise the seconds
+        until it is."""
+        return self.table.take(key, self.capacity, self.rate)
+
+    def limit(self, key: str):
+        """Raise `TooManyRequests` unless a request of `key` is allowed. The
+        app answers it with 429 and a Retry-After header."""
+        wait = self.check(key)
+        if wait > 0:
+            raise TooManyRequests(wait)
+
+
+def client_address(environ: WSGIEnv) -> str:
+    """The client's address, which nginx passes in the X-Real-IP header.
+    Without nginx in front, clients can set the header themselves."""
+    return environ.get("HTTP_X_REAL_IP") or environ.get("REMOTE_ADDR", "")
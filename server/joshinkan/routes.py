@@ -1,14 +1,25 @@
-from dataclasses import dataclass
-from email.message import EmailMessage
-import os
-import textwrap
+from dataclasses import dataclass, field
+from typing import Optional, Union
 
 from .config import Config
-from .httpd import Router, Response, expect_json, Request, Status
-from .validation import Schema, DictOf, Values, OptionalKey, ListOf
+from .httpd import (
+    Router,
+    Response,
+    expect_json,
+    Request,
+    Status,
+    validation_errors,
+    validation_phase,
+)
+from .validation import Schema, DictOf, Values, OptionalKey, ListOf, OneOf
 from .logger import get_logger
 from joshinkan import multipart
-from .smtp import SMTP, EmailUser, Mailer
+from .smtp import SMTP, EmailUser, Mailer, RecipientsPartlyRefused
+from .mailqueue import MailQueue
+from .idempotency import FileStore, IdempotencyCache, MemoryStore, request_key
+from .ratelimit import BucketTable, RateLimiter, client_address
+from .spool import Spool
+from .templating import Markup, Templates
 
 logger = get_logger(__name__)
 router = Router()
@@ -39,10 +50,45 @@ CHILDREN_SCHEMA = Schema(
     }
 )
 
+# NOTE: Any of the children fields marks a children registration. Validating
+# only the matching schema also picks the error to report.
+REGISTRATION_SCHEMA = OneOf(
+    {
+        "child_first_name": CHILDREN_SCHEMA,
+        "child_last_name": CHILDREN_SCHEMA,
+        "child_age": CHILDREN_SCHEMA,
+    },
+    default=ADULT_SCHEMA,
+).compile()
+
+REQUIRED_MAILS = (
+    "registration_adult",
+    "registration_children",
+    "acknowledgement_adult",
+    "acknowledgement_children",
+)
+REQUIRED_PARTIALS = ("child",)
+
 
 @dataclass
 class AppContext:
-    mailer: Mailer
+    mailer: Union[Mailer, MailQueue]
+    """Either sends emails right away or, when a `MailQueue`, in the
+    background. Both share the `send` interface."""
+
+    templates: Templates = field(default_factory=Templates)
+    """The email templates, compiled when the app is built."""
+
+    rate_limiter: Optional[RateLimiter] = None
+    """Throttles registrations per client address and per email address."""
+
+    idempotency: Optional[IdempotencyCache] = None
+    """Answers repeated registrations with the response of the first one."""
+
+    def __post_init__(self):
+        # NOTE: Fail when the app is built rather than on the first
+        # registration, i.e. when the templates were not installed.
+        self.templates.require(mails=REQUIRED_MAILS, partials=REQUIRED_PARTIALS)
 
     @staticmethod
     def from_config(config: Config) -> "AppContext":
@@ -51,164 +97,175 @@ class AppContext:
             port=config.SMTP_PORT,
             user=config.SMTP_USER,
             password=config.SMTP_PASSWORD,
+            pool_size=config.SMTP_POOL_SIZE,
+            idle_timeout=config.SMTP_POOL_IDLE_TIMEOUT,
+        )
+        if config.MAIL_QUEUE:
+            if not config.MAIL_SPOOL_DIR:
+                logger.warning(
+                    "MAIL_QUEUE without MAIL_SPOOL_DIR: Queued emails are lost"
+                    " when the worker dies before it delivered them."
+                )
+            mailer = MailQueue(
+                mailer,
+                max_attempts=config.MAIL_QUEUE_MAX_ATTEMPTS,
+                backoff=config.MAIL_QUEUE_BACKOFF,
+                spool=Spool(config.MAIL_SPOOL_DIR) if config.MAIL_SPOOL_DIR else None,
+            )
+        rate_limiter = None
+        if config.RATE_LIMIT_BURST > 0:
+            rate_limiter = RateLimiter(
+                BucketTable(config.RATE_LIMIT_DIR),
+                burst=config.RATE_LIMIT_BURST,
+                per_hour=config.RATE_LIMIT_PER_HOUR,
+            )
+        idempotency = None
+        if config.IDEMPOTENCY_TTL > 0:
+            idempotency = IdempotencyCache(
+                config.IDEMPOTENCY_TTL,
+                FileStore(config.IDEMPOTENCY_DIR)
+                if config.IDEMPOTENCY_DIR
+                else MemoryStore(),
+            )
+        return AppContext(
+            mailer=mailer, rate_limiter=rate_limiter, idempotency=idempotency
+        )
+
+    def reconfigure(self, config: Config):
+        """Apply settings which can change while the app runs, i.e. rotated
+        SMTP credentials after a config reload."""
+        mailer = (
+            self.mailer.mailer if isinstance(self.mailer, MailQueue) else self.mailer
+        )
+        mailer.reconfigure(
+            host=config.SMTP_HOST,
+            port=config.SMTP_PORT,
+            user=config.SMTP_USER,
+            password=config.SMTP_PASSWORD,
         )
-        return AppContext(mailer=mailer)
+
+    def restore(self):
+        """Resend emails which previous workers did not deliver."""
+        if isinstance(self.mailer, MailQueue):
+            self.mailer.restore()
+
+
+def join_names(names: list[str]) -> str:
+    if len(names) == 1:
+        return names[0]
+    return ", ".join(names[:-1]) + " und " + names[-1]
 
 
 def host_domain(request: Request) -> str:
     return request.environ["HTTP_ORIGIN"]
 
 
-@router.post("/trial-registration")
+@router.post("/trial-registration", max_body_size=64 * 1024)
 @router.with_context()
 @router.with_config()
 def trial_registration(
     request: Request, context: AppContext, config: Config
 ) -> Response:
-    domain = host_domain(request)
+    # NOTE: Every registration sends two emails through our SMTP account.
+    # Throttle clients before their body is even read.
+    if context.rate_limiter is not None:
+        context.rate_limiter.limit(f"ip:{client_address(request.environ)}")
+
     form_data = request.form_data()
     if form_data is None:
         return Status.BAD_REQUEST, {"message": "Invalid form data"}
 
-    adult_valid, adult_error = ADULT_SCHEMA.validate(form_data)
-    child_valid, child_error = CHILDREN_SCHEMA.validate(form_data)
+    if context.idempotency is None:
+        return register(request, form_data, context, config)
+    # NOTE: Double clicks submit the same form twice. Only the first one
+    # sends emails, the others get its response.
+    return context.idempotency.run(
+        request_key(request, form_data),
+        lambda: register(request, form_data, context, config),
+    )
 
-    if not adult_valid and not child_valid:
-        if (
-            "child_first_name" in form_data
-            or "child_last_name" in form_data
-            or "child_age" in form_data
-        ):
-            error = child_error
-        else:
-            error = adult_error
 
-        return Status.BAD_REQUEST, {"message": error.message}
+def register(
+    request: Request, form_data: dict, context: AppContext, config: Config
+) -> Response:
+    with validation_phase(request) as validation_span:
+        valid, errors = REGISTRATION_SCHEMA.validate_all(form_data)
+        validation_span.set_attribute("valid", valid)
+    if not valid:
+        return Status.BAD_REQUEST, validation_errors(errors)
 
     first_name = form_data["first_name"]
     last_name = form_data["last_name"]
     email = form_data["email"]
     phone = form_data["phone"]
+    if context.rate_limiter is not None:
+        context.rate_limiter.limit(f"email:{email.strip().lower()}")
+    domain = host_domain(request)
+    templates = context.templates
 
-    if child_valid:
-
-        def make_block(index: int) -> str:
-            first_name = form_data["child_first_name"][index]
-            last_name = form_data["child_last_name"][index]
-            age = form_data["child_age"][index]
-
-            return f"""
-            <b>Kind #{index+1}</b><br/>
-            Name: {first_name} {last_name}<br/>
-            Alter: {age}<br/>
-            """
-
-        num_children = len(form_data["child_first_name"])
-        blocks = "\n<br/>".join(make_block(i) for i in range(num_children))
-
-        message = EmailMessage()
-        message.set_content(
-            f"""
-            Neuanmeldung zum Probetraining für <b>Kinder</b>.<br/>
-            <br/>
-            {blocks}
-            <br/>
-            <b>Elternteil</b><br/>
-            Name: {first_name} {last_name}<br/>
-            Email: {email}<br/>
-            Telefon: {phone}<br/>
-            """,
-            subtype="html",
-        )
+    reply_to = str(config.SMTP_REPLY_TO or config.SMTP_USER)
+    headers = {"From": str(config.SMTP_USER)}
+    if config.SMTP_CC:
+        headers["Cc"] = ", ".join(str(e) for e in config.SMTP_CC)
 
-        message["Subject"] = f"Anmeldung zum Probetraining: Kinder ({num_children})"
-        message["From"] = str(config.SMTP_USER)
-        message["To"] = str(config.SMTP_REPLY_TO or config.SMTP_USER)
-        message["Cc"] = [str(e) for e in config.SMTP_CC]
-        context.mailer.send(
-            message, to_addrs=[config.SMTP_USER] + config.SMTP_CC + config.SMTP_BCC
+    if "child_first_name" in form_data:
+        child_first_names = form_data["child_first_name"]
+        child = templates.partial("child")
+        children = Markup(
+            "<br/>\n".join(
+                child.render(
+                    number=index + 1,
+                    first_name=child_first_name,
+                    last_name=form_data["child_last_name"][index],
+                    age=form_data["child_age"][index],
+                )
+                for index, child_first_name in enumerate(child_first_names)
+            )
         )
-
-        def make_names(names: list[str]) -> str:
-            if len(names) == 1:
-                return names[0]
-            else:
-                return ", ".join(names[:-1]) + " und " + names[-1]
-
-        ack_message = EmailMessage()
-        ack_message.set_content(
-            textwrap.dedent(
-                f"""\
-                Liebe Familie {last_name},<br/>
-                <br/>
-                Vielen Dank für die Anmeldung von {make_names(form_data["child_first_name"])} zum Probetraining.<br/>
-                <br/>
-                Einer unserer Trainer wird sich in Kürze bei euch melden und die Anmeldung mit einem Termin zum ersten Training bestätigen. Falls ihr in der Zwischenzeit weitere Fragen habt, findet ihr Infos <a href="{domain}/kontakt">hier</a>.<br/>
-                <br/>
-                Liebe Grüße,<br/>
-                Das Joshinkan Team<br/>
-                """
-            ),
-            subtype="html",
+        message = templates.mail("registration_children").message(
+            {**headers, "To": reply_to},
+            num_children=len(child_first_names),
+            children=children,
+            first_name=first_name,
+            last_name=last_name,
+            email=email,
+            phone=phone,
         )
-
-        user_email = EmailUser(name=f"{first_name} {last_name}", email=email)
-        ack_message["From"] = str(config.SMTP_USER)
-        ack_message["To"] = str(user_email)
-        ack_message["Cc"] = [str(e) for e in config.SMTP_CC]
-        ack_message["Reply-To"] = str(config.SMTP_REPLY_TO or config.SMTP_USER)
-        ack_message["Subject"] = "Joshinkan Werder Karate - Anmeldung zum Probetraining"
-        context.mailer.send(
-            ack_message, to_addrs=[user_email] + config.SMTP_CC + config.SMTP_BCC
+        ack_message = templates.mail("acknowledgement_children").message(
+            {**headers, "Reply-To": reply_to},
+            last_name=last_name,
+            children_names=join_names(child_first_names),
+            domain=domain,
         )
-
-        return Status.OK, {"message": "Email sent."}
-    elif adult_valid:
-        age = form_data["age"]
-
-        message = EmailMessage()
-        message["From"] = str(config.SMTP_USER)
-        message["To"] = str(config.SMTP_REPLY_TO or config.SMTP_USER)
-        message["Cc"] = [str(e) for e in config.SMTP_CC]
-        message["Subject"] = "Anmeldung zum Probetraining: Erwachsene"
-        message.set_content(
-            f"""
-            Neuanmeldung zum Probetraining für <b>Erwachsene</b>.<br/>
-            <br/>
-            Name: {first_name} {last_name}<br/>
-            Alter: {age}<br/>
-            Email: {email}<br/>
-            Telefon: {phone}<br/>
-        """,
-            subtype="html",
+    else:
+        message = templates.mail("registration_adult").message(
+            {**headers, "To": reply_to},
+            first_name=first_name,
+            last_name=last_name,
+            age=form_data["age"],
+            email=email,
+            phone=phone,
         )
-        context.mailer.send(
-            message, to_addrs=[config.SMTP_USER] + config.SMTP_CC + config.SMTP_BCC
+        ack_message = templates.mail("acknowledgement_adult").message(
+            {**headers, "Reply-To": reply_to},
+            first_name=first_name,
+            domain=domain,
         )
 
-        user_email = EmailUser(name=f"{first_name} {last_name}", email=email)
-        ack_message = EmailMessage()
-        ack_message["From"] = str(config.SMTP_USER)
-        ack_message["To"] = str(user_email)
-        ack_message["Cc"] = [str(e) for e in config.SMTP_CC]
-        ack_message["Reply-To"] = str(config.SMTP_REPLY_TO or config.SMTP_USER)
-        ack_message["Subject"] = "Joshinkan Werder Karate - Anmeldung zum Probetraining"
-        ack_message.set_content(
-            f"""
-            Hallo {first_name},<br/>
-            <br/>
-            Vielen Dank für die Anmeldung zum Probetraining.<br/>
-            <br/>
-            Einer unserer Trainer wird sich in Kürze bei dir melden und die Anmeldung mit
-            einem Termin zum ersten Training bestätigen. Falls du in der Zwischenzeit
-            weitere Fragen hast, findest du Infos <a href="{domain}/kontakt">hier</a>.<br/>
-            <br/>
-            Liebe Grüße,<br/>
-            Das Joshinkan Team<br/>
-        """,
-            subtype="html",
-        )
-        context.mailer.send(
-            ack_message, to_addrs=[user_email] + config.SMTP_CC + config.SMTP_BCC
-        )
-        return Status.OK, {"message": "Email sent."}
+    user_email = EmailUser(name=f"{first_name} {last_name}", email=email)
+    ack_message["To"] = str(user_email)
+
+    # NOTE: Send both emails over a single SMTP session.
+    errors = context.mailer.send_many(
+        [
+            (message, [config.SMTP_USER, *config.SMTP_CC, *config.SMTP_BCC]),
+            (ack_message, [user_email, *config.SMTP_CC, *config.SMTP_BCC]),
+        ]
+    )
+    for error in errors:
+        if isinstance(error, RecipientsPartlyRefused):
+            logger.warning(f"Some recipients were refused: {error.refused}")
+        elif error is not None:
+            raise error
+
+    return Status.OK, {"message": "Email sent."}
@@ -1,8 +1,34 @@
-from smtplib import SMTP
+import asyncio
+from smtplib import (
+    SMTP,
+    SMTPDataError,
+    SMTPException,
+    SMTPRecipientsRefused,
+    SMTPSenderRefused,
+    SMTPServerDisconnected,
+)
+import email.policy
 import re
+import threading
+import time
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Optional
+from functools import lru_cache
+from typing import Iterator, Optional
+from email.headerregistry import BaseHeader
 from email.message import EmailMessage
+from email.utils import getaddresses
+
+from .metrics import REGISTRY
+from .tracing import SPAN_KIND_CLIENT, span
+
+SEND_SECONDS = REGISTRY.histogram(
+    "joshinkan_smtp_send_seconds",
+    "Time to send a batch of emails, including the SMTP handshakes.",
+)
+MESSAGES = REGISTRY.counter(
+    "joshinkan_smtp_messages_total", "Emails by result.", ("result",)
+)
 
 
 @dataclass
@@ -54,17 +80,311 @@ class EmailUser:
         return cls(name=name, email=email)
 
 
+# NOTE: `SMTP.send_message` flattens with the message's policy and CRLF line
+# endings, so prepared messages match its output byte for byte.
+SMTP_POLICY = email.policy.default.clone(linesep="\r\n")
+OMITTED_HEADERS = {"bcc", "resent-bcc"}
+LINE_BREAK = re.compile(r"\r\n|\r|\n")
+
+
+class RecipientsPartlyRefused(SMTPException):
+    """The message was sent, but the server refused some of its recipients.
+    `refused` maps each of them to the server's (code, reply), like
+    `SMTPRecipientsRefused.recipients`."""
+
+    def __init__(self, refused: dict[str, tuple[int, bytes]]):
+        super().__init__(f"Refused recipients: {', '.join(refused)}")
+        self.refused = refused
+
+
+@dataclass(frozen=True)
+class PreparedMessage:
+    """An email serialised once for `SMTP.sendmail`."""
+
+    sender: str
+    data: bytes
+
+
+@lru_cache(maxsize=256)
+def _fold_parsed_header(name: str, value: BaseHeader) -> bytes:
+    return SMTP_POLICY.fold_binary(name, value)
+
+
+def fold_header(name: str, value: str) -> bytes:
+    """Serialise a header. Parsed header objects are cached, so the headers
+    which messages share, i.e. From and Cc of a template, are folded once."""
+    if isinstance(value, BaseHeader):
+        return _fold_parsed_header(name, value)
+    return SMTP_POLICY.fold_binary(name, value)
+
+
+@lru_cache(maxsize=32)
+def envelope_sender(value: str) -> str:
+    return getaddresses([value])[0][1]
+
+
+def prepare_message(message: EmailMessage) -> Optional[PreparedMessage]:
+    """Serialise a single part ASCII message like `SMTP.send_message` does.
+
+    Returns None for the messages this does not cover, i.e. multipart or
+    8bit messages, international addresses or Resent headers. Send those
+    with `send_message`."""
+    payload = message.get_payload()
+    if (
+        message.policy is not email.policy.default
+        or not isinstance(payload, str)
+        or not payload.isascii()
+        or "Resent-Date" in message
+    ):
+        return None
+    sender_header = message["Sender"] if "Sender" in message else message["From"]
+    if sender_header is None:
+        return None
+    sender = envelope_sender(sender_header)
+    if not sender.isascii():
+        return None
+
+    parts = [
+        fold_header(name, value)
+        for name, value in message.raw_items()
+        if name.lower() not in OMITTED_HEADERS
+    ]
+    parts.append(b"\r\n")
+    parts.append(LINE_BREAK.sub("\r\n", payload).encode("ascii"))
+    return PreparedMessage(sender, b"".join(parts))
+
+
 class Mailer:
-    def __init__(self, host: str, port: int, user: EmailUser, password: str):
+    """Sends emails via an authenticated SMTP session.
+
+    Sessions are kept open in a small pool and reused across `send` calls, so
+    only the first message of a burst pays for the TCP, TLS and AUTH
+    handshakes. A pooled session is checked with NOOP before it is handed out
+    and is closed once it has been idle for longer than `idle_timeout`
+    seconds. At most `pool_size` idle sessions are kept open."""
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        user: EmailUser,
+        password: str,
+        pool_size: int = 2,
+        idle_timeout: float = 60.0,
+        smtp_class: type = SMTP,
+    ):
         self.host = host
         self.port = port
         self.user = user
         self.password = password
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.smtp_class = smtp_class
+
+        # NOTE: Stack of (session, time of last use). The most recently used
+        # session is on top, so it is the least likely one to be timed out by
+        # the server.
+        self._pool: list[tuple[SMTP, float]] = []
+        # NOTE: Bumped by `reconfigure`, so sessions which were in use at the
+        # time are closed instead of being pooled.
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def reconfigure(self, host: str, port: int, user: EmailUser, password: str):
+        """Use another server or credentials for new sessions. Pooled sessions
+        of the previous ones are closed, sessions in use finish their batch."""
+        with self._lock:
+            self.host, self.port = host, port
+            self.user, self.password = user, password
+            pool, self._pool = self._pool, []
+            self._generation += 1
+        for smtp, _ in pool:
+            self._close(smtp)
+
+    def connect(self) -> SMTP:
+        with self._lock:
+            host, port, user, password = self.host, self.port, self.user, self.password
+        smtp = self.smtp_class(host, port)
+        try:
+            smtp.starttls()
+            smtp.login(user.email, password)
+        except Exception:
+            self._close(smtp)
+            raise
+        return smtp
+
+    def _close(self, smtp: SMTP):
+        try:
+            smtp.quit()
+        except (SMTPException, OSError):
+            smtp.close()
+
+    def _is_alive(self, smtp: SMTP) -> bool:
+        try:
+            status, _ = smtp.noop()
+        except (SMTPException, OSError):
+            return False
+        return status == 250
+
+    def _acquire(self) -> SMTP:
+        while True:
+            with self._lock:
+                if not self._pool:
+                    break
+                smtp, last_used = self._pool.pop()
+
+            if time.monotonic() - last_used > self.idle_timeout:
+                self._close(smtp)
+            elif self._is_alive(smtp):
+                return smtp
+            else:
+                smtp.close()
+
+        return self.connect()
+
+    def _release(self, smtp: SMTP, generation: int):
+        with self._lock:
+            if generation == self._generation and len(self._pool) < self.pool_size:
+                self._pool.append((smtp, time.monotonic()))
+                return
+        self._close(smtp)
+
+    @contextmanager
+    def connection(self) -> Iterator[SMTP]:
+        """Borrow an authenticated session from the pool. The session is
+        returned to the pool afterwards unless the server dropped it."""
+        generation = self._generation
+        smtp = self._acquire()
+        try:
+            yield smtp
+        except SMTPServerDisconnected:
+            smtp.close()
+            raise
+        except Exception:
+            self._close(smtp)
+            raise
+        else:
+            self._release(smtp, generation)
 
     def send(self, message: EmailMessage, to_addrs: list[EmailUser]):
-        emails = [addr.email for addr in to_addrs]
-        smtp = SMTP(self.host, self.port)
-        smtp.starttls()
-        smtp.login(self.user.email, self.password)
-        smtp.send_message(message, to_addrs=emails)
-        smtp.quit()
+        """Send one message. Raises the error `send_many` reports for it,
+        which is `RecipientsPartlyRefused` if it reached some recipients."""
+        (error,) = self.send_many([(message, to_addrs)])
+        if error is not None:
+            raise error
+
+    def send_many(
+        self, messages: list[tuple[EmailMessage, list[EmailUser]]]
+    ) -> list[Optional[Exception]]:
+        """Send several messages one after another over a single session.
+
+        Returns one entry per message, which is None if the message was
+        accepted for all recipients, `RecipientsPartlyRefused` if it was sent
+        to some of them only, or the error the server replied with. Errors
+        which prevent sending anything at all, i.e. a failed login, are
+        raised."""
+        started = time.perf_counter()
+        with span(
+            "smtp.send_many",
+            kind=SPAN_KIND_CLIENT,
+            messages=len(messages),
+            **{"server.address": self.host, "server.port": self.port},
+        ) as send_span:
+            try:
+                results = self._send_many(messages)
+            finally:
+                SEND_SECONDS.observe(time.perf_counter() - started)
+            failed = sum(
+                result is not None and not isinstance(result, RecipientsPartlyRefused)
+                for result in results
+            )
+            partly = sum(
+                isinstance(result, RecipientsPartlyRefused) for result in results
+            )
+            send_span.set_attribute("failed", failed)
+            send_span.set_attribute("partly_refused", partly)
+        MESSAGES.inc("sent", amount=len(results) - failed - partly)
+        MESSAGES.inc("partly_refused", amount=partly)
+        MESSAGES.inc("failed", amount=failed)
+        return results
+
+    def _send_many(
+        self, messages: list[tuple[EmailMessage, list[EmailUser]]]
+    ) -> list[Optional[Exception]]:
+        results: list[Optional[Exception]] = [None] * len(messages)
+        # NOTE: Serialise once, a retry on a fresh session reuses the bytes.
+        prepared = [prepare_message(message) for message, _ in messages]
+        remaining = list(range(len(messages)))
+        reconnected = False
+
+        while remaining:
+            try:
+                with self.connection() as smtp:
+                    while remaining:
+                        index = remaining[0]
+                        message, to_addrs = messages[index]
+                        recipients = [addr.email for addr in to_addrs]
+                        try:
+                            # NOTE: send_message negotiates SMTPUTF8 for
+                            # international addresses.
+                            if prepared[index] is None or not all(
+                                recipient.isascii() for recipient in recipients
+                            ):
+                                refused = smtp.send_message(
+                                    message, to_addrs=recipients
+                                )
+                            else:
+                                refused = smtp.sendmail(
+                                    prepared[index].sender,
+                                    recipients,
+                                    prepared[index].data,
+                                )
+                            if refused:
+                                results[index] = RecipientsPartlyRefused(refused)
+                        except (
+                            SMTPRecipientsRefused,
+                            SMTPSenderRefused,
+                            SMTPDataError,
+                        ) as error:
+                            # NOTE: smtplib resets the transaction on these
+                            # errors, so the session can be used further.
+                            results[index] = error
+                        remaining.pop(0)
+            except SMTPServerDisconnected as error:
+                # The server may drop a session between the NOOP check and
+                # the actual transaction. Retry once on a fresh session.
+                if reconnected:
+                    for index in remaining:
+                        results[index] = error
+                    break
+                reconnected = True
+
+        return results
+
+    def close(self):
+        """Close all pooled sessions."""
+        with self._lock:
+            pool, self._pool = self._pool, []
+        for smtp, _ in pool:
+            self._close(smtp)
+
+
+class AsyncMailer:
+    """Awaitable `send` and `send_many` for `async def` route handlers.
+
+    smtplib is blocking, so the wrapped mailer (a `Mailer` or a `MailQueue`)
+    runs in the event loop's default thread pool. The event loop keeps serving
+    other requests while a message is handed to the SMTP server."""
+
+    def __init__(self, mailer):
+        self.mailer = mailer
+
+    async def send(self, message: EmailMessage, to_addrs: list[EmailUser]):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.mailer.send, message, to_addrs)
+
+    async def send_many(
+        self, messages: list[tuple[EmailMessage, list[EmailUser]]]
+    ) -> list[Optional[Exception]]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.mailer.send_many, messages)
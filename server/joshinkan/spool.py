@@ -0,0 +1,171 @@
+import base64
+import email
+import email.policy
+import fcntl
+import itertools
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from email.message import EmailMessage
+from pathlib import Path
+from typing import IO, Union
+
+from .logger import get_logger
+from .smtp import EmailUser
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class SpooledMail:
+    id: int
+    message: EmailMessage
+    to_addrs: list[EmailUser]
+
+
+def encode_record(mail: SpooledMail) -> dict:
+    return {
+        "op": "add",
+        "id": mail.id,
+        "to": [[user.name, user.email] for user in mail.to_addrs],
+        "message": base64.b64encode(mail.message.as_bytes()).decode("ascii"),
+    }
+
+
+def decode_record(record: dict) -> SpooledMail:
+    message = email.message_from_bytes(
+        base64.b64decode(record["message"]), policy=email.policy.default
+    )
+    return SpooledMail(
+        id=record["id"],
+        message=message,
+        to_addrs=[
+            EmailUser(name=name, email=address) for name, address in record["to"]
+        ],
+    )
+
+
+def read_pending(path: Path) -> list[SpooledMail]:
+    """Read all mails of a spool file which have not been marked as done. A
+    truncated last line, i.e. from a crash in the middle of a write, is
+    ignored."""
+    pending: dict[int, dict] = {}
+    with open(path, "r", encoding="utf8") as file:
+        for line_number, line in enumerate(file):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping corrupt line {line_number} in {path}")
+                continue
+
+            if record["op"] == "add":
+                pending[record["id"]] = record
+            elif record["op"] == "done":
+                pending.pop(record["id"], None)
+    return [decode_record(record) for record in pending.values()]
+
+
+class Spool:
+    """An append-only log of outgoing emails. A mail is appended before it is
+    handed to the SMTP server and marked as done after it was delivered, so
+    mails which are still pending after a crash or restart can be replayed.
+
+    Every worker process writes to its own file in `directory` and holds an
+    exclusive lock on it. Files which are not locked belong to workers which
+    are gone, and their pending mails are taken over by `recover`.
+
+    Adding a mail blocks until it is fsync'ed. Concurrent writers share a
+    single fsync (group commit): whoever syncs flushes everything written so
+    far, and writers whose records were covered by it return right away.
+
+    The file is truncated whenever no mail is pending anymore and more than
+    `compact_after` records have been written."""
+
+    def __init__(self, directory: Union[str, Path], compact_after: int = 1000):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory / f"spool-{os.getpid()}-{time.time_ns()}.log"
+
+        self._file: IO[str] = open(self.path, "a", encoding="utf8")
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        self.compact_after = compact_after
+        self._ids = itertools.count(1)
+        self._pending: set[int] = set()
+        self._write_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._records = 0
+        self._written = 0
+        self._synced = 0
+
+    def add(self, message: EmailMessage, to_addrs: list[EmailUser]) -> int:
+        mail = SpooledMail(id=next(self._ids), message=message, to_addrs=to_addrs)
+        with self._write_lock:
+            self._pending.add(mail.id)
+        self._append(encode_record(mail), sync=True)
+        return mail.id
+
+    def done(self, mail_id: int):
+        # NOTE: Losing a done marker only means a mail gets delivered twice
+        # after a crash, so it is not worth an fsync.
+        self._append({"op": "done", "id": mail_id}, sync=False)
+        with self._write_lock:
+            self._pending.discard(mail_id)
+            if not self._pending and self._records >= self.compact_after:
+                self._file.flush()
+                self._file.truncate(0)
+                self._records = 0
+
+    def pending(self) -> int:
+        with self._write_lock:
+            return len(self._pending)
+
+    def _append(self, record: dict, sync: bool):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._write_lock:
+            self._file.write(line)
+            self._records += 1
+            self._written += 1
+            ticket = self._written
+            if not sync:
+                self._file.flush()
+                return
+
+        with self._sync_lock:
+            if self._synced >= ticket:
+                return  # a concurrent writer's fsync already covered our record
+
+            with self._write_lock:
+                self._file.flush()
+                target = self._written
+            os.fsync(self._file.fileno())
+            self._synced = target
+
+    def recover(self) -> list[SpooledMail]:
+        """Collect the pending mails of all abandoned spool files. The mails
+        are moved into this spool and the abandoned files are deleted. Returns
+        the mails to deliver."""
+        recovered = []
+        for path in sorted(self.directory.glob("spool-*.log")):
+            if path == self.path:
+                continue
+            with open(path, "r", encoding="utf8") as file:
+                try:
+                    fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # owned by a running worker
+
+                for mail in read_pending(path):
+                    mail.id = self.add(mail.message, mail.to_addrs)
+                    recovered.append(mail)
+                path.unlink()
+
+        if recovered:
+            logger.info(f"Recovered {len(recovered)} pending emails from the spool")
+        return recovered
+
+    def close(self):
+        with self._write_lock:
+            self._file.close()
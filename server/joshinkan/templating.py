@@ -0,0 +1,137 @@
+"""Email templates which are compiled once into render functions.
+
+Templates use `str.format` placeholders, i.e. `Hallo {first_name}`, with
+names only. Values are HTML escaped, unless they are `Markup`. Mail templates
+start with a `Subject: ...` line and a blank line, the rest is the HTML body.
+The subject is not escaped, as it is a header."""
+import html
+from email.charset import QP, Charset
+from email.message import EmailMessage
+from functools import lru_cache
+from pathlib import Path
+from string import Formatter
+from typing import Callable, Union
+
+TEMPLATE_DIR = Path(__file__).parent / "templates"
+
+SUBJECT_PREFIX = "Subject: "
+
+
+class TemplateError(Exception):
+    pass
+
+
+class Markup(str):
+    """A string which is HTML already and is not escaped again."""
+
+
+def escape(value) -> str:
+    if isinstance(value, Markup):
+        return value
+    return html.escape(str(value))
+
+
+def compile_template(
+    text: str, name: str = "<template>", autoescape: bool = True
+) -> Callable[[dict], str]:
+    """Compile the template into a function which joins its literal parts and
+    the (escaped) values, like an f-string does."""
+    parts = []
+    for literal, field_name, format_spec, conversion in Formatter().parse(text):
+        if literal:
+            parts.append(repr(literal))
+        if field_name is None:
+            continue
+        if not field_name.isidentifier() or format_spec or conversion:
+            raise TemplateError(f"Unsupported placeholder {{{field_name}}} in {name}")
+        value = f"values[{field_name!r}]"
+        parts.append(f"escape({value})" if autoescape else f"str({value})")
+
+    source = f"def render(values):\n    return ''.join(({', '.join(parts)},))\n"
+    namespace = {"escape": escape}
+    exec(compile(source, name, "exec"), namespace)
+    return namespace["render"]
+
+
+class Template:
+    def __init__(self, text: str, name: str = "<template>", autoescape: bool = True):
+        self.name = name
+        self._render = compile_template(text, name, autoescape)
+
+    def render(self, **values) -> Markup:
+        try:
+            return Markup(self._render(values))
+        except KeyError as error:
+            raise TemplateError(f"{self.name} needs the value {error}")
+
+
+# NOTE: Quoted-printable keeps the mostly ASCII German text readable and
+# needs no 8BITMIME support of the SMTP server.
+BODY_CHARSET = Charset("utf-8")
+BODY_CHARSET.body_encoding = QP
+
+
+class MailTemplate:
+    """Renders the subject and HTML body of an email into an `EmailMessage`.
+
+    Headers which are the same for every message, i.e. From and Cc, are
+    parsed once per set of values and copied into each message."""
+
+    def __init__(self, text: str, name: str = "<template>"):
+        subject, separator, body = text.partition("\n\n")
+        if not subject.startswith(SUBJECT_PREFIX) or not separator:
+            raise TemplateError(f"{name} does not start with a Subject line")
+        self.name = name
+        self.subject = Template(
+            subject[len(SUBJECT_PREFIX) :], f"{name} (subject)", autoescape=False
+        )
+        self.body = Template(body, name)
+
+    @staticmethod
+    @lru_cache(maxsize=32)
+    def skeleton(headers: tuple[tuple[str, str], ...]) -> list[tuple[str, object]]:
+        message = EmailMessage()
+        for name, value in headers:
+            message[name] = value
+        message["MIME-Version"] = "1.0"
+        message["Content-Type"] = 'text/html; charset="utf-8"'
+        message["Content-Transfer-Encoding"] = "quoted-printable"
+        return list(message.raw_items())
+
+    def message(self, headers: dict[str, str], **values) -> EmailMessage:
+        """Render a message with the constant `headers`. Set the headers which
+        change per message, i.e. To, on the result."""
+        message = EmailMessage()
+        for name, value in self.skeleton(tuple(headers.items())):
+            message.set_raw(name, value)
+        message["Subject"] = self.subject.render(**values)
+        message.set_payload(BODY_CHARSET.body_encode(self.body.render(**values)))
+        return message
+
+
+class Templates:
+    """Loads and compiles every template of `directory` once. Files starting
+    with a Subject line are mail templates, the others partials."""
+
+    def __init__(self, directory: Union[str, Path] = TEMPLATE_DIR):
+        self.mails: dict[str, MailTemplate] = {}
+        self.partials: dict[str, Template] = {}
+        for path in sorted(Path(directory).glob("*.html")):
+            text = path.read_text(encoding="utf8")
+            if text.startswith(SUBJECT_PREFIX):
+                self.mails[path.stem] = MailTemplate(text, path.name)
+            else:
+                self.partials[path.stem] = Template(text, path.name)
+
+    def require(self, mails: tuple[str, ...] = (), partials: tuple[str, ...] = ()):
+        """Raise a `TemplateError` unless all the named templates are loaded."""
+        missing = [name for name in mails if name not in self.mails]
+        missing += [name for name in partials if name not in self.partials]
+        if missing:
+            raise TemplateError(f"Missing templates: {', '.join(sorted(missing))}")
+
+    def mail(self, name: str) -> MailTemplate:
+        return self.mails[name]
+
+    def partial(self, name: str) -> Template:
+        return self.partials[name]
@@ -0,0 +1,321 @@
+"""Lightweight traces of requests, in the OTLP JSON format of OpenTelemetry.
+
+`span` times a block of code as a span of the current trace. The spans of a
+trace are exported together once its root span ends, one OTLP
+`ExportTraceServiceRequest` per line, which the OpenTelemetry collector's
+`otlpjsonfile` receiver can read. Without an exporter, `span` does nothing.
+See: https://opentelemetry.io/docs/specs/otlp/#json-protobuf-encoding"""
+import atexit
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from queue import SimpleQueue
+from typing import Optional, TextIO, Union
+
+SERVICE_NAME = "joshinkan-backend"
+
+STATUS_UNSET = 0
+STATUS_ERROR = 2
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+
+def new_trace_id() -> str:
+    return secrets.token_hex(16)
+
+
+def new_span_id() -> str:
+    return secrets.token_hex(8)
+
+
+def is_trace_id(value: str) -> bool:
+    return len(value) == 32 and all(c in "0123456789abcdef" for c in value)
+
+
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_attributes(attributes: dict) -> list[dict]:
+    return [
+        {"key": key, "value": otlp_value(value)} for key, value in attributes.items()
+    ]
+
+
+@dataclass(frozen=True)
+class SpanContext:
+    """Identifies a span, i.e. to continue a trace in another thread."""
+
+    trace_id: str
+    span_id: str
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    kind: int = SPAN_KIND_INTERNAL
+    attributes: dict = field(default_factory=dict)
+    links: list[SpanContext] = field(default_factory=list)
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: int = 0
+    status: int = STATUS_UNSET
+    status_message: str = ""
+    # NOTE: The finished spans of the trace, shared with the child spans and
+    # exported when the root span ends.
+    batch: list["Span"] = field(default_factory=list, repr=False)
+
+    @property
+    def context(self) -> SpanContext:
+        return SpanContext(self.trace_id, self.span_id)
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_error(self, message: str):
+        self.status = STATUS_ERROR
+        self.status_message = message
+
+    def to_otlp(self) -> dict:
+        otlp = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": otlp_attributes(self.attributes),
+            "status": {"code": self.status},
+        }
+        if self.parent_id is not None:
+            otlp["parentSpanId"] = self.parent_id
+        if self.links:
+            otlp["links"] = [
+                {"traceId": link.trace_id, "spanId": link.span_id}
+                for link in self.links
+            ]
+        if self.status_message:
+            otlp["status"]["message"] = self.status_message
+        return otlp
+
+
+class NullSpan:
+    """Stands in for spans while tracing is disabled."""
+
+    context = None
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def set_error(self, message: str):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class SpanExporter:
+    """Writes batches of spans as OTLP JSON lines to a stream, from a
+    background thread so requests never wait for the I/O."""
+
+    def __init__(self, stream: Optional[TextIO] = None):
+        self.stream = stream
+        self._queue: SimpleQueue = SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def open(self) -> TextIO:
+        return self.stream or sys.stdout
+
+    def export(self, spans: list[Span]):
+        self._ensure_thread()
+        self._queue.put(spans)
+
+    def shutdown(self):
+        """Write the queued spans and stop the thread."""
+        with self._lock:
+            thread, self._thread, self._pid = self._thread, None, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _ensure_thread(self):
+        # NOTE: Threads do not survive a fork, so every worker starts its own.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name="span-exporter", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        stream = self.open()
+        resource = {"attributes": otlp_attributes({"service.name": SERVICE_NAME})}
+        while True:
+            spans = self._queue.get()
+            if spans is None:
+                break
+            request = {
+                "resourceSpans": [
+                    {
+                        "resource": resource,
+                        "scopeSpans": [
+                            {
+                                "scope": {"name": "joshinkan"},
+                                "spans": [span.to_otlp() for span in spans],
+                            }
+                        ],
+                    }
+                ]
+            }
+            stream.write(json.dumps(request, ensure_ascii=False) + "\n")
+            stream.flush()
+        if stream is not self.stream and stream is not sys.stdout:
+            stream.close()
+
+
+class FileSpanExporter(SpanExporter):
+    """Writes the spans of every worker to `traces-{pid}.jsonl` in
+    `directory`."""
+
+    def __init__(self, directory: Union[str, Path]):
+        super().__init__()
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def open(self) -> TextIO:
+        return open(
+            self.directory / f"traces-{os.getpid()}.jsonl",
+            "a",
+            encoding="utf8",
+        )
+
+
+_exporter: Optional[SpanExporter] = None
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def configure(exporter: Optional[SpanExporter]):
+    """Export spans with `exporter`, or disable tracing with None."""
+    global _exporter
+
+    if _exporter is not None:
+        _exporter.shutdown()
+    _exporter = exporter
+
+
+def _shutdown():
+    if _exporter is not None:
+        _exporter.shutdown()
+
+
+atexit.register(_shutdown)
+
+
+def is_enabled() -> bool:
+    return _exporter is not None
+
+
+def current_span_context() -> Optional[SpanContext]:
+    span = _current_span.get()
+    return None if span is None else span.context
+
+
+class _SpanScope:
+    def __init__(
+        self,
+        name: str,
+        attributes: dict,
+        kind: int,
+        trace_id: Optional[str],
+        links: list[SpanContext],
+    ):
+        self.name = name
+        self.attributes = attributes
+        self.kind = kind
+        self.trace_id = trace_id
+        self.links = links
+
+    def __enter__(self) -> Span:
+        parent = _current_span.get()
+        if parent is None:
+            self.span = Span(
+                self.name,
+                trace_id=self.trace_id or new_trace_id(),
+                span_id=new_span_id(),
+                kind=self.kind,
+                attributes=self.attributes,
+                links=self.links,
+            )
+        else:
+            self.span = Span(
+                self.name,
+                trace_id=parent.trace_id,
+                span_id=new_span_id(),
+                parent_id=parent.span_id,
+                kind=self.kind,
+                attributes=self.attributes,
+                links=self.links,
+                batch=parent.batch,
+            )
+        self.root = parent is None
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        span = self.span
+        span.end_ns = time.time_ns()
+        if exc is not None:
+            span.set_error(repr(exc))
+        _current_span.reset(self.token)
+        span.batch.append(span)
+        exporter = _exporter
+        if self.root and exporter is not None:
+            exporter.export(span.batch)
+
+
+class _NullScope:
+    def __enter__(self) -> NullSpan:
+        return NULL_SPAN
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_NULL_SCOPE = _NullScope()
+
+
+def span(
+    name: str,
+    kind: int = SPAN_KIND_INTERNAL,
+    trace_id: Optional[str] = None,
+    links: Optional[list[SpanContext]] = None,
+    **attributes,
+) -> Union[_SpanScope, _NullScope]:
+    """Time the block as a span, i.e. `with span("validate") as s: ...`. It is
+    a child of the current span, or starts a new trace, with `trace_id` if
+    given. `links` relate the span to spans of other traces."""
+    if _exporter is None:
+        return _NULL_SCOPE
+    return _SpanScope(name, attributes, kind, trace_id, links or [])
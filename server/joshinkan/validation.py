@@ -1,4 +1,4 @@
-from typing import Any, List
+from typing import Any, Callable, List
 from typing import Optional as _Optional
 from typing import Tuple, Type
 
@@ -88,6 +88,13 @@ def unexpected_value(
         )
 
 
+def no_branch_key(keys: List[Any], path: _Optional[str]) -> InvalidSchema:
+    if path is None:
+        return InvalidSchema(f"Expected one of the keys {keys}.", path)
+    else:
+        return InvalidSchema(f"Expected one of the keys {keys} at '{path}'.", path)
+
+
 def build_path(path: _Optional[str], key: str) -> str:
     if isinstance(key, Optional):
         key = key.key
@@ -103,6 +110,82 @@ def build_index_path(path: _Optional[str], index: int) -> str:
     return path + f"[{index}]"
 
 
+# NOTE: A compiled check returns None if the value is valid. Otherwise it
+# returns a function which builds the error for the path of the checked value,
+# so error paths are only built on failure.
+MakeError = Callable[[_Optional[str]], InvalidSchema]
+Check = Callable[[Any], _Optional[MakeError]]
+
+
+def at_key(make_error: MakeError, key: Any) -> MakeError:
+    return lambda path: make_error(build_path(path, key))
+
+
+def at_index(make_error: MakeError, index: int) -> MakeError:
+    return lambda path: make_error(build_index_path(path, index))
+
+
+DEFAULT_MAX_ERRORS = 20
+"""Stop collecting errors in `validate_all` after this many errors."""
+
+DEFAULT_MAX_DEPTH = 8
+"""Below this nesting depth `validate_all` only reports the first error of a
+value."""
+
+
+class ErrorCollector:
+    def __init__(self, max_errors: int, max_depth: int):
+        self.max_errors = max_errors
+        self.max_depth = max_depth
+        self.errors: List[InvalidSchema] = []
+
+    @property
+    def full(self) -> bool:
+        return len(self.errors) >= self.max_errors
+
+    def add(self, error: InvalidSchema):
+        if not self.full:
+            self.errors.append(error)
+
+
+class CompiledValidator:
+    """The result of `TypeOf.compile`. Validates like the schema it was compiled
+    from, but without walking the schema on every call."""
+
+    __slots__ = ("schema", "_check")
+
+    def __init__(self, schema: "TypeOf", check: Check):
+        self.schema = schema
+        self._check = check
+
+    def validate(
+        self, actual: Any, path: _Optional[str] = None
+    ) -> Tuple[bool, _Optional[InvalidSchema]]:
+        make_error = self._check(actual)
+        if make_error is None:
+            return True, None
+        return False, make_error(path)
+
+    def validate_all(
+        self,
+        actual: Any,
+        path: _Optional[str] = None,
+        max_errors: int = DEFAULT_MAX_ERRORS,
+        max_depth: int = DEFAULT_MAX_DEPTH,
+    ) -> Tuple[bool, List[InvalidSchema]]:
+        # NOTE: Valid values are the common case, so check them with the
+        # compiled function and only collect errors for invalid ones.
+        if self._check(actual) is None:
+            return True, []
+        return self.schema.validate_all(actual, path, max_errors, max_depth)
+
+    def compile(self) -> "CompiledValidator":
+        return self
+
+    def __repr__(self) -> str:
+        return f"Compiled({self.schema})"
+
+
 class TypeOf:
     def __init__(self, expected_type: Type):
         self.expected = expected_type
@@ -120,6 +203,54 @@ class TypeOf:
                 path,
             )
 
+    def validate_all(
+        self,
+        actual: Any,
+        path: _Optional[str] = None,
+        max_errors: int = DEFAULT_MAX_ERRORS,
+        max_depth: int = DEFAULT_MAX_DEPTH,
+    ) -> Tuple[bool, List[InvalidSchema]]:
+        """Like `validate`, but reports every error instead of the first one.
+        Stops after `max_errors` errors. Values nested deeper than `max_depth`
+        only report their first error."""
+        collector = ErrorCollector(max_errors, max_depth)
+        self._collect(actual, path, collector, 0)
+        return len(collector.errors) == 0, collector.errors
+
+    def _collect(
+        self, actual: Any, path: _Optional[str], collector: ErrorCollector, depth: int
+    ):
+        is_valid, invalid_schema = self.validate(actual, path)
+        if not is_valid:
+            collector.add(invalid_schema)
+
+    def compile(self) -> CompiledValidator:
+        """Turn the schema into a single specialised function. Use this for
+        schemas which are validated repeatedly, i.e. in routes."""
+        return CompiledValidator(self, self._compile())
+
+    def _compile(self) -> Check:
+        if type(self).validate is not TypeOf.validate:
+            # NOTE: A custom validator without its own `_compile`. Validate
+            # again with the actual path once we know it failed.
+            validate = self.validate
+
+            def check_custom(actual: Any) -> _Optional[MakeError]:
+                if validate(actual)[0]:
+                    return None
+                return lambda path: validate(actual, path)[1]
+
+            return check_custom
+
+        expected = self.expected
+
+        def check_type(actual: Any) -> _Optional[MakeError]:
+            if isinstance(actual, expected):
+                return None
+            return lambda path: unexpected_type(actual, expected, path)
+
+        return check_type
+
     def __repr__(self) -> str:
         return f"TypeOf({self.expected})"
 
@@ -147,6 +278,33 @@ class ListOf(TypeOf):
                     break
             return is_valid, invalid_schema
 
+    def _compile(self) -> Check:
+        check_item = self.expected._compile()
+
+        def check_list(actual: Any) -> _Optional[MakeError]:
+            if not isinstance(actual, list):
+                return lambda path: unexpected_type(actual, list, path)
+            for index, item in enumerate(actual):
+                make_error = check_item(item)
+                if make_error is not None:
+                    return at_index(make_error, index)
+            return None
+
+        return check_list
+
+    def _collect(
+        self, actual: Any, path: _Optional[str], collector: ErrorCollector, depth: int
+    ):
+        if not isinstance(actual, list) or depth >= collector.max_depth:
+            return super()._collect(actual, path, collector, depth)
+
+        for index, item in enumerate(actual):
+            if collector.full:
+                return
+            self.expected._collect(
+                item, build_index_path(path, index), collector, depth + 1
+            )
+
     def __repr__(self) -> str:
         return f"ListOf({self.expected})"
 
@@ -174,6 +332,18 @@ class TypeOr(TypeOf):
 
         return is_valid, invalid_schema
 
+    def _compile(self) -> Check:
+        checks = tuple(expected_type._compile() for expected_type in self.expected)
+        expected_types = self.expected
+
+        def check_typeor(actual: Any) -> _Optional[MakeError]:
+            for check in checks:
+                if check(actual) is None:
+                    return None
+            return lambda path: unexpected_typeor(actual, expected_types, path)
+
+        return check_typeor
+
     def __repr__(self) -> str:
         return f"TypeOr({self.expected})"
 
@@ -190,6 +360,16 @@ class Values(TypeOf):
         else:
             return False, unexpected_value(actual, self.expected, path)
 
+    def _compile(self) -> Check:
+        expected = self.expected
+
+        def check_values(actual: Any) -> _Optional[MakeError]:
+            if actual in expected:
+                return None
+            return lambda path: unexpected_value(actual, expected, path)
+
+        return check_values
+
     def __repr__(self) -> str:
         return f"Values({self.expected})"
 
@@ -206,6 +386,9 @@ class Optional(TypeOf):
     ) -> Tuple[bool, _Optional[InvalidSchema]]:
         return self.typeor.validate(actual, path)
 
+    def _compile(self) -> Check:
+        return self.typeor._compile()
+
     def __repr__(self) -> str:
         return f"Optional({self.expected})"
 
@@ -268,6 +451,72 @@ class Schema(TypeOf):
 
         return True, None
 
+    def _compile(self) -> Check:
+        required = tuple(
+            key for key in self.schema.keys() if not isinstance(key, OptionalKey)
+        )
+        allowed = frozenset(getattr(key, "key", key) for key in self.schema.keys())
+        checks = tuple(
+            (getattr(key, "key", key), key in required, value._compile())
+            for key, value in self.schema.items()
+        )
+        has_optional_keys = len(required) < len(allowed)
+
+        def check_schema(actual: Any) -> _Optional[MakeError]:
+            if not isinstance(actual, dict):
+                return lambda path: unexpected_type(actual, dict, path)
+
+            for key in required:
+                if key not in actual:
+                    return lambda path: missing_key(build_path(path, key))
+
+            # NOTE: All required keys are present, so without optional keys
+            # there can only be unexpected keys if there are more keys.
+            if (has_optional_keys or len(actual) > len(required)) and not (
+                allowed.issuperset(actual)
+            ):
+                for key in actual:
+                    if key not in allowed:
+                        return lambda path: unexpected_key(build_path(path, key))
+
+            for key, is_required, check in checks:
+                if is_required:
+                    value = actual[key]
+                elif key in actual:
+                    value = actual[key]
+                else:
+                    continue
+                make_error = check(value)
+                if make_error is not None:
+                    return at_key(make_error, key)
+
+            return None
+
+        return check_schema
+
+    def _collect(
+        self, actual: Any, path: _Optional[str], collector: ErrorCollector, depth: int
+    ):
+        if not isinstance(actual, dict) or depth >= collector.max_depth:
+            return super()._collect(actual, path, collector, depth)
+
+        for key in self.schema.keys():
+            if key not in actual and not isinstance(key, OptionalKey):
+                collector.add(missing_key(build_path(path, key)))
+
+        for key in actual.keys():
+            if key not in self.schema:
+                collector.add(unexpected_key(build_path(path, key)))
+
+        for key, expected_type in self.schema.items():
+            if collector.full:
+                return
+            key = getattr(key, "key", key)
+            if key in actual:
+                expected_type._collect(
+                    actual[key], build_path(path, key), collector, depth + 1
+                )
+
     def __repr__(self):
         assignments = ", ".join(
             [f"{key}={value}" for key, value in self.schema.items()]
@@ -315,3 +564,173 @@ class DictOf(TypeOf):
                 return False, invalid_schema
 
         return True, None
+
+    def _collect(
+        self, actual: Any, path: _Optional[str], collector: ErrorCollector, depth: int
+    ):
+        if (
+            not isinstance(actual, dict)
+            or (not self.allow_empty and len(actual) == 0)
+            or depth >= collector.max_depth
+        ):
+            return super()._collect(actual, path, collector, depth)
+
+        for key, value in actual.items():
+            if collector.full:
+                return
+            is_valid_key, _ = self.key_type.validate(key)
+            if not is_valid_key:
+                collector.add(
+                    unexpected_key_type(key, self.key_type, build_path(path, str(key)))
+                )
+                continue
+            self.value_type._collect(
+                value, build_path(path, str(key)), collector, depth + 1
+            )
+
+    def _compile(self) -> Check:
+        check_key = self.key_type._compile()
+        check_value = self.value_type._compile()
+        key_type = self.key_type
+        allow_empty = self.allow_empty
+
+        def check_dict(actual: Any) -> _Optional[MakeError]:
+            if not isinstance(actual, dict):
+                return lambda path: unexpected_type(actual, dict, path)
+
+            if not allow_empty and len(actual) == 0:
+                return empty_dict
+
+            for key, value in actual.items():
+                if check_key(key) is not None:
+                    return lambda path: unexpected_key_type(
+                        key, key_type, build_path(path, str(key))
+                    )
+
+                make_error = check_value(value)
+                if make_error is not None:
+                    return at_key(make_error, str(key))
+
+            return None
+
+        return check_dict
+
+
+class OneOf(TypeOf):
+    """Validates a dict against one of several schemas. The branch is picked
+    up front with a single lookup and only that branch is validated.
+
+    With a `discriminator`, the branch is `branches[actual[discriminator]]`.
+    Otherwise the keys of `branches` are checked for presence in the dict in
+    order and the first present key picks the branch. Falls back to `default`
+    if nothing matches."""
+
+    def __init__(
+        self,
+        branches: dict[Any, Any],
+        discriminator: _Optional[str] = None,
+        default: _Optional[Any] = None,
+    ):
+        self.branches = {
+            key: value if isinstance(value, TypeOf) else TypeOf(value)
+            for key, value in branches.items()
+        }
+        self.discriminator = discriminator
+        if default is not None and not isinstance(default, TypeOf):
+            default = TypeOf(default)
+        self.default = default
+        self.expected = list(self.branches.values())
+
+    def select(self, actual: dict) -> Tuple[_Optional[TypeOf], _Optional[MakeError]]:
+        """Pick the branch for `actual`, which must be a dict. Returns the
+        branch or, if there is none, a function to build the error."""
+        if self.discriminator is not None:
+            if self.discriminator not in actual:
+                if self.default is not None:
+                    return self.default, None
+                return None, lambda path: missing_key(
+                    build_path(path, self.discriminator)
+                )
+
+            tag = actual[self.discriminator]
+            try:
+                branch = self.branches.get(tag, self.default)
+            except TypeError:  # unhashable tag
+                branch = self.default
+            if branch is None:
+                return None, lambda path: unexpected_value(
+                    tag, list(self.branches), build_path(path, self.discriminator)
+                )
+            return branch, None
+
+        for key, branch in self.branches.items():
+            if key in actual:
+                return branch, None
+        if self.default is not None:
+            return self.default, None
+        return None, lambda path: no_branch_key(list(self.branches), path)
+
+    def validate(
+        self, actual: Any, path: _Optional[str] = None
+    ) -> Tuple[bool, _Optional[InvalidSchema]]:
+        if not isinstance(actual, dict):
+            return False, unexpected_type(actual, dict, path)
+
+        branch, make_error = self.select(actual)
+        if branch is None:
+            return False, make_error(path)
+        return branch.validate(actual, path)
+
+    def _collect(
+        self, actual: Any, path: _Optional[str], collector: ErrorCollector, depth: int
+    ):
+        if not isinstance(actual, dict):
+            return super()._collect(actual, path, collector, depth)
+
+        branch, make_error = self.select(actual)
+        if branch is None:
+            collector.add(make_error(path))
+        else:
+            branch._collect(actual, path, collector, depth)
+
+    def _compile(self) -> Check:
+        discriminator = self.discriminator
+        checks = {key: branch._compile() for key, branch in self.branches.items()}
+        check_default = None if self.default is None else self.default._compile()
+        select = self.select
+
+        if discriminator is not None:
+
+            def check_tagged(actual: Any) -> _Optional[MakeError]:
+                if not isinstance(actual, dict):
+                    return lambda path: unexpected_type(actual, dict, path)
+                try:
+                    check = checks.get(actual[discriminator], check_default)
+                except (KeyError, TypeError):
+                    check = check_default
+                if check is None:
+                    return select(actual)[1]
+                return check(actual)
+
+            return check_tagged
+
+        presence_checks = tuple(checks.items())
+
+        def check_by_key(actual: Any) -> _Optional[MakeError]:
+            if not isinstance(actual, dict):
+                return lambda path: unexpected_type(actual, dict, path)
+            for key, check in presence_checks:
+                if key in actual:
+                    return check(actual)
+            if check_default is None:
+                return select(actual)[1]
+            return check_default(actual)
+
+        return check_by_key
+
+    def __repr__(self) -> str:
+        if self.discriminator is not None:
+            return (
+                f"OneOf({self.discriminator}={self.branches}, default={self.default})"
+            )
+        return f"OneOf({self.branches}, default={self.default})"
@@ -5,11 +5,15 @@ setuptools.setup(
     name="joshinkan-backend",
     version="0.0.1",
     packages=setuptools.find_packages(),
+    package_data={"joshinkan": ["templates/*.html"]},
     author="Sven Mischkewitz",
     author_email="sven.mkw@gmail.com",
     description="joshinkan.de backend",
     install_requires=["gunicorn[gevent]==20.1.0"],
-    extras_require={"dev": ["pytest==7.4.3", "black==23.11.0", "pdbpp==0.10.3"]},
+    extras_require={
+        "dev": ["pytest==7.4.3", "black==23.11.0", "pdbpp==0.10.3"],
+        "orjson": ["orjson==3.8.3"],
+    },
     entry_points={
         "console_scripts": [
             "joshinkand = joshinkan.app:serve_gunicorn",
@@ -0,0 +1,121 @@
+import asyncio
+import http.client
+import json
+import threading
+
+import pytest
+
+from joshinkan.asgi import start_server
+from joshinkan.config import Config
+from joshinkan.httpd import Request, Response, Router, make_asgi_app, ndjson
+
+
+@pytest.fixture(scope="module")
+def server_address():
+    R = Router()
+
+    @R.get("/hello")
+    async def hello(request: Request) -> Response:
+        return 200, {"hello": request.parameters.get("name", "world")}
+
+    @R.post("/echo")
+    def echo(request: Request) -> Response:
+        return 200, {"body": request.body}
+
+    @R.get("/stream")
+    async def stream(request: Request) -> Response:
+        async def records():
+            for index in range(3):
+                yield {"index": index}
+
+        return 200, ndjson(records())
+
+    R.set_config(Config(SMTP_USER="test@example.com", SMTP_PASSWORD="password"))
+    app = make_asgi_app(R)
+
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(start_server(app, "127.0.0.1", 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield server.sockets[0].getsockname()[:2]
+
+    async def shutdown():
+        server.close()
+        tasks = [
+            task for task in asyncio.all_tasks() if task is not asyncio.current_task()
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run_coroutine_threadsafe(shutdown(), loop).result(timeout=5)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout=5)
+    loop.close()
+
+
+def test_get(server_address):
+    connection = http.client.HTTPConnection(*server_address, timeout=5)
+    connection.request("GET", "/hello?name=sven")
+    response = connection.getresponse()
+    assert response.status == 200
+    assert json.loads(response.read()) == {"hello": "sven"}
+
+
+def test_keep_alive(server_address):
+    connection = http.client.HTTPConnection(*server_address, timeout=5)
+    for body in ["first", "second"]:
+        connection.request("POST", "/echo", body=body)
+        response = connection.getresponse()
+        assert response.status == 200
+        assert json.loads(response.read()) == {"body": body}
+    connection.close()
+
+
+def test_not_found(server_address):
+    connection = http.client.HTTPConnection(*server_address, timeout=5)
+    connection.request("GET", "/missing")
+    response = connection.getresponse()
+    assert response.status == 404
+    assert b"Not Found" in response.read()
+
+
+def test_malformed_request(server_address):
+    connection = http.client.HTTPConnection(*server_address, timeout=5)
+    connection.connect()
+    connection.sock.sendall(b"garbage\r\n\r\n")
+    response = http.client.HTTPResponse(connection.sock)
+    response.begin()
+    assert response.status == 400
+    connection.close()
+
+
+def test_chunked_response(server_address):
+    connection = http.client.HTTPConnection(*server_address, timeout=5)
+    connection.request("GET", "/stream")
+    response = connection.getresponse()
+    assert response.getheader("Transfer-Encoding") == "chunked"
+    assert response.read() == b'{"index":0}\n{"index":1}\n{"index":2}\n'
+
+    # The connection is reused after the last chunk.
+    connection.request("GET", "/hello")
+    assert connection.getresponse().status == 200
+
+
+def test_not_modified_response(server_address):
+    connection = http.client.HTTPConnection(*server_address, timeout=5)
+    connection.request("GET", "/hello")
+    response = connection.getresponse()
+    response.read()
+    etag = response.getheader("ETag")
+
+    connection.request("GET", "/hello", headers={"If-None-Match": etag})
+    response = connection.getresponse()
+    assert response.status == 304
+    assert response.getheader("Transfer-Encoding") is None
+    assert response.read() == b""
+
+    # The connection is still in sync after a response without a body.
+    connection.request("GET", "/hello")
+    assert connection.getresponse().status == 200
+    connection.close()
@@ -0,0 +1,181 @@
+import asyncio
+import gzip
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+from joshinkan.compression import compression, is_compressible, negotiate_encoding
+from joshinkan.config import Config
+from joshinkan.httpd import (
+    Request,
+    Response,
+    Router,
+    StreamingResponse,
+    make_app,
+    make_asgi_app,
+    ndjson,
+)
+
+LARGE = {"members": [{"name": f"Member {index}"} for index in range(200)]}
+
+
+@pytest.fixture(scope="module")
+def app():
+    R = Router()
+
+    @R.get("/large")
+    def large(request: Request) -> Response:
+        return 200, LARGE
+
+    @R.get("/small")
+    def small(request: Request) -> Response:
+        return 200, {"message": "hi sailor"}
+
+    @R.get("/stream")
+    def stream(request: Request) -> Response:
+        return 200, ndjson({"index": index} for index in range(500))
+
+    @R.get("/image")
+    def image(request: Request) -> Response:
+        return 200, StreamingResponse([b"\x89PNG" * 1000], content_type="image/png")
+
+    @R.get("/precompressed")
+    def precompressed(request: Request) -> Response:
+        return 200, "x" * 2000, {"Content-Encoding": "gzip"}
+
+    R.use(compression(min_size=1024, level=6))
+    R.set_config(Config(SMTP_USER="test@example.com", SMTP_PASSWORD="password"))
+    return make_app(R)
+
+
+def call(app, path: str, accept_encoding: str = "gzip", headers: dict = {}):
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": ""}
+    if accept_encoding:
+        environ["HTTP_ACCEPT_ENCODING"] = accept_encoding
+    environ.update(headers)
+    setup_testing_defaults(environ)
+
+    response = {}
+
+    def start_response(status, headers):
+        response["status"] = status
+        response["headers"] = {key.lower(): value for key, value in headers}
+
+    chunks = list(app(environ, start_response))
+    return response["status"], response["headers"], b"".join(chunks)
+
+
+@pytest.mark.parametrize(
+    "accept_encoding,expected",
+    [
+        ("gzip", "gzip"),
+        ("gzip, deflate", "gzip"),
+        ("deflate", None),
+        ("", None),
+        ("gzip;q=0", None),
+        ("*", "gzip"),
+        ("*;q=0.5, gzip;q=0", None),
+        ("identity, GZIP;q=0.8", "gzip"),
+        ("gzip;q=invalid", None),
+    ],
+)
+def test_negotiate_encoding(accept_encoding, expected, monkeypatch):
+    monkeypatch.setattr("joshinkan.compression.brotli", None)
+    assert negotiate_encoding(accept_encoding) == expected
+
+
+def test_compresses_large_body(app):
+    status, headers, body = call(app, "/large")
+    assert status.startswith("200")
+    assert headers["content-encoding"] == "gzip"
+    assert headers["vary"] == "Accept-Encoding"
+    assert headers["content-length"] == str(len(body))
+    assert headers["etag"].startswith('W/"')
+    assert gzip.decompress(body).startswith(b'{"members":')
+
+
+def test_compressed_etag_validates(app):
+    _, headers, _ = call(app, "/large")
+    status, _, body = call(
+        app, "/large", headers={"HTTP_IF_NONE_MATCH": headers["etag"]}
+    )
+    assert status.startswith("304")
+    assert body == b""
+
+
+def test_skips_small_body(app):
+    _, headers, body = call(app, "/small")
+    assert "content-encoding" not in headers
+    assert headers["vary"] == "Accept-Encoding"
+    assert body == b'{"message":"hi sailor"}'
+
+
+def test_skips_without_accept_encoding(app):
+    _, headers, body = call(app, "/large", accept_encoding="")
+    assert "content-encoding" not in headers
+    assert body.startswith(b'{"members":')
+
+
+def test_compresses_stream(app):
+    _, headers, body = call(app, "/stream")
+    assert headers["content-encoding"] == "gzip"
+    assert "content-length" not in headers
+    lines = gzip.decompress(body).splitlines()
+    assert len(lines) == 500
+    assert lines[-1] == b'{"index":499}'
+
+
+def test_skips_compressed_content(app):
+    _, headers, _ = call(app, "/image")
+    assert "content-encoding" not in headers
+    assert "vary" not in headers
+
+    _, headers, body = call(app, "/precompressed")
+    assert headers["content-encoding"] == "gzip"
+    assert body == b"x" * 2000
+
+
+@pytest.mark.parametrize(
+    "content_type,expected",
+    [
+        ("application/json", True),
+        ("image/svg+xml", True),
+        ("image/SVG+XML; charset=utf-8", True),
+        ("image/png", False),
+        ("font/woff2", False),
+    ],
+)
+def test_is_compressible(content_type, expected):
+    assert is_compressible({"content-type": content_type}) == expected
+
+
+def test_prefers_brotli(app):
+    brotli = pytest.importorskip("brotli")
+    assert negotiate_encoding("gzip, br") == "br"
+
+    _, headers, body = call(app, "/large", accept_encoding="gzip, br")
+    assert headers["content-encoding"] == "br"
+    assert brotli.decompress(body).startswith(b'{"members":')
+
+
+def test_compresses_asgi_stream(app):
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/stream",
+        "headers": [(b"accept-encoding", b"gzip")],
+    }
+    asyncio.run(make_asgi_app(app.router)(scope, receive, send))
+
+    start, *messages = sent
+    assert (b"content-encoding", b"gzip") in start["headers"]
+    body = b"".join(message["body"] for message in messages)
+    assert len(gzip.decompress(body).splitlines()) == 500
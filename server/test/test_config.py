@@ -0,0 +1,175 @@
+import dataclasses
+import os
+import signal
+
+import pytest
+
+from joshinkan import config as config_module
+from joshinkan.config import (
+    Config,
+    ConfigError,
+    get_config,
+    install_reload_handler,
+    read_env_file,
+    reload_config,
+)
+from joshinkan.smtp import EmailUser
+
+ENVIRON = {
+    "SMTP_USER": "Joshinkan <info@example.com>",
+    "SMTP_PASSWORD": " secret ",
+    "SMTP_PORT": "2525",
+    "SMTP_CC": "cc@example.com, Trainer <trainer@example.com>",
+    "MAIL_QUEUE": "0",
+    "MAIL_SPOOL_DIR": "",
+    "RATE_LIMIT_PER_HOUR": "2.5",
+}
+
+
+@pytest.fixture
+def environ(monkeypatch):
+    monkeypatch.setattr(config_module, "_config", None)
+    for key, value in ENVIRON.items():
+        monkeypatch.setenv(key, value)
+    yield
+    config_module._config = None
+
+
+def test_from_environ():
+    config = Config.from_environ(ENVIRON)
+    assert config.SMTP_USER == EmailUser("Joshinkan", "info@example.com")
+    assert config.SMTP_PASSWORD == "secret"
+    assert config.SMTP_PORT == 2525
+    assert config.SMTP_CC == (
+        EmailUser(None, "cc@example.com"),
+        EmailUser("Trainer", "trainer@example.com"),
+    )
+    assert config.SMTP_BCC == ()
+    assert config.MAIL_QUEUE is False
+    assert config.MAIL_SPOOL_DIR is None
+    assert config.RATE_LIMIT_PER_HOUR == 2.5
+    assert config.LOGLEVEL == "INFO"  # not in the environment
+    assert "secret" not in repr(config)
+
+
+def test_config_is_immutable():
+    config = Config.from_environ(ENVIRON)
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        config.SMTP_PORT = 25
+    assert not hasattr(config, "__dict__")
+    assert config.replace(SMTP_PORT="25").SMTP_PORT == 25
+
+
+def test_invalid_values_are_reported_together():
+    with pytest.raises(ConfigError) as error:
+        Config.from_environ(
+            {
+                "SMTP_PASSWORD": "secret",
+                "SMTP_PORT": "smtp",
+                "SMTP_CC": "cc@example.com, <invalid>",
+                "LOG_FORMAT": "xml",
+                "COMPRESSION_LEVEL": "12",
+            }
+        )
+    assert error.value.errors == [
+        "LOG_FORMAT: expected one of text, json, got 'xml'",
+        "COMPRESSION_LEVEL: expected 0 to 11, got 12",
+        "SMTP_PORT: expected an integer, got 'smtp'",
+        "SMTP_USER: is required",
+        "SMTP_CC: expected comma separated email addresses, got "
+        "'cc@example.com, <invalid>'",
+    ]
+
+
+def test_json_codec_must_be_installed(monkeypatch):
+    find_spec = config_module.importlib.util.find_spec
+    monkeypatch.setattr(
+        config_module.importlib.util,
+        "find_spec",
+        lambda name: None if name == "orjson" else find_spec(name),
+    )
+    with pytest.raises(ConfigError) as error:
+        Config.from_environ({**ENVIRON, "JSON_CODEC": "orjson"})
+    assert error.value.errors == [
+        "JSON_CODEC: the orjson package is not installed, got 'orjson'"
+    ]
+    assert Config.from_environ({**ENVIRON, "JSON_CODEC": "auto"}).JSON_CODEC == "auto"
+
+
+def test_get_config_is_cached(environ):
+    config = get_config()
+    assert config.SMTP_PORT == 2525
+    os.environ["SMTP_PORT"] = "25"
+    assert get_config() is config
+
+
+def test_reload_reads_config_file(environ, tmp_path):
+    config = get_config()
+    config_file = tmp_path / ".env"
+    config_file.write_text(
+        '# Rotated credentials\nSMTP_PASSWORD="rotated"\nSMTP_PORT=465\nEMPTY=\n'
+    )
+    os.environ["CONFIG_FILE"] = str(config_file)
+
+    reloaded = reload_config()
+    assert reloaded is get_config() is not config
+    assert reloaded.SMTP_PASSWORD == "rotated"
+    assert reloaded.SMTP_PORT == 465
+    assert reloaded.SMTP_USER == config.SMTP_USER
+
+    config_file.write_text("SMTP_PORT=none\n")
+    with pytest.raises(ConfigError):
+        reload_config()
+    assert get_config() is reloaded
+    del os.environ["CONFIG_FILE"]
+
+
+def test_read_env_file(tmp_path):
+    path = tmp_path / ".env"
+    path.write_text("A=1\n  # B=2\nC = 'three'\nD\n")
+    assert read_env_file(str(path)) == {"A": "1", "C": "three"}
+
+
+def test_get_config_reads_config_file(environ, tmp_path):
+    config_file = tmp_path / ".env"
+    config_file.write_text("SMTP_PASSWORD=rotated\n")
+    os.environ["CONFIG_FILE"] = str(config_file)
+    try:
+        assert get_config().SMTP_PASSWORD == "rotated"
+    finally:
+        del os.environ["CONFIG_FILE"]
+
+
+def test_reload_on_signal(environ, tmp_path):
+    reloads = []
+    previous = signal.getsignal(signal.SIGHUP)
+    try:
+        reload_if_requested = install_reload_handler(lambda *args: reloads.append(args))
+        assert reload_if_requested is not None
+        reload_if_requested()
+        assert reloads == []
+
+        os.environ["SMTP_PORT"] = "465"
+        os.kill(os.getpid(), signal.SIGHUP)
+        # NOTE: The signal handler only notes the signal.
+        assert reloads == []
+        reload_if_requested()
+        reload_if_requested()
+
+        os.environ["SMTP_PORT"] = "invalid"
+        os.kill(os.getpid(), signal.SIGHUP)
+        reload_if_requested()
+
+        os.environ["SMTP_PORT"] = "25"
+        os.environ["CONFIG_FILE"] = str(tmp_path / "missing.env")
+        os.kill(os.getpid(), signal.SIGHUP)
+        reload_if_requested()
+    finally:
+        signal.signal(signal.SIGHUP, previous)
+        os.environ.pop("CONFIG_FILE", None)
+
+    (config, error), (failed, reload_error), (missing, file_error) = reloads
+    assert error is None and config.SMTP_PORT == 465
+    assert failed is None and "SMTP_PORT" in str(reload_error)
+    assert missing is None and "CONFIG_FILE" in str(file_error)
+    assert get_config() is config
@@ -1,22 +1,37 @@
+import asyncio
 import pytest
 from joshinkan.config import Config
 from joshinkan.httpd import (
     WSGIApp,
     make_app,
+    make_asgi_app,
     Client,
     Router,
     Request,
     Response,
     Status,
+    StreamingResponse,
     expect_json,
     expect_params,
     expect_form_data,
+    Middleware,
+    InputStream,
+    RequestTimeout,
+    STDLIB_JSON_CODEC,
+    get_json_codec,
+    cache_control,
+    http_date,
+    ndjson,
+    server_sent_events,
 )
 from dataclasses import dataclass
+from io import BytesIO
 from joshinkan.validation import Schema, ListOf
+import json
 import http.client
 from functools import partialmethod
 import urllib.request
+import time
 
 
 @pytest.fixture(scope="module")
@@ -62,6 +77,72 @@ def dummy_app() -> WSGIApp:
     def expect_params_route(request: Request) -> Response:
         return 200, request.form_data()
 
+    @R.post("/expect_json_all_errors")
+    @expect_json(Schema({"foo": ListOf(int), "bar": str}), all_errors=True)
+    def expect_json_all_errors_route(request: Request) -> Response:
+        return 200, request.json()
+
+    @R.post("/small_body", max_body_size=10)
+    def small_body_route(request: Request) -> Response:
+        return 200, {"body": request.body}
+
+    @R.get("/members/{member_id}")
+    def member_route(request: Request) -> Response:
+        return 200, request.path_parameters
+
+    @R.get("/members/{member_id}/grades/{grade}")
+    def member_grade_route(request: Request) -> Response:
+        return 200, request.path_parameters
+
+    @R.get("/members/me")
+    def member_me_route(request: Request) -> Response:
+        return 200, {"me": True}
+
+    @R.post("/async_json")
+    @expect_json(Schema({"foo": ListOf(int)}))
+    async def async_json_route(request: Request) -> Response:
+        await asyncio.sleep(0)
+        return 200, request.json()
+
+    @R.get("/ndjson")
+    def ndjson_route(request: Request) -> Response:
+        count = int(request.parameters.get("count", "3"))
+        return 200, ndjson({"index": index} for index in range(count))
+
+    @R.get("/events")
+    async def events_route(request: Request) -> Response:
+        async def events():
+            yield "hello\nworld"
+            yield {"done": True}
+
+        return 200, server_sent_events(events())
+
+    @R.get("/export")
+    def export_route(request: Request) -> Response:
+        rows = ["id,name\n", "1,Sven\n", "2,Ümit\n"]
+        return 200, StreamingResponse(
+            rows,
+            content_type="text/csv",
+            content_length=sum(len(row.encode("utf8")) for row in rows),
+        )
+
+    @R.get("/cached")
+    def cached_route(request: Request) -> Response:
+        return 200, {"version": 1}, cache_control(max_age=60, public=True)
+
+    @R.get("/tagged")
+    def tagged_route(request: Request) -> Response:
+        # NOTE: The body cannot be serialised, so only a 304 succeeds.
+        return 200, {"unserialisable": object()}, {"ETag": '"v1"'}
+
+    @R.get("/last_modified")
+    def last_modified_route(request: Request) -> Response:
+        return 200, "content", {"Last-Modified": http_date(1_700_000_000)}
+
+    @R.post("/cached")
+    def cached_post_route(request: Request) -> Response:
+        return 200, {"version": 1}
+
     R.set_config(Config(SMTP_USER="test@example.com", SMTP_PASSWORD="password"))
     return make_app(R)
 
@@ -71,6 +152,52 @@ def dummy_client(dummy_app) -> Client:
     return Client(dummy_app)
 
 
+def call_asgi(
+    app, method: str, path: str, body: bytes = b"", headers: list = []
+) -> tuple[int, dict, bytes]:
+    """Run a single request against an ASGI app. The body is sent in chunks of
+    4 bytes to exercise `more_body`."""
+    chunks = [body[i : i + 4] for i in range(0, len(body), 4)] or [b""]
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+        for i, chunk in enumerate(chunks)
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query.encode(),
+        "headers": [
+            (b"content-length", str(len(body)).encode()),
+            (b"content-type", b"application/json"),
+            *headers,
+        ],
+    }
+    asyncio.run(app(scope, receive, send))
+
+    start, *responses = sent
+    assert not responses[-1].get("more_body", False)
+    return (
+        start["status"],
+        {key.decode(): value.decode() for key, value in start["headers"]},
+        b"".join(response["body"] for response in responses),
+    )
+
+
+@pytest.fixture(scope="module")
+def dummy_asgi_app(dummy_app):
+    return make_asgi_app(dummy_app.router)
+
+
 class End2EndClient:
     @dataclass
     class Response:
@@ -149,9 +276,37 @@ def test_route_found(dummy_client):
     assert res.body == "Yay with Status"
 
 
-def test_route_wrong_method_not_found(dummy_client):
+def test_route_wrong_method_not_allowed(dummy_client):
     res = dummy_client.post("/exists_status")
-    assert res.status == 404
+    assert res.status == 405
+    assert res.headers["Allow"] == "GET"
+
+
+def test_route_path_parameters(dummy_client):
+    res = dummy_client.get("/members/42")
+    assert res.status == 200
+    assert res.json() == {"member_id": "42"}
+
+    res = dummy_client.get("/members/42/grades/3kyu")
+    assert res.status == 200
+    assert res.json() == {"member_id": "42", "grade": "3kyu"}
+
+
+def test_route_static_segment_precedes_parameter(dummy_client):
+    res = dummy_client.get("/members/me")
+    assert res.json() == {"me": True}
+
+
+def test_route_path_parameter_not_found(dummy_client):
+    assert dummy_client.get("/members/").status == 404
+    assert dummy_client.get("/members/42/grades").status == 404
+    assert dummy_client.get("/members/42/unknown/3kyu").status == 404
+
+
+def test_route_path_parameter_wrong_method(dummy_client):
+    res = dummy_client.post("/members/42")
+    assert res.status == 405
+    assert res.headers["Allow"] == "GET"
 
 
 def test_route_leading_slash_required(dummy_client):
@@ -162,7 +317,7 @@ def test_route_leading_slash_required(dummy_client):
 def test_json_from_dict(dummy_client):
     res = dummy_client.get("/json")
     assert res.status == 200
-    assert res.body == '{"message": "hi sailor"}'
+    assert res.body == '{"message":"hi sailor"}'
     assert res.json() == {"message": "hi sailor"}
 
 
@@ -180,13 +335,13 @@ def test_server_error_no_traceback(dummy_client):
 
 
 def test_server_error_with_traceback(dummy_client):
-    config = dummy_client.app.config
+    router = dummy_client.app.router
 
-    assert not config.PRINT_STACKTRACE
+    assert not router.config.PRINT_STACKTRACE
     with dummy_client.config("PRINT_STACKTRACE", True):
-        assert config.PRINT_STACKTRACE
+        assert router.config.PRINT_STACKTRACE
         res = dummy_client.get("/crashing")
-    assert not config.PRINT_STACKTRACE
+    assert not router.config.PRINT_STACKTRACE
     assert res.status == 500
     assert "Internal Server Error" in res.body
     assert "ValueError" in res.body
@@ -218,6 +373,30 @@ def test_expect_json_mismatch(dummy_client):
     assert res.json()["message"] == "The key 'foo' is missing."
 
 
+def test_expect_json_all_errors(dummy_client):
+    res = dummy_client.post(
+        "/expect_json_all_errors", body={"foo": [1, "2", "3"], "baz": 1}
+    )
+    assert res.status == 400
+    assert res.json() == {
+        "message": "The key 'bar' is missing.",
+        "errors": [
+            {"message": "The key 'bar' is missing.", "path": "bar"},
+            {"message": "The key 'baz' is not defined in the schema.", "path": "baz"},
+            {
+                "message": "The value 2 at 'foo[1]' has an unexpected type of"
+                " <class 'str'>. Expected <class 'int'>.",
+                "path": "foo[1]",
+            },
+            {
+                "message": "The value 3 at 'foo[2]' has an unexpected type of"
+                " <class 'str'>. Expected <class 'int'>.",
+                "path": "foo[2]",
+            },
+        ],
+    }
+
+
 def test_expect_json_empty(dummy_client):
     res = dummy_client.post("/expect_json")
     assert res.status == 400
@@ -272,6 +451,378 @@ def test_expect_form_empty(dummy_client, shared_datadir):
     assert res.json()["message"] == "The request body could not be parsed or is empty."
 
 
+def test_body_within_limit(dummy_client):
+    res = dummy_client.post("/small_body", body="0123456789")
+    assert res.status == 200
+    assert res.json() == {"body": "0123456789"}
+
+
+def test_body_too_large_content_length(dummy_client):
+    res = dummy_client.post("/small_body", body="0123456789a")
+    assert res.status == Status.PAYLOAD_TOO_LARGE
+    assert "maximum size of 10 bytes" in res.json()["message"]
+
+
+def test_body_too_large_without_content_length(dummy_client):
+    res = dummy_client.post(
+        "/small_body", headers={"Content-Length": ""}, body="0123456789a"
+    )
+    assert res.status == Status.PAYLOAD_TOO_LARGE
+
+
+def test_body_default_limit(dummy_client):
+    with dummy_client.config("MAX_BODY_SIZE", 5):
+        res = dummy_client.post("/expect_json", body={"foo": [1, 2, 3]})
+    assert res.status == Status.PAYLOAD_TOO_LARGE
+
+
+def test_body_read_timeout(dummy_client):
+    with dummy_client.config("BODY_READ_TIMEOUT", -1):
+        res = dummy_client.post("/small_body", body="0123")
+    assert res.status == Status.REQUEST_TIMEOUT
+
+
+def test_body_read_timeout_interrupts_slow_read():
+    class TricklingStream:
+        def read(self, size: int) -> bytes:
+            time.sleep(5)
+            return b"0"
+
+    stream = InputStream(
+        TricklingStream(), content_length=10, deadline=time.monotonic() + 0.05
+    )
+    started = time.monotonic()
+    with pytest.raises(RequestTimeout):
+        stream.read()
+    assert time.monotonic() - started < 1
+
+
+def test_async_handler_in_wsgi_app(dummy_client):
+    res = dummy_client.post("/async_json", body={"foo": [1, 2]})
+    assert res.status == 200
+    assert res.json() == {"foo": [1, 2]}
+
+    res = dummy_client.post("/async_json", body={"foo": "bar"})
+    assert res.status == 400
+
+
+def test_asgi_sync_handler(dummy_asgi_app):
+    status, _, body = call_asgi(dummy_asgi_app, "GET", "/exists_status")
+    assert status == 200
+    assert body == b"Yay with Status"
+
+
+def test_asgi_async_handler(dummy_asgi_app):
+    status, headers, body = call_asgi(
+        dummy_asgi_app, "POST", "/async_json", b'{"foo": [1, 2, 3]}'
+    )
+    assert status == 200
+    assert headers["content-type"] == "application/json"
+    assert json.loads(body) == {"foo": [1, 2, 3]}
+
+
+def test_asgi_validation_error(dummy_asgi_app):
+    status, _, body = call_asgi(dummy_asgi_app, "POST", "/expect_json", b'{"foo": 1}')
+    assert status == 400
+    assert "message" in json.loads(body)
+
+
+def test_asgi_query_and_path_parameters(dummy_asgi_app):
+    status, _, body = call_asgi(dummy_asgi_app, "GET", "/query_test?foo=1&foo=2")
+    assert json.loads(body) == {"foo": ["1", "2"]}
+
+    status, _, body = call_asgi(dummy_asgi_app, "GET", "/members/42")
+    assert json.loads(body) == {"member_id": "42"}
+
+
+def test_asgi_not_found(dummy_asgi_app):
+    assert call_asgi(dummy_asgi_app, "GET", "/missing")[0] == 404
+
+    status, headers, _ = call_asgi(dummy_asgi_app, "POST", "/exists_status")
+    assert status == 405
+    assert headers["allow"] == "GET"
+
+
+def test_asgi_body_too_large(dummy_asgi_app):
+    status, _, _ = call_asgi(dummy_asgi_app, "POST", "/small_body", b"0123456789a")
+    assert status == Status.PAYLOAD_TOO_LARGE
+
+
+def test_asgi_crashing_handler(dummy_asgi_app):
+    status, _, _ = call_asgi(dummy_asgi_app, "GET", "/crashing")
+    assert status == Status.INTERNAL_SERVER_ERROR
+
+
+def test_ndjson_response(dummy_client):
+    res = dummy_client.get("/ndjson")
+    assert res.status == 200
+    assert res.headers["content-type"] == "application/x-ndjson"
+    assert "content-length" not in res.headers
+    assert res.headers["x-accel-buffering"] == "no"
+    assert res.body == '{"index":0}\n{"index":1}\n{"index":2}\n'
+
+
+def test_streaming_response_is_lazy(dummy_app):
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/ndjson"}
+    environ["QUERY_STRING"] = "count=1000000000"
+    chunks = dummy_app(environ, lambda status, headers: None)
+
+    # Only as many records are produced as the server has sent so far.
+    iterator = iter(chunks)
+    assert next(iterator) == b'{"index":0}\n'
+    assert next(iterator) == b'{"index":1}\n'
+    chunks.close()
+
+
+def test_server_sent_events(dummy_client):
+    res = dummy_client.get("/events")
+    assert res.headers["content-type"] == "text/event-stream"
+    assert res.headers["cache-control"] == "no-cache"
+    assert res.headers["x-accel-buffering"] == "no"
+    assert res.body == 'data: hello\ndata: world\n\ndata: {"done":true}\n\n'
+
+
+def test_streaming_response_content_length(dummy_client):
+    res = dummy_client.get("/export")
+    assert res.headers["content-type"] == "text/csv"
+    assert res.headers["content-length"] == str(len(res.body.encode("utf8")))
+    assert res.body == "id,name\n1,Sven\n2,Ümit\n"
+
+
+def test_streaming_response_buffering_can_be_enabled():
+    response = StreamingResponse([], headers={"X-Accel-Buffering": "yes"})
+    assert response.headers == {"X-Accel-Buffering": "yes"}
+
+
+def test_asgi_streaming_response(dummy_asgi_app):
+    status, headers, body = call_asgi(dummy_asgi_app, "GET", "/ndjson")
+    assert status == 200
+    assert "content-length" not in headers
+    assert body == b'{"index":0}\n{"index":1}\n{"index":2}\n'
+
+    _, _, body = call_asgi(dummy_asgi_app, "GET", "/events")
+    assert body == b'data: hello\ndata: world\n\ndata: {"done":true}\n\n'
+
+
+def test_custom_headers(dummy_client):
+    res = dummy_client.get("/cached")
+    assert res.status == 200
+    assert res.headers["cache-control"] == "public, max-age=60"
+    assert res.headers["etag"].startswith('"')
+
+
+def test_cache_control():
+    assert cache_control(no_store=True) == {"Cache-Control": "no-store"}
+    assert cache_control(max_age=0, s_maxage=300, must_revalidate=True) == {
+        "Cache-Control": "max-age=0, s-maxage=300, must-revalidate"
+    }
+
+
+def test_if_none_match(dummy_client):
+    etag = dummy_client.get("/cached").headers["etag"]
+
+    res = dummy_client.get("/cached", headers={"If-None-Match": etag})
+    assert res.status == Status.NOT_MODIFIED
+    assert res.body == ""
+    assert res.headers["etag"] == etag
+    assert res.headers["cache-control"] == "public, max-age=60"
+    assert "content-type" not in res.headers
+
+    res = dummy_client.get("/cached", headers={"If-None-Match": f'"other", W/{etag}'})
+    assert res.status == Status.NOT_MODIFIED
+
+    res = dummy_client.get("/cached", headers={"If-None-Match": '"other"'})
+    assert res.status == 200
+
+
+def test_if_none_match_skips_serialisation(dummy_client):
+    res = dummy_client.get("/tagged", headers={"If-None-Match": '"v1"'})
+    assert res.status == Status.NOT_MODIFIED
+    assert res.headers["etag"] == '"v1"'
+
+
+def test_if_modified_since(dummy_client):
+    res = dummy_client.get(
+        "/last_modified", headers={"If-Modified-Since": http_date(1_700_000_000)}
+    )
+    assert res.status == Status.NOT_MODIFIED
+
+    res = dummy_client.get(
+        "/last_modified", headers={"If-Modified-Since": http_date(1_600_000_000)}
+    )
+    assert res.status == 200
+    assert res.body == "content"
+
+    res = dummy_client.get("/last_modified", headers={"If-Modified-Since": "garbage"})
+    assert res.status == 200
+
+
+def test_no_etag_for_unsafe_methods(dummy_client):
+    res = dummy_client.post("/cached", headers={"If-None-Match": "*"})
+    assert res.status == 200
+    assert "etag" not in res.headers
+
+
+def test_asgi_not_modified(dummy_asgi_app):
+    _, headers, _ = call_asgi(dummy_asgi_app, "GET", "/cached")
+    status, _, body = call_asgi(
+        dummy_asgi_app,
+        "GET",
+        "/cached",
+        headers=[(b"if-none-match", headers["etag"].encode())],
+    )
+    assert status == 304
+    assert body == b""
+
+
+@pytest.fixture(params=["json", "orjson"])
+def json_codec(request):
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    return get_json_codec(request.param)
+
+
+def test_json_codec_roundtrip(json_codec):
+    value = {"name": "Ümit", "grades": [1, 2.5, None, True], "nested": {"a": "b"}}
+    encoded = json_codec.dumps(value)
+    assert isinstance(encoded, bytes)
+    assert encoded == STDLIB_JSON_CODEC.dumps(value)
+    assert json_codec.loads(encoded) == value
+
+
+def test_json_codec_non_string_keys(json_codec):
+    assert json_codec.dumps({1: "one"}) == b'{"1":"one"}'
+
+
+def test_json_codec_decode_error(json_codec):
+    with pytest.raises(json.JSONDecodeError):
+        json_codec.loads(b"{")
+
+
+def test_unknown_json_codec():
+    with pytest.raises(ValueError):
+        get_json_codec("simplejson")
+
+
+def test_request_json_and_body(json_codec):
+    body = '{"name": "Ümit"}'.encode("utf8")
+    request = Request(
+        {"wsgi.input": BytesIO(body), "CONTENT_LENGTH": str(len(body))},
+        json_codec=json_codec,
+    )
+    assert request.json() == {"name": "Ümit"}
+    assert request.json() == {"name": "Ümit"}
+    assert request.body == '{"name": "Ümit"}'
+
+
+def make_middleware_app(*middleware: Middleware, asgi: bool = False):
+    R = Router()
+
+    @R.get("/hello")
+    def hello(request: Request) -> Response:
+        request.environ["calls"].append("handler")
+        return 200, "hello"
+
+    for layer in middleware:
+        R.use(layer)
+    R.set_config(Config(SMTP_USER="test@example.com", SMTP_PASSWORD="password"))
+    return make_asgi_app(R) if asgi else make_app(R)
+
+
+def recording_middleware(name: str) -> Middleware:
+    def before(environ):
+        environ["calls"].append(f"before {name}")
+
+    def after(environ, response):
+        environ["calls"].append(f"after {name}")
+        status, headers, chunks = response
+        return status, headers + [(f"X-{name}", "yes")], chunks
+
+    def wrap(handle):
+        def wrapped(environ):
+            environ["calls"].append(f"wrap {name}")
+            return handle(environ)
+
+        return wrapped
+
+    return Middleware(before=before, after=after, wrap=wrap)
+
+
+def test_middleware_order():
+    app = make_middleware_app(recording_middleware("a"), recording_middleware("b"))
+    calls = []
+
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/hello", "calls": calls}
+    headers = {}
+    body = b"".join(
+        app(environ, lambda status, header_list: headers.update(header_list))
+    )
+    assert body == b"hello"
+    assert calls == [
+        "before a",
+        "wrap a",
+        "before b",
+        "wrap b",
+        "handler",
+        "after b",
+        "after a",
+    ]
+    assert headers["X-a"] == headers["X-b"] == "yes"
+
+
+def test_middleware_before_answers_request():
+    def before(environ):
+        return Status.BAD_REQUEST, [], [b"rejected"]
+
+    app = make_middleware_app(Middleware(before=before))
+    res = Client(app).get("/hello")
+    assert res.status == 400
+    assert res.body == "rejected"
+
+
+def test_middleware_applies_to_not_found():
+    def after(environ, response):
+        status, headers, chunks = response
+        return status, headers + [("X-Seen", "yes")], chunks
+
+    res = Client(make_middleware_app(Middleware(after=after))).get("/missing")
+    assert res.status == 404
+    assert res.headers["X-Seen"] == "yes"
+
+
+def test_middleware_error():
+    def after(environ, response):
+        raise ValueError("broken middleware")
+
+    res = Client(make_middleware_app(Middleware(after=after))).get("/missing")
+    assert res.status == 500
+
+
+def test_asgi_middleware():
+    def wrap_async(handle):
+        async def wrapped(environ):
+            status, headers, chunks = await handle(environ)
+            return status, headers + [("X-Wrapped", "yes")], chunks
+
+        return wrapped
+
+    def before(environ):
+        environ["calls"] = []
+
+    app = make_middleware_app(
+        Middleware(before=before, wrap_async=wrap_async), asgi=True
+    )
+    status, headers, body = call_asgi(app, "GET", "/hello")
+    assert status == 200
+    assert headers["x-wrapped"] == "yes"
+    assert body == b"hello"
+
+
+def test_asgi_middleware_requires_wrap_async():
+    with pytest.raises(ValueError):
+        make_middleware_app(Middleware(wrap=lambda handle: handle), asgi=True)
+
+
 @pytest.mark.end2end
 def test_end2end_request(dummy_server: End2EndClient):
     res = dummy_server.get("/exists_status")
@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+from joshinkan.httpd import Status
+from joshinkan.idempotency import (
+    REPLAYED_HEADER,
+    FileStore,
+    IdempotencyCache,
+    MemoryStore,
+    payload_key,
+)
+
+
+def test_payload_key_is_normalised():
+    key = payload_key({"email": "Sven@Example.com ", "child_age": ["7", "9"]})
+    assert key == payload_key({"child_age": ["7 ", "9"], "email": "sven@example.com"})
+    assert key != payload_key({"child_age": ["9", "7"], "email": "sven@example.com"})
+
+
+@pytest.fixture(params=["memory", "file"])
+def store(request, tmp_path):
+    return MemoryStore() if request.param == "memory" else FileStore(tmp_path)
+
+
+def test_duplicates_get_the_first_response(store):
+    cache = IdempotencyCache(60, store)
+    calls = []
+
+    def handle():
+        calls.append(1)
+        return Status.OK, {"message": "Email sent."}
+
+    assert cache.run("key", handle) == (Status.OK, {"message": "Email sent."})
+    assert cache.run("key", handle) == (
+        200,
+        {"message": "Email sent."},
+        {REPLAYED_HEADER: "true"},
+    )
+    assert cache.run("other", handle)[0] == Status.OK
+    assert len(calls) == 2
+
+
+def test_responses_expire(store):
+    cache = IdempotencyCache(0.01, store)
+    calls = []
+    handle = lambda: calls.append(1) or (Status.OK, {})
+    cache.run("key", handle)
+    threading.Event().wait(0.02)
+    cache.run("key", handle)
+    assert len(calls) == 2
+
+
+def test_errors_are_not_stored(store):
+    cache = IdempotencyCache(60, store)
+
+    def fail():
+        raise ValueError("SMTP is down")
+
+    with pytest.raises(ValueError):
+        cache.run("key", fail)
+    assert cache.run("key", lambda: (Status.INTERNAL_SERVER_ERROR, {}))[0] == 500
+    assert cache.run("key", lambda: (Status.OK, {}))[0] == Status.OK
+
+
+def test_duplicate_waits_for_the_first_request(store):
+    cache = IdempotencyCache(60, store, poll_interval=0.001)
+    started, finish = threading.Event(), threading.Event()
+
+    def handle():
+        started.set()
+        finish.wait(5)
+        return Status.OK, {"message": "first"}
+
+    first = threading.Thread(target=cache.run, args=("key", handle))
+    first.start()
+    started.wait(5)
+    threading.Timer(0.05, finish.set).start()
+    status, body, headers = cache.run("key", lambda: (Status.OK, {"message": "x"}))
+    first.join()
+    assert body == {"message": "first"}
+
+
+def test_duplicate_conflicts_after_waiting(store):
+    cache = IdempotencyCache(60, store, wait=0.01, poll_interval=0.001)
+    store.claim("key", 60)
+    assert cache.run("key", lambda: (Status.OK, {}))[0] == Status.CONFLICT
+
+
+def test_file_store_is_shared(tmp_path):
+    IdempotencyCache(60, FileStore(tmp_path)).run("key", lambda: (Status.OK, {}))
+    response = IdempotencyCache(60, FileStore(tmp_path)).run("key", lambda: None)
+    assert response[2] == {REPLAYED_HEADER: "true"}
@@ -0,0 +1,117 @@
+import json
+import logging
+from io import StringIO
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+from joshinkan.config import Config
+from joshinkan.httpd import Request, Response, Router, make_app
+from joshinkan.logger import (
+    ROOT_LOGGER_NAME,
+    get_logger,
+    log_context,
+    setup_logging,
+    stop_logging,
+)
+
+
+@pytest.fixture
+def stream():
+    stream = StringIO()
+    yield stream
+    setup_logging("DEBUG")
+
+
+def lines(stream: StringIO) -> list[str]:
+    stop_logging()  # waits for the queued records
+    return stream.getvalue().splitlines()
+
+
+def test_json_lines_with_context(stream):
+    setup_logging("INFO", "json", stream=stream)
+    logger = get_logger("joshinkan.test")
+
+    with log_context(request_id="abc123"):
+        logger.info("Hello %s", "Jürgen")
+    logger.warning("Outside")
+
+    first, second = [json.loads(line) for line in lines(stream)]
+    assert first["message"] == "Hello Jürgen"
+    assert first["level"] == "INFO"
+    assert first["logger"] == "joshinkan.test"
+    assert first["request_id"] == "abc123"
+    assert first["elapsed_ms"] >= 0
+    assert first["time"] > 0
+    assert second["message"] == "Outside"
+    assert "request_id" not in second
+
+
+def test_text_format_with_context(stream):
+    setup_logging("INFO", stream=stream)
+    with log_context(request_id="abc123"):
+        get_logger("joshinkan.test").info("Hello")
+
+    (line,) = lines(stream)
+    assert line.startswith("INFO joshinkan.test ")
+    assert "Hello [abc123 +" in line
+
+
+def test_filtered_records_are_not_formatted(stream):
+    setup_logging("INFO", stream=stream)
+    formatted = []
+
+    class Expensive:
+        def __str__(self):
+            formatted.append(True)
+            return "expensive"
+
+    get_logger("joshinkan.test").debug("%s", Expensive())
+    assert lines(stream) == []
+    assert formatted == []
+
+
+def test_handlers_are_not_duplicated(stream):
+    setup_logging("INFO", stream=stream)
+    get_logger("joshinkan.test")
+    get_logger("joshinkan.test")
+    get_logger("other")
+    get_logger("other")
+    setup_logging("INFO", stream=stream)
+
+    assert logging.getLogger("joshinkan.test").handlers == []
+    assert len(logging.getLogger(ROOT_LOGGER_NAME).handlers) == 1
+    assert len(logging.getLogger("other").handlers) == 1
+
+    get_logger("joshinkan.test").info("once")
+    get_logger("other").info("once")
+    assert len(lines(stream)) == 2
+
+
+def test_invalid_settings():
+    with pytest.raises(ValueError):
+        setup_logging("VERBOSE")
+    with pytest.raises(ValueError):
+        setup_logging("INFO", "xml")
+
+
+def test_request_id_in_app_logs(stream):
+    R = Router()
+
+    @R.get("/log")
+    def log(request: Request) -> Response:
+        get_logger("joshinkan.test").info("In the handler")
+        return 200, None
+
+    R.set_config(Config(SMTP_USER="test@example.com", SMTP_PASSWORD="password"))
+    app = make_app(R)
+    setup_logging("INFO", "json", stream=stream)
+
+    for _ in range(2):
+        environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/log", "QUERY_STRING": ""}
+        setup_testing_defaults(environ)
+        b"".join(app(environ, lambda status, headers: None))
+
+    first, second = [json.loads(line) for line in lines(stream)]
+    assert len(first["request_id"]) == 32
+    assert first["request_id"] != second["request_id"]
@@ -0,0 +1,218 @@
+from email.message import EmailMessage
+from smtplib import SMTPServerDisconnected
+import threading
+import time
+
+import pytest
+
+from joshinkan.mailqueue import DELIVERY_SECONDS, MESSAGES, MailQueue
+from joshinkan.smtp import EmailUser, RecipientsPartlyRefused
+
+
+class FlakyMailer:
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.sent = []
+
+    def send(self, message, to_addrs):
+        if self.failures > 0:
+            self.failures -= 1
+            raise SMTPServerDisconnected("Connection unexpectedly closed")
+        self.sent.append((message, to_addrs))
+
+    def send_many(self, messages):
+        results = []
+        for message, to_addrs in messages:
+            try:
+                self.send(message, to_addrs)
+                results.append(None)
+            except Exception as error:
+                results.append(error)
+        return results
+
+
+def make_message(subject: str = "Hello") -> EmailMessage:
+    message = EmailMessage()
+    message["Subject"] = subject
+    message.set_content("Hello there")
+    return message
+
+
+@pytest.fixture
+def to_addrs() -> list[EmailUser]:
+    return [EmailUser.from_description("to@example.com")]
+
+
+def test_send_returns_before_delivery(to_addrs):
+    release = threading.Event()
+
+    class SlowMailer(FlakyMailer):
+        def send(self, message, to_addrs):
+            release.wait()
+            super().send(message, to_addrs)
+
+    mailer = SlowMailer()
+    queue = MailQueue(mailer)
+    queue.send(make_message(), to_addrs=to_addrs)
+    assert mailer.sent == []
+    assert queue.stats().depth == 1
+
+    release.set()
+    assert queue.join(timeout=5)
+    assert len(mailer.sent) == 1
+    queue.stop()
+
+
+def test_delivers_in_order(to_addrs):
+    mailer = FlakyMailer()
+    queue = MailQueue(mailer)
+    for subject in ["first", "second", "third"]:
+        queue.send(make_message(subject), to_addrs=to_addrs)
+    assert queue.join(timeout=5)
+    assert [message["Subject"] for message, _ in mailer.sent] == [
+        "first",
+        "second",
+        "third",
+    ]
+
+    stats = queue.stats()
+    assert stats.depth == 0
+    assert stats.delivered == 3
+    assert stats.last_latency is not None
+    queue.stop()
+
+
+def test_retries_with_backoff(to_addrs):
+    mailer = FlakyMailer(failures=2)
+    queue = MailQueue(mailer, max_attempts=3, backoff=0.01)
+    queue.send(make_message(), to_addrs=to_addrs)
+    assert queue.join(timeout=5)
+    assert len(mailer.sent) == 1
+
+    stats = queue.stats()
+    assert stats.retried == 2
+    assert stats.failed == 0
+    assert stats.delivered == 1
+    queue.stop()
+
+
+def test_records_metrics(to_addrs):
+    delivered = MESSAGES.value("delivered")
+    retried = MESSAGES.value("retried")
+    deliveries = DELIVERY_SECONDS.count()
+
+    queue = MailQueue(FlakyMailer(failures=1), backoff=0.01)
+    queue.send(make_message(), to_addrs=to_addrs)
+    assert queue.join(timeout=5)
+    queue.stop()
+
+    assert MESSAGES.value("delivered") == delivered + 1
+    assert MESSAGES.value("retried") == retried + 1
+    assert DELIVERY_SECONDS.count() == deliveries + 1
+
+
+def test_partly_refused_message_is_not_retried(to_addrs):
+    class RefusingMailer(FlakyMailer):
+        def send_many(self, messages):
+            self.sent.extend(messages)
+            return [RecipientsPartlyRefused({"cc@example.com": (550, b"No")})]
+
+    mailer = RefusingMailer()
+    queue = MailQueue(mailer, backoff=0.01)
+    queue.send(make_message(), to_addrs=to_addrs)
+    assert queue.join(timeout=5)
+    queue.stop()
+
+    stats = queue.stats()
+    assert len(mailer.sent) == 1
+    assert stats.delivered == 1
+    assert stats.retried == 0
+
+
+def test_gives_up_after_max_attempts(to_addrs):
+    mailer = FlakyMailer(failures=5)
+    queue = MailQueue(mailer, max_attempts=2, backoff=0.01)
+    queue.send(make_message(), to_addrs=to_addrs)
+    assert queue.join(timeout=5)
+    assert mailer.sent == []
+
+    stats = queue.stats()
+    assert stats.retried == 1
+    assert stats.failed == 1
+    queue.stop()
+
+
+def test_stop_delivers_queued_messages(to_addrs):
+    mailer = FlakyMailer(failures=1)
+    queue = MailQueue(mailer, backoff=60)
+    queue.send(make_message("retried"), to_addrs=to_addrs)
+    queue.send(make_message("queued"), to_addrs=to_addrs)
+    while queue.stats().retried == 0:
+        time.sleep(0.01)
+
+    # NOTE: The retry would be due in a minute, stopping delivers it now.
+    queue.stop(timeout=5)
+    assert sorted(message["Subject"] for message, _ in mailer.sent) == [
+        "queued",
+        "retried",
+    ]
+    assert queue.stats().depth == 0
+
+
+def test_stop_does_not_retry(to_addrs):
+    mailer = FlakyMailer(failures=5)
+    queue = MailQueue(mailer, backoff=60)
+    queue.send(make_message(), to_addrs=to_addrs)
+    while queue.stats().retried == 0:
+        time.sleep(0.01)
+
+    queue.stop(timeout=5)
+    stats = queue.stats()
+    assert mailer.sent == []
+    assert stats.depth == 0
+    assert stats.failed == 1
+
+
+def test_batches_due_messages(to_addrs):
+    release = threading.Event()
+    batches = []
+
+    class BatchingMailer(FlakyMailer):
+        def send_many(self, messages):
+            release.wait()
+            batches.append(len(messages))
+            return super().send_many(messages)
+
+    queue = MailQueue(BatchingMailer(), batch_size=3)
+    for _ in range(5):
+        queue.send(make_message(), to_addrs=to_addrs)
+    release.set()
+    assert queue.join(timeout=5)
+
+    # The first message is picked up right away, the others are batched.
+    assert sum(batches) == 5
+    assert max(batches) <= 3
+    assert len(batches) < 5
+    queue.stop()
+
+
+def test_send_many_is_delivered_in_one_batch(to_addrs):
+    batches = []
+
+    class BatchingMailer(FlakyMailer):
+        def send_many(self, messages):
+            batches.append([message["Subject"] for message, _ in messages])
+            return super().send_many(messages)
+
+    queue = MailQueue(BatchingMailer())
+    for _ in range(20):
+        queue.send_many(
+            [
+                (make_message("Registration"), to_addrs),
+                (make_message("Acknowledgement"), to_addrs),
+            ]
+        )
+        assert queue.join(timeout=5)
+    queue.stop()
+
+    assert batches == [["Registration", "Acknowledgement"]] * 20
@@ -0,0 +1,293 @@
+import asyncio
+import json
+import subprocess
+import sys
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+from joshinkan.config import Config
+from joshinkan.httpd import (
+    Request,
+    Response,
+    Router,
+    ValidationType,
+    expect_schema,
+    make_app,
+    make_asgi_app,
+)
+from joshinkan.instrumentation import add_metrics_route, instrumentation
+from joshinkan.metrics import (
+    CONTENT_TYPE,
+    Registry,
+    SnapshotStore,
+    escape_label_value,
+    exposition,
+    merge,
+    render,
+)
+from joshinkan.validation import Schema
+
+
+def test_counter_and_gauge():
+    registry = Registry()
+    counter = registry.counter("requests_total", "Requests.", ("method",))
+    counter.inc("GET")
+    counter.inc("GET", amount=2)
+    counter.inc("POST")
+    assert counter.value("GET") == 3
+    assert counter.value("POST") == 1
+    assert counter.value("PUT") == 0
+
+    gauge = registry.gauge("in_flight", "In flight.")
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    assert gauge.value() == 1
+    gauge.set(7)
+    assert gauge.value() == 7
+
+    assert registry.counter("requests_total", "Requests.") is counter
+    with pytest.raises(ValueError):
+        registry.gauge("requests_total", "Requests.")
+
+
+def test_render_histogram():
+    registry = Registry()
+    histogram = registry.histogram(
+        "latency_seconds", "Latency.", ("route",), buckets=(0.1, 1.0)
+    )
+    histogram.observe(0.05, "/a")
+    histogram.observe(0.1, "/a")
+    histogram.observe(0.5, "/a")
+    histogram.observe(3, "/a")
+    assert histogram.count("/a") == 4
+
+    text = render(merge([registry.snapshot()]))
+    assert text == (
+        "# HELP latency_seconds Latency.\n"
+        "# TYPE latency_seconds histogram\n"
+        'latency_seconds_bucket{route="/a",le="0.1"} 2\n'
+        'latency_seconds_bucket{route="/a",le="1"} 3\n'
+        'latency_seconds_bucket{route="/a",le="+Inf"} 4\n'
+        'latency_seconds_sum{route="/a"} 3.65\n'
+        'latency_seconds_count{route="/a"} 4\n'
+    )
+
+
+def test_render_without_labels():
+    registry = Registry()
+    registry.counter("total", "").inc()
+    registry.add_collector(lambda: {"queue_depth": 3})
+    assert render(merge([registry.snapshot()])) == (
+        "# TYPE queue_depth gauge\nqueue_depth 3\n# TYPE total counter\ntotal 1\n"
+    )
+
+
+def test_escape_label_value():
+    assert escape_label_value('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
+
+
+def test_failing_collector_is_skipped():
+    registry = Registry()
+
+    def collect():
+        raise RuntimeError("boom")
+
+    registry.add_collector(collect)
+    registry.counter("total", "").inc()
+    assert set(registry.snapshot()["metrics"]) == {"total"}
+
+
+def test_snapshot_store_merges_workers(tmp_path):
+    registry = Registry()
+    registry.counter("total", "", ("status",)).inc("200")
+    registry.gauge("in_flight", "").inc()
+    store = SnapshotStore(tmp_path)
+
+    # NOTE: Another worker which has exited already.
+    exited = int(
+        subprocess.run(
+            [sys.executable, "-c", "import os; print(os.getpid())"],
+            capture_output=True,
+        ).stdout
+    )
+    (tmp_path / f"metrics-{exited}.json").write_text(
+        json.dumps(
+            {
+                "pid": exited,
+                "metrics": {
+                    "total": {
+                        "type": "counter",
+                        "help": "",
+                        "buckets": None,
+                        "values": {'status="200"': 2, 'status="500"': 1},
+                    },
+                    "in_flight": {
+                        "type": "gauge",
+                        "help": "",
+                        "buckets": None,
+                        "values": {"": 5},
+                    },
+                },
+            }
+        )
+    )
+
+    text = exposition(registry, store)
+    assert 'total{status="200"} 3\n' in text
+    assert 'total{status="500"} 1\n' in text
+    assert "in_flight 1\n" in text
+    assert store.path.exists()
+
+    store.clear()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_snapshot_store_throttles_writes(tmp_path):
+    registry = Registry()
+    counter = registry.counter("total", "")
+    store = SnapshotStore(tmp_path, interval=60)
+
+    counter.inc()
+    store.write(registry)
+    counter.inc()
+    store.write(registry)
+    assert json.loads(store.path.read_text())["metrics"]["total"]["values"][""] == 1
+
+    store.write(registry, force=True)
+    assert json.loads(store.path.read_text())["metrics"]["total"]["values"][""] == 2
+
+
+def make_instrumented_router(registry: Registry) -> Router:
+    R = Router()
+
+    @R.get("/members/{member_id}")
+    def member(request: Request) -> Response:
+        return 200, {"id": request.path_parameters["member_id"]}
+
+    @R.post("/members")
+    @expect_schema(Schema({"name": str}), validate=ValidationType.JSON_BODY)
+    def create_member(request: Request) -> Response:
+        return 200, None
+
+    @R.get("/async")
+    async def async_handler(request: Request) -> Response:
+        return 200, None
+
+    @R.get("/error")
+    def error(request: Request) -> Response:
+        raise RuntimeError("boom")
+
+    R.use(instrumentation(registry))
+    add_metrics_route(R, registry)
+    R.set_config(Config(SMTP_USER="test@example.com", SMTP_PASSWORD="password"))
+    return R
+
+
+def call(app, method: str, path: str, body: bytes = b""):
+    environ = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "CONTENT_LENGTH": str(len(body)),
+        "CONTENT_TYPE": "application/json",
+    }
+    setup_testing_defaults(environ)
+    environ["wsgi.input"].write(body)
+    environ["wsgi.input"].seek(0)
+
+    response = {}
+
+    def start_response(status, headers):
+        response["status"] = status
+        response["headers"] = {key.lower(): value for key, value in headers}
+
+    chunks = list(app(environ, start_response))
+    return response["status"], response["headers"], b"".join(chunks)
+
+
+def test_instrumentation_records_requests():
+    registry = Registry()
+    app = make_app(make_instrumented_router(registry))
+
+    assert call(app, "GET", "/members/1")[0] == "200 OK"
+    assert call(app, "GET", "/members/2")[0] == "200 OK"
+    assert (
+        call(app, "POST", "/members", '{"name": "Jürgen"}'.encode("utf8"))[0]
+        == "200 OK"
+    )
+    assert call(app, "POST", "/members", b'{"name": 1}')[0] == "400 Bad Request"
+    assert call(app, "GET", "/async")[0] == "200 OK"
+    assert call(app, "GET", "/error")[0] == "500 Internal Server Error"
+    assert call(app, "GET", "/unknown/path")[0] == "404 Not Found"
+
+    duration = registry.metrics["joshinkan_request_duration_seconds"]
+    assert duration.count("/members/{member_id}", "GET") == 2
+    assert duration.count("/members", "POST") == 2
+
+    responses = registry.metrics["joshinkan_responses_total"]
+    assert responses.value("/members/{member_id}", "GET", "200") == 2
+    assert responses.value("/members", "POST", "400") == 1
+    assert responses.value("/async", "GET", "200") == 1
+    assert responses.value("/error", "GET", "500") == 1
+    assert responses.value("unmatched", "GET", "404") == 1
+
+    phases = registry.metrics["joshinkan_request_phase_seconds"]
+    assert phases.count("/members", "body_read") == 2
+    assert phases.count("/members", "validation") == 2
+    assert phases.count("/members", "handler") == 2
+    assert phases.count("/members/{member_id}", "body_read") == 0
+
+    assert registry.metrics["joshinkan_requests_in_flight"].value() == 0
+
+
+def test_instrumentation_records_asgi_requests():
+    registry = Registry()
+    app = make_asgi_app(make_instrumented_router(registry))
+
+    async def request(path: str):
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": path,
+            "query_string": b"",
+            "headers": [],
+        }
+        await app(scope, receive, send)
+        return messages[0]["status"]
+
+    assert asyncio.run(request("/members/1")) == 200
+    assert asyncio.run(request("/error")) == 500
+
+    responses = registry.metrics["joshinkan_responses_total"]
+    assert responses.value("/members/{member_id}", "GET", "200") == 1
+    assert responses.value("/error", "GET", "500") == 1
+    phases = registry.metrics["joshinkan_request_phase_seconds"]
+    assert phases.count("/members/{member_id}", "body_read") == 1
+    assert phases.count("/members/{member_id}", "handler") == 1
+
+
+def test_metrics_route():
+    registry = Registry()
+    app = make_app(make_instrumented_router(registry))
+    call(app, "GET", "/members/1")
+
+    status, headers, body = call(app, "GET", "/metrics")
+    assert status == "200 OK"
+    assert headers["content-type"] == CONTENT_TYPE
+    assert headers["cache-control"] == "no-store"
+    text = body.decode("utf8")
+    assert "# TYPE joshinkan_request_duration_seconds histogram" in text
+    assert (
+        'joshinkan_responses_total{route="/members/{member_id}",method="GET",'
+        'status="200"} 1\n'
+    ) in text
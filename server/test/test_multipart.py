@@ -1,4 +1,5 @@
 import pytest
+from io import BytesIO
 from joshinkan import multipart
 
 
@@ -84,3 +85,67 @@ def test_list_form_data(shared_datadir):
     assert form_data["child_first_name"] == ["Boi", "Girl"]
     assert form_data["child_last_name"] == ["Fam", "Fam"]
     assert form_data["child_age"] == ["17", "16"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1024])
+def test_parse_stream_chunk_sizes(shared_datadir, chunk_size):
+    CONTENT_TYPE = (
+        "multipart/form-data; boundary=----WebKitFormBoundaryJBxGtknRPIBvH5oj"
+    )
+    body = (shared_datadir / "children_registration.txt").read_bytes()
+    form_data = multipart.parse_stream(
+        BytesIO(body), content_type=CONTENT_TYPE, chunk_size=chunk_size
+    )
+    assert form_data == multipart.parse(body=body, content_type=CONTENT_TYPE)
+    assert form_data["child_first_name"] == ["Boi", "Girl"]
+    assert form_data["age"] == ""
+
+
+def test_parse_stream_crlf(shared_datadir):
+    CONTENT_TYPE = (
+        "multipart/form-data; boundary=----WebKitFormBoundaryJBxGtknRPIBvH5oj"
+    )
+    body = (shared_datadir / "children_registration.txt").read_bytes()
+    body = body.replace(b"\n", b"\r\n")
+    form_data = multipart.parse_stream(BytesIO(body), content_type=CONTENT_TYPE)
+    assert form_data["first_name"] == "Dad"
+    assert form_data["child_age"] == ["17", "16"]
+
+
+def test_parse_stream_multiline_value():
+    CONTENT_TYPE = "multipart/form-data; boundary=xyz"
+    body = (
+        b"--xyz\r\n"
+        b'Content-Disposition: form-data; name="message"\r\n'
+        b"\r\n"
+        b"Hallo,\r\nwie geht's? \xc3\xbc\r\n"
+        b"--xyz--\r\n"
+    )
+    form_data = multipart.parse_stream(
+        BytesIO(body), content_type=CONTENT_TYPE, chunk_size=3
+    )
+    assert form_data == {"message": "Hallo,\nwie geht's? ü"}
+
+
+def test_iter_fields_is_incremental(shared_datadir):
+    CONTENT_TYPE = (
+        "multipart/form-data; boundary=----WebKitFormBoundaryiB5iskbmcAfH1zPo"
+    )
+    stream = BytesIO((shared_datadir / "adult_registration.txt").read_bytes())
+    fields = multipart.iter_fields(stream, content_type=CONTENT_TYPE, chunk_size=16)
+    assert next(fields) == ("first_name", "sven")
+    assert stream.tell() < len(stream.getvalue())
+
+
+def test_max_field_size(shared_datadir):
+    CONTENT_TYPE = "multipart/form-data; boundary=xyz"
+    body = (
+        b'--xyz\nContent-Disposition: form-data; name="big"\n\n'
+        + b"x" * 1000
+        + b"\n--xyz--\n"
+    )
+    with pytest.raises(ValueError) as error:
+        multipart.parse_stream(
+            BytesIO(body), content_type=CONTENT_TYPE, max_field_size=100
+        )
+    assert "maximum size" in str(error)
@@ -0,0 +1,126 @@
+import os
+import signal
+import time
+from wsgiref.util import setup_testing_defaults
+
+from joshinkan.config import Config
+from joshinkan.httpd import Request, Response, Router, make_app
+from joshinkan.profiler import Profiler, install_signal_handler, profiling
+
+
+def busy_handler(seconds: float):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+def wait_for_samples(profiler: Profiler, timeout: float = 2.0):
+    end = time.monotonic() + timeout
+    while profiler.samples == 0 and time.monotonic() < end:
+        time.sleep(0.01)
+
+
+def test_profiler_samples_entered_thread(tmp_path):
+    profiler = Profiler(tmp_path, interval=0.001)
+    profiler.enter()
+    try:
+        busy_handler(0.2)
+    finally:
+        profiler.exit()
+    wait_for_samples(profiler)
+    profiler.stop()
+    assert not profiler.active
+
+    stacks = list(profiler.stacks)
+    assert any("busy_handler (test_profiler.py:" in stack for stack in stacks)
+    assert all(stack.split(";")[-1] for stack in stacks)
+
+    profiler.flush()
+    lines = profiler.path.read_text().splitlines()
+    assert profiler.path.name == f"profile-{os.getpid()}.folded"
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) == profiler.samples
+
+
+def test_profiler_flushes_while_sampling(tmp_path):
+    profiler = Profiler(tmp_path, interval=0.0001)
+    profiler.enter()
+    try:
+        end = time.monotonic() + 0.2
+        while time.monotonic() < end:
+            # NOTE: Varying stacks, so the sampler keeps adding new ones.
+            busy_handler(0.0001)
+            profiler.flush()
+    finally:
+        profiler.exit()
+        profiler.stop()
+    lines = profiler.path.read_text().splitlines()
+    assert 0 < sum(int(line.rsplit(" ", 1)[1]) for line in lines) <= profiler.samples
+
+
+def test_profiler_is_idle_without_requests(tmp_path):
+    profiler = Profiler(tmp_path, interval=0.001)
+    profiler.enter()
+    profiler.exit()
+    time.sleep(0.05)
+    samples = profiler.samples
+    busy_handler(0.05)
+    profiler.stop()
+    assert profiler.samples == samples
+
+
+def make_profiled_app(profiler: Profiler):
+    R = Router()
+
+    @R.get("/busy")
+    def busy(request: Request) -> Response:
+        busy_handler(0.2)
+        return 200, None
+
+    R.use(profiling(profiler))
+    R.set_config(Config(SMTP_USER="test@example.com", SMTP_PASSWORD="password"))
+    return make_app(R)
+
+
+def call(app, path: str) -> str:
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": ""}
+    setup_testing_defaults(environ)
+    response = {}
+
+    def start_response(status, headers):
+        response["status"] = status
+
+    b"".join(app(environ, start_response))
+    return response["status"]
+
+
+def test_profiling_middleware(tmp_path):
+    profiler = Profiler(tmp_path, sample_rate=1.0, interval=0.001)
+    app = make_profiled_app(profiler)
+    assert call(app, "/busy") == "200 OK"
+    wait_for_samples(profiler)
+    profiler.stop()
+    assert any("busy (test_profiler.py:" in stack for stack in profiler.stacks)
+
+
+def test_profiling_middleware_skips_unsampled_requests(tmp_path):
+    profiler = Profiler(tmp_path, sample_rate=0.0, interval=0.001)
+    app = make_profiled_app(profiler)
+    assert call(app, "/busy") == "200 OK"
+    assert profiler.samples == 0
+
+
+def test_profile_on_signal(tmp_path):
+    profiler = Profiler(tmp_path, interval=0.001)
+    previous = signal.getsignal(signal.SIGUSR2)
+    try:
+        assert install_signal_handler(profiler, seconds=0.2)
+        os.kill(os.getpid(), signal.SIGUSR2)
+        assert profiler.active
+        busy_handler(0.1)
+        wait_for_samples(profiler)
+    finally:
+        signal.signal(signal.SIGUSR2, previous)
+        profiler.stop()
+
+    assert any("busy_handler (test_profiler.py:" in stack for stack in profiler.stacks)
+    assert not any("sample (profiler.py:" in stack for stack in profiler.stacks)
@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from joshinkan.httpd import TooManyRequests
+from joshinkan.ratelimit import WAYS, BucketTable, RateLimiter, client_address
+
+
+def test_bucket_allows_burst_and_refills():
+    table = BucketTable(slots=64)
+    assert [table.take("key", 3, 1.0, now=100) for _ in range(3)] == [0, 0, 0]
+    assert table.take("key", 3, 1.0, now=100) == pytest.approx(1.0)
+    assert table.take("key", 3, 1.0, now=100.5) == pytest.approx(0.5)
+    assert table.take("key", 3, 1.0, now=101) == 0
+    # Other keys have their own buckets.
+    assert table.take("other", 3, 1.0, now=101) == 0
+
+
+def test_bucket_is_capped_at_capacity():
+    table = BucketTable(slots=64)
+    table.take("key", 2, 1.0, now=0)
+    assert [table.take("key", 2, 1.0, now=1000) for _ in range(3)][-1] > 0
+
+
+def test_least_recently_used_key_is_evicted():
+    table = BucketTable(slots=WAYS)  # a single set
+    for index in range(WAYS):
+        assert table.take(f"key-{index}", 1, 0.001, now=index) == 0
+    assert table.take("key-0", 1, 0.001, now=WAYS) > 0  # key-0 is now the newest
+
+    assert table.take("new", 1, 0.001, now=WAYS + 1) == 0
+    # key-1 was evicted and starts over with a full bucket, key-0 was kept.
+    assert table.take("key-1", 1, 0.001, now=WAYS + 2) == 0
+    assert table.take("key-0", 1, 0.001, now=WAYS + 3) > 0
+
+
+def test_table_is_shared_between_processes(tmp_path):
+    table = BucketTable(tmp_path, slots=64)
+    table.take("key", 2, 0.001)
+
+    pid = os.fork()
+    if pid == 0:
+        # NOTE: Like a gunicorn worker, which opens the table itself.
+        child_table = BucketTable(tmp_path, slots=64)
+        os._exit(0 if child_table.take("key", 2, 0.001) == 0 else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+
+    assert table.take("key", 2, 0.001) > 0
+    table.close()
+
+
+def test_table_of_another_size_is_reset(tmp_path):
+    BucketTable(tmp_path, slots=64).take("key", 1, 0.001)
+    assert BucketTable(tmp_path, slots=128).take("key", 1, 0.001) == 0
+
+
+def test_rate_limiter_raises():
+    limiter = RateLimiter(BucketTable(slots=64), burst=1, per_hour=60)
+    limiter.limit("key")
+    with pytest.raises(TooManyRequests) as error:
+        limiter.limit("key")
+    assert 0 < error.value.retry_after <= 60
+
+
+def test_client_address():
+    environ = {"REMOTE_ADDR": "127.0.0.1"}
+    assert client_address(environ) == "127.0.0.1"
+    environ["HTTP_X_REAL_IP"] = "203.0.113.7"
+    assert client_address(environ) == "203.0.113.7"
@@ -4,9 +4,11 @@ import pytest
 
 # from your_module import Client, ServerContext, User, SMTP
 from joshinkan.config import Config
+from joshinkan.idempotency import IdempotencyCache
+from joshinkan.ratelimit import BucketTable, RateLimiter
 from joshinkan.routes import AppContext, router
-from joshinkan.httpd import make_app, Client
-from joshinkan.smtp import Mailer, EmailUser
+from joshinkan.httpd import TIMINGS_KEY, Middleware, make_app, Client
+from joshinkan.smtp import Mailer, EmailUser, RecipientsPartlyRefused
 from unittest.mock import Mock
 
 
@@ -25,6 +27,7 @@ def client():
         SMTP_PASSWORD="password",
     )
     mailer = Mock(spec=Mailer)
+    mailer.send_many.return_value = [None, None]
     context = AppContext(mailer=mailer)
 
     router.set_config(config)
@@ -249,9 +252,11 @@ def test_register_adult(client: Client, adult_registration: RequestData):
     )
     assert response.status == 200
     assert response.json()["message"] == "Email sent."
-    assert client.app.context.mailer.send.call_count == 2
+    assert client.app.context.mailer.send_many.call_count == 1
+    messages = client.app.context.mailer.send_many.call_args.args[0]
+    assert len(messages) == 2
 
-    registration_mail = client.app.context.mailer.send.call_args_list[0].args[0]
+    registration_mail = messages[0][0]
     assert registration_mail["Subject"] == "Anmeldung zum Probetraining: Erwachsene"
     body = registration_mail.get_content()
     assert "Name: sven mkw" in body
@@ -259,7 +264,7 @@ def test_register_adult(client: Client, adult_registration: RequestData):
     assert "Email: sven.mkw@gmail.com" in body
     assert "Telefon: 123456789" in body
 
-    acknowledgement_mail = client.app.context.mailer.send.call_args_list[1].args[0]
+    acknowledgement_mail = messages[1][0]
     assert (
         acknowledgement_mail["Subject"]
         == "Joshinkan Werder Karate - Anmeldung zum Probetraining"
@@ -269,6 +274,20 @@ def test_register_adult(client: Client, adult_registration: RequestData):
     assert "Vielen Dank für die Anmeldung zum Probetraining." in body
 
 
+def test_register_with_refused_recipient(
+    client: Client, adult_registration: RequestData
+):
+    refused = RecipientsPartlyRefused({"bcc@example.com": (550, b"No")})
+    client.app.context.mailer.send_many.return_value = [None, refused]
+    response = client.post(
+        "/trial-registration",
+        headers=adult_registration.headers,
+        body=adult_registration.body,
+    )
+    # NOTE: The emails were sent to the other recipients.
+    assert response.status == 200
+
+
 def test_register_no_privacy(client: Client, register_no_privacy: RequestData):
     response = client.post(
         "/trial-registration",
@@ -277,6 +296,7 @@ def test_register_no_privacy(client: Client, register_no_privacy: RequestData):
     )
     assert response.status == 400
     assert "'privacy' is off" in response.json()["message"]
+    assert [error["path"] for error in response.json()["errors"]] == ["privacy"]
 
 
 def test_register_child(client: Client, child_registration: RequestData):
@@ -287,9 +307,11 @@ def test_register_child(client: Client, child_registration: RequestData):
     )
     assert response.status == 200
     assert response.json()["message"] == "Email sent."
-    assert client.app.context.mailer.send.call_count == 2
+    assert client.app.context.mailer.send_many.call_count == 1
+    messages = client.app.context.mailer.send_many.call_args.args[0]
+    assert len(messages) == 2
 
-    registration_mail = client.app.context.mailer.send.call_args_list[0].args[0]
+    registration_mail = messages[0][0]
     assert registration_mail["Subject"] == "Anmeldung zum Probetraining: Kinder (1)"
     body = registration_mail.get_content()
     assert "Name: Boi Fam" in body
@@ -301,7 +323,7 @@ def test_register_child(client: Client, child_registration: RequestData):
     assert "Telefon: 04912847" in body
     assert registration_mail["From"] == "sender@example.com"
 
-    acknowledgement_mail = client.app.context.mailer.send.call_args_list[1].args[0]
+    acknowledgement_mail = messages[1][0]
     assert (
         acknowledgement_mail["Subject"]
         == "Joshinkan Werder Karate - Anmeldung zum Probetraining"
@@ -320,9 +342,11 @@ def test_register_children(client: Client, children_registration: RequestData):
     )
     assert response.status == 200
     assert response.json()["message"] == "Email sent."
-    assert client.app.context.mailer.send.call_count == 2
+    assert client.app.context.mailer.send_many.call_count == 1
+    messages = client.app.context.mailer.send_many.call_args.args[0]
+    assert len(messages) == 2
 
-    registration_mail = client.app.context.mailer.send.call_args_list[0].args[0]
+    registration_mail = messages[0][0]
     assert registration_mail["Subject"] == "Anmeldung zum Probetraining: Kinder (2)"
     body = registration_mail.get_content()
     assert "Name: Boi Fam" in body
@@ -333,7 +357,7 @@ def test_register_children(client: Client, children_registration: RequestData):
     assert "Email: fam@mail.com" in body
     assert "Telefon: 049127495" in body
 
-    acknowledgement_mail = client.app.context.mailer.send.call_args_list[1].args[0]
+    acknowledgement_mail = messages[1][0]
     assert (
         acknowledgement_mail["Subject"]
         == "Joshinkan Werder Karate - Anmeldung zum Probetraining"
@@ -341,3 +365,83 @@ def test_register_children(client: Client, children_registration: RequestData):
     body = acknowledgement_mail.get_content()
     assert "Liebe Familie Fam" in body
     assert "Vielen Dank für die Anmeldung von Boi und Girl zum Probetraining." in body
+
+
+def test_register_is_rate_limited(
+    client: Client, adult_registration: RequestData, child_registration: RequestData
+):
+    client.app.context.rate_limiter = RateLimiter(
+        BucketTable(slots=64), burst=1, per_hour=1
+    )
+    response = client.post(
+        "/trial-registration",
+        headers={**adult_registration.headers, "X-Real-IP": "203.0.113.7"},
+        body=adult_registration.body,
+    )
+    assert response.status == 200
+
+    response = client.post(
+        "/trial-registration",
+        headers={**child_registration.headers, "X-Real-IP": "203.0.113.7"},
+        body=child_registration.body,
+    )
+    assert response.status == 429
+    assert 0 < int(response.headers["Retry-After"]) <= 3600
+
+    # Another client can not send more emails to the same address either.
+    response = client.post(
+        "/trial-registration",
+        headers={**adult_registration.headers, "X-Real-IP": "203.0.113.8"},
+        body=adult_registration.body,
+    )
+    assert response.status == 429
+    assert client.app.context.mailer.send_many.call_count == 1
+
+
+def test_register_records_validation(client: Client, adult_registration: RequestData):
+    timings = {}
+
+    def record_timings(environ, response):
+        timings.update(environ[TIMINGS_KEY])
+        return response
+
+    router.use(Middleware(after=record_timings))
+    try:
+        response = Client(make_app(router)).post(
+            "/trial-registration",
+            headers=adult_registration.headers,
+            body=adult_registration.body,
+        )
+    finally:
+        router.middleware.pop()
+    assert response.status == 200
+    assert {"form_parse", "validation", "handler"} <= timings.keys()
+
+
+def test_register_twice_sends_emails_once(
+    client: Client, adult_registration: RequestData
+):
+    client.app.context.idempotency = IdempotencyCache(60)
+    first = client.post(
+        "/trial-registration",
+        headers=adult_registration.headers,
+        body=adult_registration.body,
+    )
+    second = client.post(
+        "/trial-registration",
+        headers=adult_registration.headers,
+        body=adult_registration.body,
+    )
+    assert first.status == second.status == 200
+    assert first.json() == second.json()
+    assert second.headers["idempotent-replayed"] == "true"
+    assert client.app.context.mailer.send_many.call_count == 1
+
+    # A new Idempotency-Key marks an intended resubmission.
+    third = client.post(
+        "/trial-registration",
+        headers={**adult_registration.headers, "Idempotency-Key": "retry-1"},
+        body=adult_registration.body,
+    )
+    assert third.status == 200
+    assert client.app.context.mailer.send_many.call_count == 2
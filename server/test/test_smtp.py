@@ -1,5 +1,18 @@
+import asyncio
+import copy
+import io
 import pytest
-from joshinkan.smtp import EmailUser
+from email.generator import BytesGenerator
+from email.message import EmailMessage
+from smtplib import SMTPRecipientsRefused, SMTPServerDisconnected
+from joshinkan.smtp import (
+    AsyncMailer,
+    EmailUser,
+    Mailer,
+    RecipientsPartlyRefused,
+    prepare_message,
+)
+from joshinkan.templating import MailTemplate
 
 
 def test_parse_description_missing_closing_caret():
@@ -91,3 +104,227 @@ def test_parse_description_email_as_name():
     user = EmailUser.from_description("john@example.com")
     assert user.email == "john@example.com"
     assert user.name is None
+
+
+class FakeSMTP:
+    instances = []
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.logins = 0
+        self.sent = []
+        self.alive = True
+        self.closed = False
+        FakeSMTP.instances.append(self)
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        self.logins += 1
+
+    def noop(self):
+        if not self.alive:
+            raise SMTPServerDisconnected("Connection unexpectedly closed")
+        return 250, b"OK"
+
+    def send_message(self, message, to_addrs):
+        return self.sendmail(message["From"], to_addrs, message.as_bytes())
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        # NOTE: Like smtplib, fails if every recipient is refused and returns
+        # the refused ones otherwise.
+        if not self.alive:
+            raise SMTPServerDisconnected("Connection unexpectedly closed")
+        refused = {
+            addr: (550, b"No") for addr in to_addrs if addr == "refused@example.com"
+        }
+        if len(refused) == len(to_addrs):
+            raise SMTPRecipientsRefused(refused)
+        self.sent.append((msg, to_addrs))
+        return refused
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def mailer():
+    FakeSMTP.instances = []
+    return Mailer(
+        host="localhost",
+        port=587,
+        user=EmailUser.from_description("sender@example.com"),
+        password="password",
+        pool_size=1,
+        idle_timeout=60,
+        smtp_class=FakeSMTP,
+    )
+
+
+def make_message() -> EmailMessage:
+    message = EmailMessage()
+    message["Subject"] = "Hello"
+    message.set_content("Hello there")
+    return message
+
+
+def test_mailer_reuses_session(mailer):
+    to_addrs = [EmailUser.from_description("to@example.com")]
+    mailer.send(make_message(), to_addrs=to_addrs)
+    mailer.send(make_message(), to_addrs=to_addrs)
+
+    assert len(FakeSMTP.instances) == 1
+    assert FakeSMTP.instances[0].logins == 1
+    assert len(FakeSMTP.instances[0].sent) == 2
+    assert FakeSMTP.instances[0].sent[0][1] == ["to@example.com"]
+
+
+def test_mailer_reconnects_dropped_session(mailer):
+    to_addrs = [EmailUser.from_description("to@example.com")]
+    mailer.send(make_message(), to_addrs=to_addrs)
+    FakeSMTP.instances[0].alive = False
+    mailer.send(make_message(), to_addrs=to_addrs)
+
+    assert len(FakeSMTP.instances) == 2
+    assert FakeSMTP.instances[0].closed
+    assert len(FakeSMTP.instances[1].sent) == 1
+
+
+def test_mailer_closes_idle_session(mailer):
+    to_addrs = [EmailUser.from_description("to@example.com")]
+    mailer.idle_timeout = 0
+    mailer.send(make_message(), to_addrs=to_addrs)
+    mailer.send(make_message(), to_addrs=to_addrs)
+
+    assert len(FakeSMTP.instances) == 2
+    assert FakeSMTP.instances[0].closed
+
+
+def test_mailer_pool_size(mailer):
+    with mailer.connection() as first:
+        with mailer.connection() as second:
+            assert first is not second
+
+    # Only one session fits into the pool, the other one is closed.
+    assert len(mailer._pool) == 1
+    assert sum(smtp.closed for smtp in FakeSMTP.instances) == 1
+
+    mailer.close()
+    assert len(mailer._pool) == 0
+    assert all(smtp.closed for smtp in FakeSMTP.instances)
+
+
+def test_send_many_single_session(mailer):
+    to_addrs = [EmailUser.from_description("to@example.com")]
+    refused = [EmailUser.from_description("refused@example.com")]
+    results = mailer.send_many(
+        [
+            (make_message(), to_addrs),
+            (make_message(), refused),
+            (make_message(), to_addrs),
+        ]
+    )
+
+    assert results[0] is None
+    assert isinstance(results[1], SMTPRecipientsRefused)
+    assert results[2] is None
+    assert len(FakeSMTP.instances) == 1
+    assert FakeSMTP.instances[0].logins == 1
+    assert len(FakeSMTP.instances[0].sent) == 2
+
+
+def test_send_many_reports_partly_refused_recipients(mailer):
+    to_addrs = [
+        EmailUser.from_description("to@example.com"),
+        EmailUser.from_description("refused@example.com"),
+    ]
+    (result,) = mailer.send_many([(make_message(), to_addrs)])
+
+    assert isinstance(result, RecipientsPartlyRefused)
+    assert result.refused == {"refused@example.com": (550, b"No")}
+    assert len(FakeSMTP.instances[0].sent) == 1
+
+
+def test_send_raises_refused_recipients(mailer):
+    with pytest.raises(SMTPRecipientsRefused):
+        mailer.send(make_message(), [EmailUser.from_description("refused@example.com")])
+
+
+def test_async_mailer(mailer):
+    to_addrs = [EmailUser.from_description("to@example.com")]
+    refused = [EmailUser.from_description("refused@example.com")]
+    async_mailer = AsyncMailer(mailer)
+
+    async def send():
+        await async_mailer.send(make_message(), to_addrs)
+        return await async_mailer.send_many([(make_message(), refused)])
+
+    (error,) = asyncio.run(send())
+    assert isinstance(error, SMTPRecipientsRefused)
+    assert len(FakeSMTP.instances[0].sent) == 1
+
+
+def flatten(message: EmailMessage) -> bytes:
+    """Serialise the message like `SMTP.send_message` does."""
+    message = copy.copy(message)
+    del message["Bcc"]
+    stream = io.BytesIO()
+    BytesGenerator(stream).flatten(message, linesep="\r\n")
+    return stream.getvalue()
+
+
+def test_prepare_message_matches_send_message():
+    template = MailTemplate("Subject: Hallo {name}\n\n<p>Grüße,\n{name}</p>\n")
+    headers = {
+        "From": "Jürgen <sender@example.com>",
+        "Cc": "cc@example.com",
+        "Bcc": "bcc@example.com",
+    }
+    for name in ["Sven", "Jörg " * 30]:
+        message = template.message(headers, name=name)
+        message["To"] = f"{name} <to@example.com>"
+        prepared = prepare_message(message)
+        assert prepared.sender == "sender@example.com"
+        assert prepared.data == flatten(message)
+        assert b"bcc@example.com" not in prepared.data
+
+
+def test_prepare_message_falls_back():
+    message = make_message()
+    message["From"] = "sender@example.com"
+    assert prepare_message(message).data == flatten(message)
+
+    message.set_content("Grüße")  # 8bit
+    assert prepare_message(message) is None
+    assert prepare_message(make_message()) is None  # no sender
+
+
+def test_send_many_sends_prepared_bytes(mailer):
+    message = make_message()
+    message["From"] = "sender@example.com"
+    to_addrs = [EmailUser.from_description("to@example.com")]
+    mailer.send(message, to_addrs)
+    assert FakeSMTP.instances[0].sent == [(flatten(message), ["to@example.com"])]
+
+
+def test_mailer_reconfigure_drops_sessions(mailer):
+    to_addrs = [EmailUser.from_description("to@example.com")]
+    mailer.send(make_message(), to_addrs)
+    with mailer.connection() as in_use:
+        mailer.reconfigure(
+            "smtp.example.com",
+            465,
+            EmailUser.from_description("new@example.com"),
+            "new",
+        )
+    assert in_use.closed
+    assert mailer._pool == []
+
+    mailer.send(make_message(), to_addrs)
+    assert FakeSMTP.instances[-1].host == "smtp.example.com"
+    assert len(FakeSMTP.instances) == 2
@@ -0,0 +1,115 @@
+from email.message import EmailMessage
+import threading
+
+from joshinkan.mailqueue import MailQueue
+from joshinkan.smtp import EmailUser
+from joshinkan.spool import Spool, read_pending
+
+
+def make_message(subject: str = "Hello") -> EmailMessage:
+    message = EmailMessage()
+    message["Subject"] = subject
+    message["From"] = "sender@example.com"
+    message.set_content("Hallo Grüße")
+    return message
+
+
+TO_ADDRS = [EmailUser(name="John Smith", email="john@example.com")]
+
+
+def test_pending_mails(tmp_path):
+    spool = Spool(tmp_path)
+    first = spool.add(make_message("first"), TO_ADDRS)
+    spool.add(make_message("second"), TO_ADDRS)
+    spool.done(first)
+
+    pending = read_pending(spool.path)
+    assert len(pending) == 1
+    assert pending[0].message["Subject"] == "second"
+    assert pending[0].message.get_content().strip() == "Hallo Grüße"
+    assert pending[0].to_addrs == TO_ADDRS
+    assert spool.pending() == 1
+
+
+def test_ignores_truncated_record(tmp_path):
+    spool = Spool(tmp_path)
+    spool.add(make_message(), TO_ADDRS)
+    with open(spool.path, "a") as file:
+        file.write('{"op":"add","id":2,"to":')
+
+    assert len(read_pending(spool.path)) == 1
+
+
+def test_recover_abandoned_spool(tmp_path):
+    abandoned = Spool(tmp_path)
+    abandoned.add(make_message("lost"), TO_ADDRS)
+    abandoned.close()
+
+    spool = Spool(tmp_path)
+    recovered = spool.recover()
+    assert [mail.message["Subject"] for mail in recovered] == ["lost"]
+    assert not abandoned.path.exists()
+    assert spool.pending() == 1
+
+    # The mail is now owned by the new spool.
+    spool.done(recovered[0].id)
+    assert read_pending(spool.path) == []
+
+
+def test_recover_skips_running_spool(tmp_path):
+    running = Spool(tmp_path)
+    running.add(make_message(), TO_ADDRS)
+
+    spool = Spool(tmp_path)
+    assert spool.recover() == []
+    assert running.path.exists()
+
+
+def test_compaction(tmp_path):
+    spool = Spool(tmp_path, compact_after=4)
+    for _ in range(2):
+        spool.done(spool.add(make_message(), TO_ADDRS))
+    assert spool.path.stat().st_size == 0
+
+
+def test_concurrent_writers(tmp_path):
+    spool = Spool(tmp_path)
+
+    def write():
+        for _ in range(20):
+            spool.add(make_message(), TO_ADDRS)
+
+    threads = [threading.Thread(target=write) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(read_pending(spool.path)) == 80
+
+
+def test_mail_queue_restores_spool(tmp_path):
+    class FailingMailer:
+        def send_many(self, messages):
+            raise ConnectionRefusedError()
+
+    queue = MailQueue(FailingMailer(), max_attempts=1, spool=Spool(tmp_path))
+    queue.send(make_message("undelivered"), TO_ADDRS)
+    assert queue.join(timeout=5)
+    queue.stop()
+    queue.spool.close()
+
+    class Mailer:
+        sent = []
+
+        def send_many(self, messages):
+            self.sent.extend(message["Subject"] for message, _ in messages)
+            return [None] * len(messages)
+
+    mailer = Mailer()
+    queue = MailQueue(mailer, spool=Spool(tmp_path))
+    assert queue.restore() == 1
+    assert queue.join(timeout=5)
+    assert mailer.sent == ["undelivered"]
+    assert queue.spool.pending() == 0
+    queue.stop()
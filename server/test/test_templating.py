@@ -0,0 +1,103 @@
+import pytest
+
+from joshinkan.templating import (
+    MailTemplate,
+    Markup,
+    Template,
+    TemplateError,
+    Templates,
+)
+
+HEADERS = {"From": "Joshinkan <sender@example.com>", "Cc": "cc@example.com"}
+
+
+def test_render_escapes_values():
+    template = Template('<a href="{url}">{name}</a> {{literal}}')
+    assert (
+        template.render(url='"><script>', name="Tom & Jerry")
+        == '<a href="&quot;&gt;&lt;script&gt;">Tom &amp; Jerry</a> {literal}'
+    )
+
+
+def test_render_keeps_markup():
+    template = Template("<p>{content}</p>")
+    rendered = template.render(content=Markup("<b>bold</b>"))
+    assert rendered == "<p><b>bold</b></p>"
+    assert isinstance(rendered, Markup)
+
+
+def test_render_without_autoescape():
+    assert Template("{name}", autoescape=False).render(name="<b>") == "<b>"
+
+
+@pytest.mark.parametrize("text", ["{0}", "{name:>10}", "{name!r}", "{user.name}"])
+def test_unsupported_placeholders(text: str):
+    with pytest.raises(TemplateError):
+        Template(text)
+
+
+def test_missing_value():
+    with pytest.raises(TemplateError, match="needs the value 'name'"):
+        Template("Hallo {name}", "greeting.html").render()
+
+
+def test_mail_template():
+    template = MailTemplate("Subject: Hallo {name}\n\n<p>Grüße, {name}</p>\n")
+    message = template.message(HEADERS, name="<Jürgen>")
+    message["To"] = "juergen@example.com"
+
+    assert message["Subject"] == "Hallo <Jürgen>"
+    assert message["From"] == "Joshinkan <sender@example.com>"
+    assert message["Cc"] == "cc@example.com"
+    assert message["To"] == "juergen@example.com"
+    assert message.get_content_type() == "text/html"
+    assert message.get_content() == "<p>Grüße, &lt;Jürgen&gt;</p>\n"
+    assert message.as_bytes().isascii()
+
+
+def test_mail_template_reuses_skeleton():
+    template = MailTemplate("Subject: Hallo\n\nHallo")
+    first = template.message(HEADERS)
+    second = template.message(HEADERS)
+    assert first is not second
+    assert first["From"] is second["From"]
+
+    second["To"] = "to@example.com"
+    assert first["To"] is None
+
+
+def test_mail_template_needs_subject():
+    with pytest.raises(TemplateError):
+        MailTemplate("<p>No subject</p>")
+
+
+def test_templates_are_loaded(tmp_path):
+    (tmp_path / "mail.html").write_text("Subject: Hallo\n\n{content}")
+    (tmp_path / "partial.html").write_text("<b>{name}</b>")
+    (tmp_path / "notes.txt").write_text("ignored")
+
+    templates = Templates(tmp_path)
+    assert list(templates.mails) == ["mail"]
+    assert list(templates.partials) == ["partial"]
+    content = templates.partial("partial").render(name="Sven")
+    message = templates.mail("mail").message({}, content=content)
+    assert message.get_content() == "<b>Sven</b>"
+
+
+def test_builtin_templates():
+    templates = Templates()
+    assert set(templates.mails) == {
+        "acknowledgement_adult",
+        "acknowledgement_children",
+        "registration_adult",
+        "registration_children",
+    }
+    assert set(templates.partials) == {"child"}
+
+
+def test_require_reports_missing_templates(tmp_path):
+    (tmp_path / "mail.html").write_text("Subject: Hallo\n\nHallo")
+    templates = Templates(tmp_path)
+    templates.require(mails=("mail",))
+    with pytest.raises(TemplateError, match="Missing templates: child, other"):
+        templates.require(mails=("mail", "other"), partials=("child",))
@@ -0,0 +1,179 @@
+import json
+from email.message import EmailMessage
+from io import StringIO
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+from joshinkan import tracing
+from joshinkan.config import Config
+from joshinkan.httpd import (
+    Request,
+    Response,
+    Router,
+    ValidationType,
+    expect_schema,
+    get_request_id,
+    make_app,
+)
+from joshinkan.mailqueue import MailQueue
+from joshinkan.smtp import EmailUser
+from joshinkan.validation import Schema
+
+
+@pytest.fixture
+def exported():
+    stream = StringIO()
+    tracing.configure(tracing.SpanExporter(stream))
+
+    def read() -> list[list[dict]]:
+        tracing.configure(None)  # waits for the queued spans
+        return [
+            json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+            for line in stream.getvalue().splitlines()
+        ]
+
+    yield read
+    tracing.configure(None)
+
+
+def attributes(span: dict) -> dict:
+    return {
+        attribute["key"]: next(iter(attribute["value"].values()))
+        for attribute in span["attributes"]
+    }
+
+
+def test_span_is_a_noop_without_exporter():
+    tracing.configure(None)
+    with tracing.span("noop", key="value") as span:
+        span.set_attribute("other", 1)
+        assert span is tracing.NULL_SPAN
+        assert tracing.current_span_context() is None
+
+
+def test_nested_spans_are_exported_with_the_root(exported):
+    with tracing.span("root", trace_id="0" * 31 + "1", user="Jürgen") as root:
+        with tracing.span("child") as child:
+            assert tracing.current_span_context() == child.context
+        with pytest.raises(ValueError):
+            with tracing.span("failing"):
+                raise ValueError("boom")
+        root.set_attribute("count", 2)
+    assert tracing.current_span_context() is None
+
+    (spans,) = exported()
+    child, failing, root = spans
+    assert [span["name"] for span in spans] == ["child", "failing", "root"]
+    assert {span["traceId"] for span in spans} == {"0" * 31 + "1"}
+    assert child["parentSpanId"] == root["spanId"]
+    assert failing["parentSpanId"] == root["spanId"]
+    assert "parentSpanId" not in root
+    assert failing["status"] == {"code": 2, "message": "ValueError('boom')"}
+    assert attributes(root) == {"user": "Jürgen", "count": "2"}
+    assert int(root["startTimeUnixNano"]) <= int(child["startTimeUnixNano"])
+    assert int(child["endTimeUnixNano"]) <= int(root["endTimeUnixNano"])
+
+
+@pytest.mark.parametrize(
+    "header,accepted",
+    [
+        ("0123456789abcdef0123456789abcdef", True),
+        ("my-request.id_1", True),
+        ("", False),
+        ("x" * 129, False),
+        ("with space", False),
+        ("ümlaut", False),
+    ],
+)
+def test_get_request_id(header: str, accepted: bool):
+    request_id = get_request_id({"HTTP_X_REQUEST_ID": header})
+    if accepted:
+        assert request_id == header
+    else:
+        assert tracing.is_trace_id(request_id)
+
+
+def make_traced_app():
+    R = Router()
+
+    @R.post("/members")
+    @expect_schema(Schema({"name": str}), validate=ValidationType.JSON_BODY)
+    def create_member(request: Request) -> Response:
+        return 200, {"request_id": request.request_id}
+
+    R.set_config(Config(SMTP_USER="test@example.com", SMTP_PASSWORD="password"))
+    return make_app(R)
+
+
+def call(app, body: bytes, headers: dict = {}):
+    environ = {
+        "REQUEST_METHOD": "POST",
+        "PATH_INFO": "/members",
+        "QUERY_STRING": "",
+        "CONTENT_LENGTH": str(len(body)),
+        "CONTENT_TYPE": "application/json",
+        **headers,
+    }
+    setup_testing_defaults(environ)
+    environ["wsgi.input"].write(body)
+    environ["wsgi.input"].seek(0)
+
+    response = {}
+
+    def start_response(status, headers):
+        response["status"] = status
+        response["headers"] = dict(headers)
+
+    body = b"".join(app(environ, start_response))
+    return response["status"], response["headers"], body
+
+
+def test_request_spans(exported):
+    request_id = "0123456789abcdef0123456789abcdef"
+    status, headers, body = call(
+        make_traced_app(), b'{"name": "Sven"}', {"HTTP_X_REQUEST_ID": request_id}
+    )
+    assert status == "200 OK"
+    assert headers["X-Request-ID"] == request_id
+    assert json.loads(body) == {"request_id": request_id}
+
+    (spans,) = exported()
+    names = [span["name"] for span in spans]
+    assert names == ["parse", "validate", "handler", "request"]
+    assert {span["traceId"] for span in spans} == {request_id}
+    root = spans[-1]
+    assert root["kind"] == tracing.SPAN_KIND_SERVER
+    assert attributes(root)["http.route"] == "/members"
+    assert attributes(root)["http.response.status_code"] == "200"
+    assert attributes(spans[1]) == {"valid": True}
+
+
+def test_request_id_without_tracing():
+    tracing.configure(None)
+    status, headers, body = call(make_traced_app(), b'{"name": "Sven"}')
+    assert tracing.is_trace_id(headers["X-Request-ID"])
+    assert json.loads(body) == {"request_id": headers["X-Request-ID"]}
+
+
+def test_mail_queue_links_delivery_to_request(exported):
+    class Mailer:
+        def send_many(self, messages):
+            with tracing.span("smtp.send_many"):
+                return [None] * len(messages)
+
+    queue = MailQueue(Mailer())
+    message = EmailMessage()
+    message["Subject"] = "Hello"
+    with tracing.span("request") as request:
+        queue.send(message, [EmailUser.from_description("to@example.com")])
+    assert queue.join(timeout=5)
+    queue.stop()
+
+    request_spans, delivery_spans = sorted(exported(), key=len)
+    send, deliver = delivery_spans
+    assert send["parentSpanId"] == deliver["spanId"]
+    assert deliver["traceId"] != request.trace_id
+    assert deliver["links"] == [
+        {"traceId": request.trace_id, "spanId": request.span_id}
+    ]
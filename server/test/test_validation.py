@@ -3,6 +3,7 @@ from joshinkan.validation import (
     DictOf,
     InvalidSchema,
     ListOf,
+    OneOf,
     Optional,
     OptionalKey,
     Schema,
@@ -311,3 +312,184 @@ class TestOptional:
             " Expected one of [<class 'NoneType'>, <class 'str'>]"
             in invalid_schema.message
         )
+
+
+class TestOneOf:
+    SCHEMA = OneOf(
+        {
+            "adult": Schema({"kind": str, "age": int}),
+            "child": Schema({"kind": str, "parent": str}),
+        },
+        discriminator="kind",
+    )
+
+    def test_discriminator(self):
+        assert self.SCHEMA.validate({"kind": "adult", "age": 3}) == (True, None)
+        assert self.SCHEMA.validate({"kind": "child", "parent": "x"}) == (True, None)
+
+    def test_discriminator_picks_error(self):
+        is_valid, invalid_schema = self.SCHEMA.validate({"kind": "child", "age": 3})
+        assert not is_valid
+        assert invalid_schema.message == "The key 'parent' is missing."
+
+    def test_unknown_discriminator(self):
+        is_valid, invalid_schema = self.SCHEMA.validate({"kind": "baby"}, "form")
+        assert not is_valid
+        assert invalid_schema.path == "form.kind"
+        assert "Expected one of ['adult', 'child']" in invalid_schema.message
+
+    def test_missing_discriminator(self):
+        is_valid, invalid_schema = self.SCHEMA.validate({"age": 3})
+        assert not is_valid
+        assert invalid_schema.message == "The key 'kind' is missing."
+
+    def test_key_presence(self):
+        schema = OneOf(
+            {"children": Schema({"children": ListOf(str)})},
+            default=Schema({"name": str}),
+        )
+        assert schema.validate({"children": ["a"]}) == (True, None)
+        assert schema.validate({"name": "a"}) == (True, None)
+
+        is_valid, invalid_schema = schema.validate({"name": "a", "children": []})
+        assert not is_valid
+        assert invalid_schema.message == "The key 'name' is not defined in the schema."
+
+    def test_key_presence_without_default(self):
+        schema = OneOf({"a": Schema({"a": int}), "b": Schema({"b": int})})
+        is_valid, invalid_schema = schema.validate({"c": 1})
+        assert not is_valid
+        assert invalid_schema.message == "Expected one of the keys ['a', 'b']."
+
+    def test_only_selected_branch_is_validated(self):
+        class Exploding(TypeOf):
+            def __init__(self):
+                super().__init__(object)
+
+            def validate(self, actual, path=None):
+                raise AssertionError("Should not be validated")
+
+        schema = OneOf({"a": Schema({"a": int})}, default=Exploding())
+        assert schema.validate({"a": 1}) == (True, None)
+        assert schema.compile().validate({"a": 1}) == (True, None)
+
+
+class MyValidator(TypeOf):
+    def __init__(self):
+        super().__init__(int)
+
+    def validate(self, actual, path=None):
+        if actual == 42:
+            return True, None
+        return False, InvalidSchema(f"Not 42 at {path}", path)
+
+
+COMPILE_CASES = [
+    (TypeOf(int), 5),
+    (TypeOf(int), "5"),
+    (ListOf(int), [1, 2, "3"]),
+    (ListOf(int), 3),
+    (TypeOr(int, float), "hi"),
+    (TypeOr(Values(1, 2, 3), ListOf(float)), [1]),
+    (Values(1, 2, 3), 5),
+    (Optional(str), 1),
+    (Optional(str), None),
+    (Schema({"a": int}), 5),
+    (Schema({"a": int, "b": str}), {"a": 1}),
+    (Schema({"a": int}), {"a": 1, "b": 2}),
+    (Schema({"a": int, OptionalKey("b"): str}), {"a": 1}),
+    (Schema({"a": int, OptionalKey("b"): str}), {"a": 1, "b": 2}),
+    (Schema({"a": int, OptionalKey("b"): str}), {"a": 1, "c": 2}),
+    (Schema({"region": Schema({"a": int})}), {"region": {"a": "1"}}),
+    (ListOf(Schema({"a": int})), [{"a": 1}, {"b": 1}]),
+    (DictOf(key_type=str, value_type=int, allow_empty=False), {}),
+    (DictOf(key_type=str, value_type=object), {1: 1}),
+    (DictOf(key_type=str, value_type=Values(1, 2)), {"1": None}),
+    (DictOf(key_type=str, value_type=Schema({"a": int})), {"b": {"a": "x"}}),
+    (Schema({"a": MyValidator()}), {"a": 42}),
+    (Schema({"a": MyValidator()}), {"a": 41}),
+    (OneOf({"a": Schema({"a": int})}, default=Schema({"b": int})), {"a": "1"}),
+    (OneOf({"a": Schema({"a": int})}, default=Schema({"b": int})), {"b": "1"}),
+    (OneOf({"a": Schema({"a": int})}), {"b": 1}),
+    (OneOf({"a": Schema({"kind": str})}, discriminator="kind"), {"kind": "b"}),
+    (OneOf({"a": Schema({"kind": str})}, discriminator="kind"), {"kind": ["a"]}),
+    (OneOf({"a": Schema({"kind": str})}, discriminator="kind"), {}),
+    (OneOf({"a": Schema({"kind": str})}, discriminator="kind"), 5),
+]
+
+
+class TestCompile:
+    @pytest.mark.parametrize("schema,value", COMPILE_CASES)
+    @pytest.mark.parametrize("path", [None, "hello.there"])
+    def test_same_result(self, schema, value, path):
+        expected_valid, expected_error = schema.validate(value, path)
+        is_valid, invalid_schema = schema.compile().validate(value, path)
+
+        assert is_valid == expected_valid
+        if expected_error is None:
+            assert invalid_schema is None
+        else:
+            assert invalid_schema.message == expected_error.message
+            assert invalid_schema.path == expected_error.path
+
+    def test_compile_is_idempotent(self):
+        compiled = Schema({"a": int}).compile()
+        assert compiled.compile() is compiled
+
+
+class TestValidateAll:
+    SCHEMA = Schema(
+        {
+            "a": int,
+            "b": str,
+            "c": ListOf(int),
+            OptionalKey("d"): DictOf(key_type=str, value_type=int),
+        }
+    )
+
+    def test_valid(self):
+        assert self.SCHEMA.validate_all({"a": 1, "b": "x", "c": []}) == (True, [])
+        assert self.SCHEMA.compile().validate_all({"a": 1, "b": "x", "c": []}) == (
+            True,
+            [],
+        )
+
+    def test_collects_every_error(self):
+        is_valid, errors = self.SCHEMA.validate_all(
+            {"a": "1", "c": [1, "2", "3"], "d": {"x": "y"}, "e": 5}
+        )
+        assert not is_valid
+        assert [error.path for error in errors] == [
+            "b",
+            "e",
+            "a",
+            "c[1]",
+            "c[2]",
+            "d.x",
+        ]
+        assert errors[0].message == "The key 'b' is missing."
+
+    def test_first_error_matches_validate(self):
+        value = {"a": "1", "b": 2, "c": [1]}
+        _, error = self.SCHEMA.validate(value)
+        _, errors = self.SCHEMA.compile().validate_all(value)
+        assert errors[0].message == error.message
+
+    def test_max_errors(self):
+        is_valid, errors = ListOf(int).validate_all(["x"] * 100, max_errors=3)
+        assert not is_valid
+        assert [error.path for error in errors] == ["[0]", "[1]", "[2]"]
+
+    def test_max_depth(self):
+        schema = ListOf(ListOf(int))
+        _, errors = schema.validate_all([["x", "y"], ["z"]])
+        assert [error.path for error in errors] == ["[0][0]", "[0][1]", "[1][0]"]
+
+        # Below the maximum depth only the first error of each value is reported
+        _, errors = schema.validate_all([["x", "y"], ["z"]], max_depth=1)
+        assert [error.path for error in errors] == ["[0][0]", "[1][0]"]
+
+    def test_one_of(self):
+        schema = OneOf({"a": Schema({"a": int, "b": int})}, default=Schema({"c": int}))
+        _, errors = schema.validate_all({"a": "1", "b": "2"})
+        assert [error.path for error in errors] == ["a", "b"]